@@ -0,0 +1,182 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Benchmarks, each one a module to be run from the top directory, such as:
+
+    python -m benchmarks.stanzas --count 100000
+
+The ones which need a server use the loopback one from the tests.
+"""
+
+import argparse
+import os
+import resource
+import threading
+import time
+
+from tests import server
+
+def parser(description):
+    """
+    Creates the command line parser of a benchmark.
+
+    :param description: The benchmark module docstring.
+    """
+    return argparse.ArgumentParser(
+        description=description.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+
+
+def peak_rss():
+    """
+    Gets the peak resident memory of the process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+
+def rss():
+    """
+    Gets the current resident memory of the process, in MB.
+    """
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+
+    return pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+
+def timed(function, *args, **kwargs):
+    """
+    Calls a function.
+
+    :return Returns the elapsed time, in seconds, and the function result.
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+
+    return time.time() - start, result
+
+
+
+def best(repeat, function, *args, **kwargs):
+    """
+    Calls a function several times.
+
+    :return Returns the shortest elapsed time, in seconds.
+    """
+    return min(timed(function, *args, **kwargs)[0] for _ in range(repeat))
+
+
+
+def report(title, rows):
+    """
+    Prints the results of a benchmark.
+
+    :param title: The benchmark title.
+    :param rows: A list of (name, value) tuples. Floats are shown with
+                 three decimal places.
+    """
+    print title
+    width = max(len(name) for name, unused in rows)
+
+    for name, value in rows:
+        if isinstance(value, float):
+            value = '%.3f' % value
+
+        print '  %-*s  %s' % (width, name, value)
+
+
+
+class Counter(object):
+    """
+    A thread safe counter which can be waited for.
+    """
+    def __init__(self):
+        self.value = 0
+        self._condition = threading.Condition()
+
+
+    def add(self, count=1):
+        with self._condition:
+            self.value += count
+            self._condition.notify_all()
+
+
+    def wait(self, value, timeout=None):
+        """
+        Waits until the counter reaches a value.
+
+        :return Returns True if it did.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._condition:
+            while self.value < value:
+                if deadline is not None and time.time() > deadline:
+                    return False
+
+                self._condition.wait(0.1)
+
+        return True
+
+
+
+def login(loopback, user, handle_received_message=None, **options):
+    """
+    Logs a user in the loopback server.
+
+    :param loopback: The tests.server.Server object.
+    :param user: The user name.
+    :param handle_received_message: The function to be called with the
+                                    received messages. If omitted, they're
+                                    ignored.
+    :param options: Options of the chat.Chat object.
+
+    :return Returns the chat.Chat object.
+    """
+    chat = server.chat_class(loopback)(
+        handle_received_message or (lambda sender, body: None), **options)
+    chat.login([user, 'secret', server.DOMAIN, 'bench'])
+
+    if chat.wait_session() is False:
+        raise Exception("unable to log %s in" % user)
+
+    return chat
+
+
+
+def directory():
+    """
+    Gets a directory for the files of a benchmark, removed at exit.
+    """
+    import atexit
+    import shutil
+    import tempfile
+
+    path = tempfile.mkdtemp(prefix='shellber-bench-')
+    atexit.register(shutil.rmtree, path, True)
+
+    return path
+
+
+
+def file_size(path):
+    return os.path.getsize(path) / (1024.0 * 1024.0)
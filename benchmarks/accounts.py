@@ -0,0 +1,117 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Sends messages from several accounts logged in at the same time, as the
+application does with the sessions of the "accounts" config section. For
+each number of sessions, it reports the messages per second of all of them
+together, the mean latency of a message() call, the scaling efficiency,
+which is the total rate divided by the rate of a single session times the
+number of sessions, and the threads running while they're logged in.
+
+The client sessions and the loopback server share one process, and so the
+same interpreter lock.
+"""
+
+import threading
+import time
+
+import benchmarks
+from tests import server
+
+def _send(chat, count, latencies):
+    start = time.time()
+
+    for index in range(count):
+        chat.message(u'message %d' % index, 'alert@' + server.SINK)
+
+    latencies.append((time.time() - start) / count)
+
+
+
+def _run(loopback, sessions, count):
+    """
+    Sends @count messages from each one of @sessions accounts at once.
+
+    :return Returns the messages per second, the mean message() latency,
+            in seconds, and the number of threads.
+    """
+    loopback.sunk = 0
+    chats = [benchmarks.login(loopback, 'user%d' % index)
+             for index in range(sessions)]
+    running = threading.active_count()
+    latencies = []
+
+    try:
+        threads = [threading.Thread(target=_send,
+                                    args=(chat, count, latencies))
+                   for chat in chats]
+        start = time.time()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if loopback.wait_sunk(sessions * count) is False:
+            raise Exception("only %d of %d messages arrived" %
+                            (loopback.sunk, sessions * count))
+
+        elapsed = time.time() - start
+    finally:
+        for chat in chats:
+            chat.logout()
+
+    return (sessions * count / elapsed, sum(latencies) / len(latencies),
+            running)
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=5000,
+                        help="messages per session (default: %(default)s)")
+    parser.add_argument('--sessions', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help="numbers of sessions (default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server()
+    rows = []
+    single = None
+
+    for sessions in args.sessions:
+        rate, latency, running = _run(loopback, sessions, args.count)
+        single = single or rate / sessions
+
+        rows += [("%d sessions, messages/s" % sessions, rate),
+                 ("%d sessions, message() mean (us)" % sessions,
+                  latency * 1e6),
+                 ("%d sessions, efficiency" % sessions,
+                  rate / (single * sessions)),
+                 ("%d sessions, threads" % sessions, running)]
+
+    loopback.close()
+    benchmarks.report("Concurrent sessions, %d messages each" % args.count,
+                      rows)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Logs in with a history whose conversations stopped a day ago, while the
+archive of the loopback server kept their messages since then, so the
+session catches up with all of them. The server answers each archive query
+after a delay, as a remote one would. For each number of conversations
+fetched at the same time, it reports the time from the login until the
+first message was delivered and until the catch-up finished.
+"""
+
+import os
+import time
+
+import benchmarks
+from shellber.chat import archive
+from shellber.chat import history
+from tests import server
+
+def _peer(index):
+    return u'user%d@%s' % (index, server.DOMAIN)
+
+
+
+def _catch_up(loopback, directory, conversations, concurrency, page_size):
+    """
+    Logs in with a history which has a message from each conversation, from
+    a day ago.
+
+    :return Returns the time until the first message and until the end of
+            the catch-up, in seconds, and the number of fetched messages.
+    """
+    owner = u'alice@' + server.DOMAIN
+    store = history.History(os.path.join(directory, owner + '.db'))
+    yesterday = time.time() - archive.PERIOD + 600
+
+    for index in range(conversations):
+        store.append(_peer(index), history.INCOMING, _peer(index), u'hello',
+                     yesterday)
+
+    store.close()
+
+    first = []
+    notifications = []
+    received = lambda sender, body: first or first.append(time.time())
+
+    start = time.time()
+    alice = benchmarks.login(loopback, 'alice', received,
+                             handle_notification=notifications.append,
+                             history_directory=directory,
+                             archive_concurrency=concurrency,
+                             archive_page_size=page_size)
+
+    try:
+        if server.wait(lambda: [n for n in notifications
+                                if n.startswith("Fetched ")],
+                       timeout=600) is False:
+            raise Exception("the catch-up never finished")
+
+        finished = time.time()
+        done = [n for n in notifications if n.startswith("Fetched ")][0]
+    finally:
+        alice.logout()
+
+    return first[0] - start, finished - start, int(done.split()[1])
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--conversations', type=int, default=200,
+                        help="number of conversations (default: %(default)s)")
+    parser.add_argument('--messages', type=int, default=200,
+                        help="messages of each conversation "
+                        "(default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="delay of each archive answer, in seconds "
+                        "(default: %(default)s)")
+    parser.add_argument('--page-size', type=int, default=archive.PAGE_SIZE,
+                        help="messages per archive page "
+                        "(default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, archive.CONCURRENCY, 32],
+                        help="conversations fetched at the same time "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server(latency=args.latency)
+    owner = u'alice@' + server.DOMAIN
+    interval = (archive.PERIOD - 1200.0) / args.messages
+    start = time.time() - archive.PERIOD + 900
+
+    for index in range(args.conversations):
+        peer = _peer(index)
+
+        for number in range(args.messages):
+            loopback.archive_message(owner, peer, start + number * interval,
+                                     peer, owner, 'm%d-%d' % (index, number),
+                                     u'message %d' % number)
+
+    rows = []
+
+    for concurrency in args.concurrency:
+        directory = os.path.join(benchmarks.directory(), 'history')
+        first, finished, fetched = _catch_up(loopback, directory,
+                                             args.conversations, concurrency,
+                                             args.page_size)
+
+        if fetched != args.conversations * args.messages:
+            raise Exception("only %d of %d messages were fetched" %
+                            (fetched, args.conversations * args.messages))
+
+        rows += [("%d at a time, first message (s)" % concurrency, first),
+                 ("%d at a time, catch-up (s)" % concurrency, finished)]
+
+    loopback.close()
+    benchmarks.report("Catch-up of %d conversations, %d messages each, "
+                      "%d ms per answer" % (args.conversations, args.messages,
+                                            args.latency * 1000), rows)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Runs the application in batch mode, as shellber-cli --batch FILE does,
+with a file which logs in and sends messages to the loopback server. It
+reports the commands per second, from the start of the application until
+it quits, which includes the login and the logout, once every message was
+sent.
+"""
+
+import argparse
+import os
+import time
+
+import benchmarks
+from tests import server
+
+def config(directory, log_level='info'):
+    """
+    Writes a config file which keeps every file of the application inside
+    a directory.
+
+    :return Returns the config file name.
+    """
+    filename = os.path.join(directory, 'shellber.yml')
+
+    with open(filename, 'w') as f:
+        f.write("log_filename: %s\n" % os.path.join(directory, 'shellber.log'))
+        f.write("log_level: %s\n" % log_level)
+
+        for name in ('history', 'roster', 'download', 'spool'):
+            f.write("%s_directory: %s\n" % (name, os.path.join(directory,
+                                                               name)))
+
+    return filename
+
+
+
+def run(application):
+    """
+    Runs an application until it quits, as shellber-cli does.
+
+    :return Returns the application exit status.
+    """
+    while application.run():
+        cmd = application.wait_for_command()
+
+        if cmd is not None:
+            application.handle_command(cmd)
+
+    application.sync_configuration()
+
+    return application.finish()
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=20000,
+                        help="number of messages (default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    batch = os.path.join(directory, 'commands')
+
+    with open(batch, 'w') as f:
+        f.write("login alice secret %s bench\n" % server.DOMAIN)
+
+        for index in range(args.count):
+            f.write("msgto alert@%s message %d\n" % (server.SINK, index))
+
+    loopback = server.Server()
+    application = server.application_class(loopback)(argparse.Namespace(
+        config=config(directory), batch=batch, daemon=False, commands=None,
+        socket=None))
+
+    start = time.time()
+    status = run(application)
+    elapsed = time.time() - start
+
+    if status != 0:
+        raise Exception("some commands failed")
+
+    if loopback.wait_sunk(args.count) is False:
+        raise Exception("only %d of %d messages arrived" %
+                        (loopback.sunk, args.count))
+
+    loopback.close()
+    benchmarks.report("Batch of %d messages" % args.count, [
+        ("commands/s", (args.count + 1) / elapsed)])
+
+
+
+if __name__ == '__main__':
+    main()
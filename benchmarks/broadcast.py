@@ -0,0 +1,119 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Sends a message to several logged in recipients, comparing a broadcast,
+which fans the stanzas out at once, with sending them one at a time and
+waiting for each delivery receipt, until every recipient is reported. It
+also compares the time to queue a message to many recipients of the sink
+with one broadcast() call and with one message() call per recipient.
+"""
+
+import benchmarks
+from shellber.chat import broadcast
+from tests import server
+
+def _deliver(alice, message, recipients):
+    """
+    Broadcasts a message and waits for its report.
+
+    :return Returns the broadcast.Broadcast object.
+    """
+    reports = benchmarks.Counter()
+    alice._handle_broadcast = lambda tracker: reports.add()
+    tracker = alice.broadcast(message, recipients)
+
+    if reports.wait(1, timeout=60) is False:
+        raise Exception("the broadcast was never reported")
+
+    return tracker
+
+
+
+def _sequential(alice, recipients):
+    for recipient in recipients:
+        _deliver(alice, u'alert', [recipient])
+
+
+
+def _queue_messages(alice, recipients):
+    for recipient in recipients:
+        alice.message(u'alert', recipient)
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--recipients', type=int, default=50,
+                        help="logged in recipients (default: %(default)s)")
+    parser.add_argument('--sink', type=int, default=10000,
+                        help="recipients of the sink (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each case, the best one is reported "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server()
+    alice = benchmarks.login(loopback, 'alice')
+    users = ['user%d' % index for index in range(args.recipients)]
+    chats = []
+
+    try:
+        for user in users:
+            chats.append(benchmarks.login(loopback, user))
+
+        recipients = ['%s@%s/bench' % (user, server.DOMAIN) for user in users]
+        delivered = _deliver(alice, u'alert', recipients).count(
+            broadcast.DELIVERED)
+
+        if delivered != len(recipients):
+            raise Exception("only %d of %d recipients got the message" %
+                            (delivered, len(recipients)))
+
+        fan_out = benchmarks.best(args.repeat, _deliver, alice, u'alert',
+                                  recipients)
+        sequential = benchmarks.best(args.repeat, _sequential, alice,
+                                     recipients)
+
+        sink = ['user%d@%s' % (index, server.SINK)
+                for index in range(args.sink)]
+        loopback.sunk = 0
+        queued = benchmarks.timed(alice.broadcast, u'alert', sink)[0]
+        loopback.wait_sunk(args.sink)
+        loopback.sunk = 0
+        queued_messages = benchmarks.timed(_queue_messages, alice, sink)[0]
+        loopback.wait_sunk(args.sink)
+    finally:
+        for chat in chats + [alice]:
+            chat.logout()
+
+        loopback.close()
+
+    benchmarks.report("Message to %d recipients" % args.recipients, [
+        ("broadcast, all delivered (ms)", fan_out * 1000),
+        ("one at a time, all delivered (ms)", sequential * 1000),
+        ("speedup", sequential / fan_out)])
+    benchmarks.report("Message queued to %d recipients" % args.sink, [
+        ("broadcast() (ms)", queued * 1000),
+        ("message() per recipient (ms)", queued_messages * 1000),
+        ("speedup", queued_messages / queued)])
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Completes the contacts of the msgto command with rosters of several sizes.
+It reports the time to build the prefix tree, which the first completion
+after a change of the roster contacts pays, and the latency of the next
+completions, as readline calls the completer, for a prefix of a single
+character, which matches as many contacts as completed at once, and for
+one which matches a single contact. A scan of every roster JID, which
+completes the contacts with a linear cost, is shown for comparison.
+"""
+
+import os
+
+import benchmarks
+from shellber.chat import roster
+from shellber.ui import commands
+from shellber.ui import input
+
+def _roster(directory, count):
+    contacts = roster.Roster(os.path.join(directory, '%d.roster' % count),
+                             'alice@localhost')
+
+    for index in range(count):
+        contacts.save('alice@localhost', 'user%d@localhost' % index,
+                      {'name': 'User %d' % index, 'groups': []}, None)
+
+    return contacts
+
+
+
+def _complete(completer, text):
+    """
+    Calls the completer as readline does, until it has no more matches.
+    """
+    state = 0
+
+    while completer.complete(text, state) is not None:
+        state += 1
+
+
+
+def _scan(jids, text):
+    return sorted(jid for jid in jids if jid.startswith(text))[
+        :input.COMPLETION_LIMIT]
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 50000],
+                        help="roster sizes (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=100,
+                        help="completions of each prefix, the best one is "
+                        "reported (default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    rows = []
+
+    for size in args.sizes:
+        contacts = _roster(directory, size)
+        completer = input._Completer(commands.UserCommands(),
+                                     lambda: 'msgto ', lambda: contacts)
+        jids = contacts.jids()
+        last = 'user%d@' % (size - 1)
+
+        rows.append(("%d contacts, tree build (ms)" % size,
+                     benchmarks.timed(_complete, completer, last)[0] * 1000))
+
+        for name, prefix in (("'u'", 'u'), ("'%s'" % last, last)):
+            rows += [("%d contacts, %s, tree (us)" % (size, name),
+                      benchmarks.best(args.repeat, _complete, completer,
+                                      prefix) * 1e6),
+                     ("%d contacts, %s, scan (us)" % (size, name),
+                      benchmarks.best(args.repeat / 10 or 1, _scan, jids,
+                                      prefix) * 1e6)]
+
+    benchmarks.report("Completion of the msgto contacts", rows)
+
+
+
+if __name__ == '__main__':
+    main()
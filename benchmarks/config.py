@@ -0,0 +1,164 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Loads config files with several accounts, each one with a snapshot of its
+roster, comparing config.load(), which reads the cached configuration, with
+the previous path, which parsed the file with yaml.load() and the pure
+Python loader at every start. It also makes a burst of changes through a
+config.Store, reporting the time of each set() and the number of writes.
+"""
+
+import os
+import time
+
+import yaml
+
+import benchmarks
+from shellber.app import config
+
+def generate(accounts, contacts):
+    """
+    Creates a configuration with @accounts accounts of @contacts contacts
+    each.
+
+    :return Returns the configuration, as a dict.
+    """
+    cfg = dict(log_filename='shellber.log', log_level='info', accounts={})
+
+    for index in range(accounts):
+        server = u'server%d.example.com' % index
+        roster = [dict(jid=u'contact%d@%s' % (number, server),
+                       name=u'Contact %d' % number,
+                       groups=[u'Group %d' % (number % 10)],
+                       subscription=u'both')
+                  for number in range(contacts)]
+
+        cfg['accounts'][u'account%d' % index] = dict(
+            username=u'user%d' % index, password=u'secret', server=server,
+            host=server, roster=roster)
+
+    return cfg
+
+
+
+def write(filename, cfg):
+    """
+    Writes a configuration into a config file, without its cache.
+    """
+    with open(filename, 'wb') as f:
+        yaml.dump(cfg, f, Dumper=config._Dumper, default_flow_style=False,
+                  allow_unicode=True, encoding='utf-8')
+
+
+
+def _yaml_load(filename):
+    with open(filename, 'rb') as f:
+        return yaml.load(f.read(), Loader=yaml.Loader)
+
+
+
+def _burst(directory, count):
+    """
+    Changes a configuration @count times in a row through a config.Store.
+
+    :return Returns the mean time of set(), in microseconds, the number of
+            writes and the time from the last change until it was written,
+            in seconds.
+    """
+    cfg = config.load(os.path.join(directory, 'burst.yml'))
+    cfg.filename = os.path.join(directory, 'burst.yml')
+    writes = []
+    save = config._save
+
+    def counted(filename, data):
+        save(filename, data)
+        writes.append(time.time())
+
+    config._save = counted
+
+    try:
+        store = config.Store(cfg)
+        start = time.time()
+
+        for index in range(count):
+            store.set('account', 'resource', 'resource%d' % index)
+
+        spent = time.time() - start
+        written = time.time()
+
+        while not writes and time.time() - written < 10 * config.SAVE_DELAY:
+            time.sleep(0.01)
+
+        time.sleep(2 * config.SAVE_DELAY)
+        store.close()
+    finally:
+        config._save = save
+
+    if not writes:
+        raise Exception("the configuration was never written")
+
+    return spent * 1e6 / count, len(writes), writes[0] - (start + spent)
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['5x10', '50x200'],
+                        help="configurations to load, as ACCOUNTSxCONTACTS "
+                        "(default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="loads of each configuration, the best one is "
+                        "reported (default: %(default)s)")
+    parser.add_argument('--changes', type=int, default=1000,
+                        help="set() calls of the burst (default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    rows = []
+
+    for size in args.sizes:
+        accounts, contacts = [int(n) for n in size.split('x')]
+        filename = os.path.join(directory, 'shellber-%s.yml' % size)
+        write(filename, generate(accounts, contacts))
+
+        # The first load parses the file and caches it
+        config.load(filename)
+
+        if os.path.exists(filename + config.CACHE_SUFFIX) is False:
+            raise Exception("%s wasn't cached" % filename)
+
+        parsed = benchmarks.best(args.repeat, _yaml_load, filename)
+        cached = benchmarks.best(args.repeat, config.load, filename)
+        name = "%s, %d KB" % (size, os.path.getsize(filename) / 1024)
+
+        rows += [("%s, yaml.load (ms)" % name, parsed * 1000),
+                 ("%s, config.load (ms)" % name, cached * 1000),
+                 ("%s, speedup" % name, parsed / cached)]
+
+    mean, writes, delay = _burst(directory, args.changes)
+    rows += [("%d set() calls, mean (us)" % args.changes, mean),
+             ("%d set() calls, writes" % args.changes, writes),
+             ("last set() to write (s)", delay)]
+
+    benchmarks.report("Loading and changing a configuration", rows)
+
+
+
+if __name__ == '__main__':
+    main()
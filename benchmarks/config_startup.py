@@ -0,0 +1,155 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Starts the application with config files of several sizes. For each one it
+reports the time to parse the file with the pure Python YAML loader, as
+the application did before, and with the one config.load() uses, libyaml
+when PyYAML is built with it, the time of config.load() with a valid
+cache, and the wall time of shellber-cli --batch /dev/null without the
+cache and with it.
+"""
+
+import os
+import subprocess
+import sys
+
+import yaml
+
+import benchmarks
+from benchmarks.config import generate, write
+from shellber.app import config
+
+# Accounts of the generated configurations, their contacts grow with the
+# size
+ACCOUNTS = 10
+
+def _size(text):
+    """
+    Parses a size such as 512, 1K or 10M into bytes.
+    """
+    units = dict(K=1024, M=1024 * 1024)
+
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+
+    return int(text)
+
+
+
+def _fill(filename, directory, size):
+    """
+    Writes a config file of about @size bytes, which keeps the files of the
+    application inside @directory.
+    """
+    sample = os.path.join(directory, 'sample.yml')
+    write(sample, generate(ACCOUNTS, 100))
+    per_contact = os.path.getsize(sample) / (ACCOUNTS * 100.0)
+    os.unlink(sample)
+
+    cfg = generate(ACCOUNTS, max(0, int(size / per_contact / ACCOUNTS) - 1))
+    cfg['log_filename'] = os.path.join(directory, 'shellber.log')
+
+    for name in ('history', 'roster', 'download', 'spool'):
+        cfg['%s_directory' % name] = os.path.join(directory, name)
+
+    write(filename, cfg)
+
+
+
+def _parse(filename, loader):
+    with open(filename, 'rb') as f:
+        return yaml.load(f.read(), Loader=loader)
+
+
+
+def _cold_load(filename):
+    if os.path.exists(filename + config.CACHE_SUFFIX):
+        os.unlink(filename + config.CACHE_SUFFIX)
+
+    return config.load(filename)
+
+
+
+def _startup(filename, cached):
+    """
+    Runs shellber-cli with a config file and no commands.
+
+    :param cached: Indicates if the config cache is kept.
+
+    :return Returns the wall time, in seconds.
+    """
+    if cached is False and os.path.exists(filename + config.CACHE_SUFFIX):
+        os.unlink(filename + config.CACHE_SUFFIX)
+
+    with open(os.devnull, 'w') as null:
+        elapsed, status = benchmarks.timed(
+            subprocess.call, [sys.executable, 'shellber-cli', '--config',
+                              filename, '--batch', os.devnull],
+            stdout=null, stderr=null)
+
+    if status != 0:
+        raise Exception("shellber-cli failed with %s" % filename)
+
+    return elapsed
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['1K', '1M', '10M'],
+                        help="config file sizes (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each case, the best one is reported; "
+                        "the pure Python loader runs once (default: "
+                        "%(default)s)")
+    args = parser.parse_args()
+
+    loader = config._Loader.__bases__[0].__name__
+    rows = []
+
+    for text in args.sizes:
+        directory = benchmarks.directory()
+        filename = os.path.join(directory, 'shellber.yml')
+        _fill(filename, directory, _size(text))
+        name = "%d KB" % (os.path.getsize(filename) / 1024)
+
+        pure = benchmarks.timed(_parse, filename, yaml.SafeLoader)[0]
+        parsed = benchmarks.best(args.repeat, _parse, filename,
+                                 config._Loader)
+        cold = benchmarks.best(args.repeat, _cold_load, filename)
+        cached = benchmarks.best(args.repeat, config.load, filename)
+        startup_cold = min(_startup(filename, False)
+                           for _ in range(args.repeat))
+        startup_cached = min(_startup(filename, True)
+                             for _ in range(args.repeat))
+
+        rows += [("%s, pure Python parse (ms)" % name, pure * 1000),
+                 ("%s, %s parse (ms)" % (name, loader), parsed * 1000),
+                 ("%s, load, building the cache (ms)" % name, cold * 1000),
+                 ("%s, load, cache hit (ms)" % name, cached * 1000),
+                 ("%s, startup, no cache (ms)" % name, startup_cold * 1000),
+                 ("%s, startup, cached (ms)" % name, startup_cached * 1000)]
+
+    benchmarks.report("Startup with config files of %s bytes" %
+                      ', '.join(args.sizes), rows)
+
+
+
+if __name__ == '__main__':
+    main()
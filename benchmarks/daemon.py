@@ -0,0 +1,152 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Sends single messages to the loopback server, comparing a cold run of the
+application in batch mode, which loads the config, logs in, sends and logs
+out, with messages routed through the control socket of a logged in
+daemon, by shellber-cli -c and by a client which only writes the request
+frame and reads the reply. It reports the median and the longest times of
+each way.
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import benchmarks
+from benchmarks.batch import config, run
+from shellber.app import control
+from tests import server
+
+class _Remote(object):
+    """
+    The loopback server of the benchmark process, as seen by a cold run.
+    """
+    def __init__(self, port):
+        self.address = ('127.0.0.1', port)
+
+
+
+def _cold(port, batch, directory):
+    """
+    Runs the application in batch mode, connected to the loopback server of
+    the parent process.
+    """
+    application = server.application_class(_Remote(port))(argparse.Namespace(
+        config=config(directory), batch=batch, daemon=False, commands=None,
+        socket=None))
+
+    return run(application)
+
+
+
+def _times(count, function, *args):
+    times = sorted(benchmarks.timed(function, *args)[0] * 1000
+                   for _ in range(count))
+
+    return times[len(times) / 2], times[-1]
+
+
+
+def _call(command):
+    with open(os.devnull, 'w') as null:
+        if subprocess.call(command, stdout=null) != 0:
+            raise Exception("command failed: " + ' '.join(command))
+
+
+
+def _request(path, line):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+        control.write_frame(sock, line)
+        reply = control.read_frame(sock)
+    finally:
+        sock.close()
+
+    if reply is None or reply[:1] != control.STATUS_OK:
+        raise Exception("command failed: " + line)
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--cold-runs', type=int, default=20,
+                        help="cold runs and shellber-cli -c calls "
+                        "(default: %(default)s)")
+    parser.add_argument('--requests', type=int, default=1000,
+                        help="requests written to the control socket "
+                        "(default: %(default)s)")
+    parser.add_argument('--cold', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold is not None:
+        return _cold(int(args.cold[0]), args.cold[1], args.cold[2])
+
+    directory = benchmarks.directory()
+    message = "msgto alert@%s hello" % server.SINK
+    batch = os.path.join(directory, 'commands')
+
+    with open(batch, 'w') as f:
+        f.write("login bob secret %s bench\n%s\n" % (server.DOMAIN, message))
+
+    for name in ('cold', 'daemon'):
+        os.mkdir(os.path.join(directory, name))
+
+    loopback = server.Server()
+    cold = _times(args.cold_runs, _call,
+                  [sys.executable, '-m', 'benchmarks.daemon', '--cold',
+                   str(loopback.address[1]), batch,
+                   os.path.join(directory, 'cold')])
+
+    path = os.path.join(directory, 'control')
+    daemon = server.application_class(loopback)(argparse.Namespace(
+        config=config(os.path.join(directory, 'daemon')), batch=None,
+        daemon=True, commands=None, socket=path))
+    thread = threading.Thread(target=run, args=(daemon,))
+    thread.start()
+
+    try:
+        _request(path, "login alice secret %s bench" % server.DOMAIN)
+        cli = _times(args.cold_runs, _call,
+                     [sys.executable, 'shellber-cli', '-S', path, '-c',
+                      message])
+        frames = _times(args.requests, _request, path, message)
+    finally:
+        _request(path, "quit app")
+        thread.join()
+
+    loopback.close()
+    benchmarks.report("Single message sends", [
+        ("cold run, median (ms)", cold[0]),
+        ("cold run, max (ms)", cold[1]),
+        ("daemon, shellber-cli -c, median (ms)", cli[0]),
+        ("daemon, shellber-cli -c, max (ms)", cli[1]),
+        ("daemon, request frame, median (ms)", frames[0]),
+        ("daemon, request frame, max (ms)", frames[1]),
+        ("speedup, shellber-cli -c", cold[0] / cli[0])])
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
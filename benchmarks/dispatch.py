@@ -0,0 +1,85 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Reads, parses, validates and dispatches commands in batch mode, with the
+handlers of the application replaced by one which does nothing, so only
+the overhead of each command is measured. It reports the time per command
+for a few kinds of command lines.
+"""
+
+import argparse
+import os
+from cStringIO import StringIO
+
+import benchmarks
+from benchmarks.batch import config
+from shellber.app import core
+
+# The command lines, by name
+LINES = [("msgto, 200 characters", "msgto bob@jabber.com " + "x" * 200),
+         ("contact add", "contact add bob@jabber.com"),
+         ("presence away", "presence away out for lunch")]
+
+def _dispatch(application, count):
+    """
+    Handles the commands of the batch input, as shellber-cli does.
+    """
+    for _ in range(count):
+        application.handle_command(application.wait_for_command())
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=100000,
+                        help="commands of each kind (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each kind, the best one is reported "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    empty = os.path.join(directory, 'empty')
+    open(empty, 'w').close()
+
+    application = core.Application(argparse.Namespace(
+        config=config(directory), batch=empty, daemon=False, commands=None,
+        socket=None))
+    application._actions = dict.fromkeys(application._actions,
+                                         lambda cmd: None)
+    rows = []
+
+    for name, line in LINES:
+        def run():
+            application._input._stream = StringIO((line + '\n') * args.count)
+            _dispatch(application, args.count)
+
+        elapsed = benchmarks.best(args.repeat, run)
+        rows.append(("%s (us/command)" % name, elapsed * 1e6 / args.count))
+
+    if application._failed_commands:
+        raise Exception("%d commands failed" % application._failed_commands)
+
+    application.sync_configuration()
+    benchmarks.report("Dispatch of %d commands" % args.count, rows)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Joins groups of the loopback server. It reports the time to join a large
+group with a long history, of which only the last messages are sent, the
+time to handle its occupants leaving and coming back, and the time to join
+many groups at login, which are joined all at once when the session starts.
+"""
+
+import time
+
+import benchmarks
+from shellber.chat import muc
+from tests import server
+
+def _joined(notifications, count):
+    return len([n for n in notifications if n.startswith("Joined ")]) >= count
+
+
+
+def _large_room(loopback, occupants, history):
+    """
+    Joins a room with @occupants occupants and @history old messages, then
+    has every occupant leave and come back.
+
+    :return Returns the report rows.
+    """
+    room = loopback.add_room('large', occupants, history)
+    notifications = []
+    received = benchmarks.Counter()
+    alice = benchmarks.login(loopback, 'alice',
+                             lambda sender, body: received.add(),
+                             handle_notification=notifications.append)
+
+    try:
+        start = time.time()
+        alice.group_join(room.jid)
+
+        if server.wait(lambda: _joined(notifications, 1), timeout=120) \
+                is False:
+            raise Exception("unable to join " + room.jid)
+
+        join = time.time() - start
+        received.wait(min(history, muc.HISTORY_STANZAS), timeout=10)
+        table = alice._rooms[room.jid]
+
+        # The occupants leave, then come back
+        start = time.time()
+        nicks = [u'user%d' % index for index in range(occupants)]
+        loopback.push(alice.ID, u''.join(
+            loopback._occupant(room, nick, alice.ID, kind='unavailable')
+            for nick in nicks))
+
+        if server.wait(lambda: len(table) == 1, timeout=120) is False:
+            raise Exception("the occupants never left")
+
+        loopback.push(alice.ID, u''.join(
+            loopback._occupant(room, nick, alice.ID) for nick in nicks))
+
+        if server.wait(lambda: len(table) == occupants + 1, timeout=120) \
+                is False:
+            raise Exception("the occupants never came back")
+
+        churn = time.time() - start
+    finally:
+        alice.logout()
+
+    return [("join (ms)", join * 1000),
+            ("old messages received", received.value),
+            ("occupant presences/s", occupants * 2 / churn)]
+
+
+
+def _many_rooms(loopback, rooms, occupants):
+    """
+    Joins @rooms rooms with @occupants occupants each at login.
+
+    :return Returns the elapsed time, in seconds.
+    """
+    jids = [loopback.add_room('room%d' % index, occupants).jid
+            for index in range(rooms)]
+    notifications = []
+    alice = server.chat_class(loopback)(
+        lambda *args: None, notifications.append)
+
+    start = time.time()
+    alice.login(['alice', 'secret', server.DOMAIN, 'bench'])
+
+    try:
+        for jid in jids:
+            alice.group_join(jid)
+
+        if server.wait(lambda: _joined(notifications, rooms), timeout=120) \
+                is False:
+            raise Exception("unable to join every room")
+
+        return time.time() - start
+    finally:
+        alice.logout()
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--occupants', type=int, default=5000,
+                        help="occupants of the large group "
+                        "(default: %(default)s)")
+    parser.add_argument('--history', type=int, default=10000,
+                        help="old messages of the large group "
+                        "(default: %(default)s)")
+    parser.add_argument('--rooms', type=int, default=100,
+                        help="groups joined at login (default: %(default)s)")
+    parser.add_argument('--room-occupants', type=int, default=50,
+                        help="occupants of each group joined at login "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server()
+    benchmarks.report("Group of %d occupants, %d old messages" %
+                      (args.occupants, args.history),
+                      _large_room(loopback, args.occupants, args.history))
+    benchmarks.report("%d groups of %d occupants" %
+                      (args.rooms, args.room_occupants), [
+                          ("login and join (ms)",
+                           _many_rooms(loopback, args.rooms,
+                                       args.room_occupants) * 1000)])
+    loopback.close()
+
+
+
+if __name__ == '__main__':
+    main()
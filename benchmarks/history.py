@@ -0,0 +1,164 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Fills a message history and looks conversations up in it. It reports the
+time spent in append(), which only queues the message, the rate at which
+the messages are written, and the latency of the lookups of the last page
+of a conversation and of a page from a given time.
+"""
+
+import os
+import random
+import time
+
+import benchmarks
+from shellber.chat import history
+
+# The words of the generated messages. Each one is ten times less frequent
+# than the previous one, see body().
+WORDS = [['ok', 'yes', 'the', 'and', 'is'],
+         ['deploy', 'server', 'meeting', 'build', 'lunch'],
+         ['outage', 'rollback', 'database', 'release', 'invoice'],
+         ['kernel', 'firmware', 'datacenter', 'migration', 'audit']]
+
+# Time, in seconds, between two messages of the generated history
+INTERVAL = 1.0
+
+def body(rand):
+    """
+    Generates a message of a few words, the rare ones less often.
+    """
+    words = []
+
+    for _ in range(rand.randint(3, 12)):
+        level = 0
+
+        while level < len(WORDS) - 1 and rand.random() < 0.1:
+            level += 1
+
+        words.append(rand.choice(WORDS[level]))
+
+    return ' '.join(words)
+
+
+
+def peer(index):
+    return 'user%d@localhost' % index
+
+
+
+def fill(store, count, peers, start):
+    """
+    Appends messages to a history, spread over @peers conversations, one
+    every INTERVAL seconds from @start on.
+
+    :return Returns the time spent in append() and the longest call, in
+            seconds.
+    """
+    rand = random.Random(0)
+    spent = 0.0
+    longest = 0.0
+
+    for index in range(count):
+        jid = peer(rand.randrange(peers))
+        direction = rand.choice((history.INCOMING, history.OUTGOING))
+        text = body(rand)
+        before = time.time()
+        store.append(jid, direction, jid, text, start + index * INTERVAL)
+        call = time.time() - before
+        spent += call
+        longest = max(longest, call)
+
+    return spent, longest
+
+
+
+def lookups(store, count, peers, start, end, limit):
+    """
+    Looks up random conversations.
+
+    :return Returns the median and the longest times of the lookups of the
+            last @limit messages and of @limit messages from a random time,
+            in milliseconds.
+    """
+    rand = random.Random(1)
+    last = []
+    since = []
+
+    for _ in range(count):
+        jid = peer(rand.randrange(peers))
+        elapsed, messages = benchmarks.timed(
+            lambda: list(store.lookup(jid, limit=limit)))
+        last.append(elapsed * 1000)
+
+        timestamp = rand.uniform(start, end)
+        elapsed, messages = benchmarks.timed(
+            lambda: list(store.lookup(jid, since=timestamp, limit=limit)))
+        since.append(elapsed * 1000)
+
+    last.sort()
+    since.sort()
+
+    return last[len(last) / 2], last[-1], since[len(since) / 2], since[-1]
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=10000000,
+                        help="number of messages (default: %(default)s)")
+    parser.add_argument('--peers', type=int, default=1000,
+                        help="number of conversations (default: %(default)s)")
+    parser.add_argument('--lookups', type=int, default=200,
+                        help="number of lookups (default: %(default)s)")
+    parser.add_argument('--limit', type=int, default=50,
+                        help="messages per lookup (default: %(default)s)")
+    args = parser.parse_args()
+
+    filename = os.path.join(benchmarks.directory(), 'history.db')
+    store = history.History(filename)
+    start = time.time() - args.count * INTERVAL
+
+    before = time.time()
+    spent, longest = fill(store, args.count, args.peers, start)
+    store.flush()
+    written = time.time() - before
+
+    median_last, max_last, median_since, max_since = lookups(
+        store, args.lookups, args.peers, start, time.time(), args.limit)
+    store.close()
+
+    benchmarks.report("History of %d messages in %d conversations" %
+                      (args.count, args.peers), [
+                          ("append() mean (us)", spent * 1e6 / args.count),
+                          ("append() max (ms)", longest * 1000),
+                          ("written messages/s", args.count / written),
+                          ("database size (MB)",
+                           benchmarks.file_size(filename)),
+                          ("last %d, median (ms)" % args.limit, median_last),
+                          ("last %d, max (ms)" % args.limit, max_last),
+                          ("%d since a time, median (ms)" % args.limit,
+                           median_since),
+                          ("%d since a time, max (ms)" % args.limit,
+                           max_since)])
+
+
+
+if __name__ == '__main__':
+    main()
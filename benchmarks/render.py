@@ -0,0 +1,98 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Renders received messages with the compiled templates of ui.output.Output,
+comparing them with the previous path, which substituted the tokens and
+the colors with string.Template and stripped the plain form with a regular
+expression for every message.
+"""
+
+import re
+from string import Template
+
+import benchmarks
+from shellber.ui import output
+
+# A received message, as displayed by the application
+TEMPLATE = "[${FG_MAGENTA}%s${FG_RESET}] %s"
+
+def _template_path(out, message):
+    """
+    Renders a message in the way Output did before the templates were
+    compiled.
+    """
+    tokens = Template(message).safe_substitute(out._tokens)
+    colored = Template(tokens).safe_substitute(out._colors)
+    plain = re.sub(r'\$\{[a-zA-Z0-9_]*\}', '', message)
+
+    return colored, plain
+
+
+
+def _run_template_path(out, messages):
+    for sender, body in messages:
+        _template_path(out, TEMPLATE % (sender, body))
+
+
+
+def _run_compiled(out, messages):
+    for sender, body in messages:
+        out._render(TEMPLATE, (sender, body))
+
+
+
+def _run_uncached(out, templates):
+    for template in templates:
+        out._render(template, ())
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=100000,
+                        help="number of messages (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each path, the best one is reported "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    out = output.Output()
+    messages = [('user%d@localhost' % (index % 50),
+                 'message number %d with some text' % index)
+                for index in range(args.count)]
+
+    # Messages with the data formatted into the template never hit the
+    # cache, which is the worst case of the compiled path.
+    templates = [TEMPLATE % message for message in messages]
+
+    template_path = benchmarks.best(args.repeat, _run_template_path, out,
+                                    messages)
+    compiled = benchmarks.best(args.repeat, _run_compiled, out, messages)
+    uncached = benchmarks.best(args.repeat, _run_uncached, out, templates)
+
+    benchmarks.report("Rendering %d messages" % args.count, [
+        ("string.Template (us/message)", template_path * 1e6 / args.count),
+        ("compiled, cached (us/message)", compiled * 1e6 / args.count),
+        ("compiled, uncached (us/message)", uncached * 1e6 / args.count),
+        ("speedup, cached", template_path / compiled)])
+
+
+
+if __name__ == '__main__':
+    main()
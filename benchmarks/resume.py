@@ -0,0 +1,123 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Breaks the connection of a session right after a burst of messages, as a
+network failure would, and lets it come back: by resuming its stream
+(XEP-0198), or by a new login when the server refuses to resume it. It
+reports the median time from the drop until the session is back, and
+until every message of the burst reached the server, and the lost or
+repeated messages.
+
+The reconnection delay is set to zero, so the random backoff doesn't hide
+the difference.
+"""
+
+import time
+
+import benchmarks
+from shellber.chat import chat
+from tests import server
+
+def _median(values):
+    values = sorted(values)
+
+    return values[len(values) / 2]
+
+
+
+def _drops(loopback, count, burst, resumption):
+    """
+    Drops a session @count times, each one after a burst of messages.
+
+    :return Returns the report rows.
+    """
+    loopback.resumption = resumption
+    loopback.sunk = 0
+    loopback.sunk_bodies = []
+    notifications = []
+    alice = benchmarks.login(loopback, 'alice',
+                             handle_notification=notifications.append)
+    back = "Session resumed" if resumption else "Session started"
+    sessions, delivered = [], []
+
+    try:
+        for index in range(count):
+            before = len([n for n in notifications if n.startswith(back)])
+            sunk = loopback.sunk
+
+            for number in range(burst):
+                alice.message(u'message %d-%d' % (index, number),
+                              'alert@' + server.SINK)
+
+            start = time.time()
+            loopback.drop('alice')
+
+            if server.wait(lambda: len([n for n in notifications
+                                        if n.startswith(back)]) > before,
+                           timeout=30) is False:
+                raise Exception("the session didn't come back")
+
+            sessions.append(time.time() - start)
+
+            if loopback.wait_sunk(sunk + burst) is False:
+                raise Exception("only %d of %d messages arrived" %
+                                (loopback.sunk - sunk, burst))
+
+            delivered.append(time.time() - start)
+    finally:
+        alice.logout()
+
+    bodies = loopback.sunk_bodies
+
+    return [("session back, median (ms)", _median(sessions) * 1000),
+            ("messages delivered, median (ms)", _median(delivered) * 1000),
+            ("lost messages", count * burst - len(set(bodies))),
+            ("repeated messages", len(bodies) - len(set(bodies)))]
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--drops', type=int, default=20,
+                        help="dropped connections (default: %(default)s)")
+    parser.add_argument('--burst', type=int, default=200,
+                        help="messages sent before each drop "
+                        "(default: %(default)s)")
+    parser.add_argument('--contacts', type=int, default=1000,
+                        help="contacts of the roster (default: %(default)s)")
+    args = parser.parse_args()
+
+    chat.RECONNECT_DELAY = 0
+    loopback = server.Server()
+
+    for index in range(args.contacts):
+        loopback.add_contact('alice', 'contact%d@localhost' % index)
+
+    for title, resumption in (("Resumed stream", True),
+                              ("New login", False)):
+        benchmarks.report("%s, %d drops" % (title, args.drops),
+                          _drops(loopback, args.drops, args.burst,
+                                 resumption))
+
+    loopback.close()
+
+
+
+if __name__ == '__main__':
+    main()
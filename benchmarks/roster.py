@@ -0,0 +1,99 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Logs in with a large roster, measuring the time until the local copy of
+the roster is up to date: at the first login, which downloads the whole
+roster, and at the next ones, which only get the changes made since the
+cached roster version (XEP-0237), if any.
+"""
+
+import time
+
+import benchmarks
+from tests import server
+
+def _login(loopback, directory, count, name):
+    """
+    Logs in and waits for the roster.
+
+    :param count: The number of contacts.
+    :param name: The name of the last contact, which tells that the roster
+                 is up to date.
+
+    :return Returns the elapsed time, in seconds.
+    """
+    start = time.time()
+    alice = benchmarks.login(loopback, 'alice', roster_directory=directory)
+    last = 'contact%d@localhost' % (count - 1)
+
+    # The roster version is saved before its contacts
+    def updated():
+        contacts = alice.roster().contacts(pattern=last)
+
+        return len(alice.roster().jids()) == count and contacts and \
+                contacts[0][1].name == name
+
+    try:
+        if server.wait(updated, timeout=600) is False:
+            raise Exception("the roster wasn't updated")
+
+        return time.time() - start
+    finally:
+        alice.logout()
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--contacts', type=int, default=10000,
+                        help="number of contacts (default: %(default)s)")
+    parser.add_argument('--changes', type=int, default=10,
+                        help="contacts changed between the logins "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server()
+
+    for index in range(args.contacts):
+        loopback.add_contact('alice', 'contact%d@localhost' % index,
+                             'Contact %d' % index)
+
+    directory = benchmarks.directory()
+    last = args.contacts - 1
+    full = _login(loopback, directory, args.contacts, 'Contact %d' % last)
+    unchanged = _login(loopback, directory, args.contacts,
+                       'Contact %d' % last)
+
+    for index in range(args.contacts - args.changes, args.contacts):
+        loopback.add_contact('alice', 'contact%d@localhost' % index,
+                             'Renamed %d' % index)
+
+    delta = _login(loopback, directory, args.contacts, 'Renamed %d' % last)
+    loopback.close()
+
+    benchmarks.report("Login with %d contacts" % args.contacts, [
+        ("whole roster (s)", full),
+        ("cached, no changes (s)", unchanged),
+        ("cached, %d changes (s)" % args.changes, delta),
+        ("speedup, %d changes" % args.changes, full / delta)])
+
+
+
+if __name__ == '__main__':
+    main()
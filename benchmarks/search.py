@@ -0,0 +1,93 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Searches a message history through its full-text index. It reports the
+rate at which messages are written and indexed as they arrive, the rate
+of a full rebuild of the index, as made for a history from an older
+version, and the latency of searches for common and rare terms, with and
+without the conversation and date filters.
+"""
+
+import os
+import sqlite3
+import time
+
+import benchmarks
+from benchmarks.history import INTERVAL, WORDS, fill, peer
+from shellber.chat import history
+
+def _queries(count, start):
+    """
+    Gets the searches to run, as (name, terms, peer, since) tuples.
+    """
+    since = start + count * INTERVAL * 0.9
+
+    return [("common term", WORDS[0][0], None, None),
+            ("uncommon term", WORDS[1][0], None, None),
+            ("rare term", WORDS[3][0], None, None),
+            ("two terms", '%s %s' % (WORDS[1][1], WORDS[2][1]), None, None),
+            ("rare term, one peer", WORDS[3][0], peer(0), None),
+            ("rare term, last 10%", WORDS[3][0], None, since),
+            ("missing term", 'nonexistent', None, None)]
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=10000000,
+                        help="number of messages (default: %(default)s)")
+    parser.add_argument('--peers', type=int, default=1000,
+                        help="number of conversations (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each search, the best one is reported "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    filename = os.path.join(benchmarks.directory(), 'history.db')
+    store = history.History(filename)
+    start = time.time() - args.count * INTERVAL
+
+    written = benchmarks.timed(fill, store, args.count, args.peers, start)[0]
+    written += benchmarks.timed(store.flush)[0]
+
+    rows = [("written and indexed messages/s", args.count / written)]
+
+    for name, terms, jid, since in _queries(args.count, start):
+        elapsed = benchmarks.best(args.repeat, store.search, terms, peer=jid,
+                                  since=since)
+        rows.append(("%s (ms)" % name, elapsed * 1000))
+
+    store.close()
+
+    connection = sqlite3.connect(filename)
+    rebuild = benchmarks.timed(
+        connection.execute, 'INSERT INTO messages_index (messages_index) '
+        'VALUES (\'rebuild\')')[0]
+    connection.commit()
+    connection.close()
+
+    rows.insert(1, ("rebuilt messages/s", args.count / rebuild))
+    rows.insert(2, ("database size (MB)", benchmarks.file_size(filename)))
+    benchmarks.report("Search of %d messages in %d conversations" %
+                      (args.count, args.peers), rows)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Sends a burst of messages, comparing the coalesced socket writes of the
+send queue with one write per stanza, which is what a batch size of a
+single byte gives. It reports the messages per second, the number of
+socket writes and the time spent in each message() call.
+"""
+
+import time
+
+import benchmarks
+from shellber.chat import chat
+from tests import server
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+
+def _burst(loopback, count, batch_size):
+    """
+    Sends @count messages to the sink of the loopback server.
+
+    :return Returns the report rows.
+    """
+    chat.SEND_BATCH_SIZE = batch_size
+    loopback.sunk = 0
+    alice = benchmarks.login(loopback, 'alice')
+    sock = alice._xmpp.socket
+    send = sock.send
+    writes = [0]
+
+    def counted(data, *args):
+        writes[0] += 1
+        return send(data, *args)
+
+    sock.send = counted
+    latencies = []
+    start = time.time()
+
+    for index in range(count):
+        before = time.time()
+        alice.message(u'message %d' % index, 'alert@' + server.SINK)
+        latencies.append(time.time() - before)
+
+    if loopback.wait_sunk(count) is False:
+        raise Exception("only %d of %d messages arrived" %
+                        (loopback.sunk, count))
+
+    elapsed = time.time() - start
+    alice.logout()
+    latencies.sort()
+
+    return [("messages/s", count / elapsed),
+            ("socket writes", writes[0]),
+            ("message() p50 (ms)", _percentile(latencies, 0.5) * 1000),
+            ("message() p99 (ms)", _percentile(latencies, 0.99) * 1000),
+            ("message() max (ms)", latencies[-1] * 1000)]
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=20000,
+                        help="number of messages (default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server()
+
+    for title, batch_size in (("One write per stanza", 1),
+                              ("Coalesced writes", chat.SEND_BATCH_SIZE)):
+        benchmarks.report("%s, %d messages" % (title, args.count),
+                          _burst(loopback, args.count, batch_size))
+
+    loopback.close()
+
+
+
+if __name__ == '__main__':
+    main()
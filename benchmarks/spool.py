@@ -0,0 +1,80 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Spools messages, as a session does while it's down, and replays them to
+the loopback server at the next login. It reports the rate at which the
+messages are appended and written to the spool, its file size, and the
+time from the login until every message reached the server, which
+includes opening the spool again.
+"""
+
+import os
+import time
+
+import benchmarks
+from shellber.chat import spool
+from tests import server
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=1000000,
+                        help="number of messages (default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    filename = os.path.join(directory, 'alice@%s.spool' % server.DOMAIN)
+    messages = spool.Spool(filename)
+
+    start = time.time()
+
+    for index in range(args.count):
+        messages.append('alert@' + server.SINK, 'message %d' % index)
+
+    appended = time.time() - start
+    messages.flush()
+    written = time.time() - start
+    size = benchmarks.file_size(filename)
+    messages.close()
+
+    loopback = server.Server()
+    start = time.time()
+    alice = benchmarks.login(loopback, 'alice', spool_directory=directory)
+
+    try:
+        if loopback.wait_sunk(args.count, timeout=3600) is False:
+            raise Exception("only %d of %d messages arrived" %
+                            (loopback.sunk, args.count))
+
+        replayed = time.time() - start
+    finally:
+        alice.logout()
+        loopback.close()
+
+    benchmarks.report("Spool of %d messages" % args.count, [
+        ("appended messages/s", args.count / appended),
+        ("written messages/s", args.count / written),
+        ("spool size (MB)", size),
+        ("replay (s)", replayed),
+        ("replayed messages/s", args.count / replayed),
+        ("duplicates", args.count - len(set(loopback.sunk_ids)))])
+
+
+
+if __name__ == '__main__':
+    main()
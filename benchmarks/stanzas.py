@@ -0,0 +1,82 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Floods a session with incoming messages, measuring the stanzas parsed and
+handled per second and the memory used. With the bounded stanza backlog
+the resident memory stays flat however many stanzas arrive.
+"""
+
+import threading
+import time
+
+import benchmarks
+from tests import server
+
+# Stanzas written by the server at once
+CHUNK = 1000
+
+def _flood(loopback, jid, count):
+    stanza = u"<message from='bob@localhost/bench' type='chat'>" \
+             u"<body>flood message</body></message>"
+
+    for start in range(0, count, CHUNK):
+        loopback.push(jid, stanza * min(CHUNK, count - start))
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--count', type=int, default=1000000,
+                        help="number of stanzas (default: %(default)s)")
+    args = parser.parse_args()
+
+    loopback = server.Server()
+    received = benchmarks.Counter()
+    chat = benchmarks.login(loopback, 'alice',
+                            lambda sender, body: received.add())
+    before = benchmarks.rss()
+    samples = []
+
+    start = time.time()
+    thread = threading.Thread(target=_flood,
+                              args=(loopback, chat.ID, args.count))
+    thread.daemon = True
+    thread.start()
+
+    while received.wait(args.count, timeout=1) is False:
+        samples.append(benchmarks.rss())
+
+    elapsed = time.time() - start
+    samples.append(benchmarks.rss())
+    chat.logout()
+    loopback.close()
+
+    benchmarks.report("Incoming stanza flood", [
+        ("stanzas", args.count),
+        ("seconds", elapsed),
+        ("stanzas/s", args.count / elapsed),
+        ("RSS before (MB)", before),
+        ("RSS max sampled (MB)", max(samples)),
+        ("RSS at the end (MB)", samples[-1]),
+        ("peak RSS (MB)", benchmarks.peak_rss())])
+
+
+
+if __name__ == '__main__':
+    main()
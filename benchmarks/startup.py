@@ -0,0 +1,103 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Measures the startup of shellber-cli: the wall time of --version, --help
+and of a batch run without a session, and, since Python 2 has no -X
+importtime, the time to import each of the slowest modules into a fresh
+interpreter. It reports the medians; tests/test_startup.py checks which
+modules each of these modes loads.
+"""
+
+import os
+import subprocess
+import sys
+
+import benchmarks
+from benchmarks.batch import config
+
+# The slowest modules, only loaded when they're needed
+MODULES = ('yaml', 'colorama', 'readline', 'sleekxmpp', 'shellber.app.core')
+
+# Prints the time to import a module
+_IMPORT = "import time; start = time.time(); import %s; " \
+          "print time.time() - start"
+
+def _median(values):
+    values = sorted(values)
+
+    return values[len(values) / 2]
+
+
+
+def _wall_time(runs, command):
+    """
+    Runs a command.
+
+    :return Returns the median wall time, in milliseconds.
+    """
+    with open(os.devnull, 'w') as null:
+        return _median(benchmarks.timed(subprocess.call, command,
+                                        stdout=null, stderr=null)[0] * 1000
+                       for _ in range(runs))
+
+
+
+def _import_time(runs, module):
+    """
+    Imports a module into fresh interpreters.
+
+    :return Returns the median import time, in milliseconds.
+    """
+    return _median(float(subprocess.check_output([sys.executable, '-c',
+                                                  _IMPORT % module])) * 1000
+                   for _ in range(runs))
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--runs', type=int, default=15,
+                        help="runs of each case (default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    batch = os.path.join(directory, 'commands')
+
+    with open(batch, 'w') as f:
+        f.write("help\n")
+
+    cli = [sys.executable, 'shellber-cli']
+    rows = [("interpreter only (ms)",
+             _wall_time(args.runs, [sys.executable, '-c', 'pass'])),
+            ("--version (ms)", _wall_time(args.runs, cli + ['--version'])),
+            ("--help (ms)", _wall_time(args.runs, cli + ['--help'])),
+            ("--batch, help only (ms)",
+             _wall_time(args.runs, cli + ['--config', config(directory),
+                                          '--batch', batch]))]
+
+    for module in MODULES:
+        rows.append(("import %s (ms)" % module,
+                     _import_time(args.runs, module)))
+
+    benchmarks.report("Startup of shellber-cli", rows)
+
+
+
+if __name__ == '__main__':
+    main()
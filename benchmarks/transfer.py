@@ -0,0 +1,124 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Sends a large file between two sessions of the loopback server, through
+its SOCKS5 proxy, and a smaller one In-Band. It reports the transfer rates
+and the resident memory of the process, sampled during the transfers,
+which holds both sides and the server, against the memory before them.
+"""
+
+import os
+import time
+
+import benchmarks
+from shellber.chat import presence
+from shellber.chat import transfer
+from tests import server
+
+def _create(directory, name, size):
+    """
+    Creates a file, sparse so it doesn't take the disk twice.
+    """
+    filename = os.path.join(directory, name)
+
+    with open(filename, 'wb') as f:
+        f.truncate(size)
+
+    return filename
+
+
+
+def _send(alice, filename, size):
+    """
+    Sends a file from Alice to Bob.
+
+    :return Returns the transfer rate, in MB/s, and the largest resident
+            memory during the transfer, in MB.
+    """
+    sent = alice.send_file(filename, 'bob@localhost')
+    largest = benchmarks.rss()
+
+    while sent.state not in (transfer.DONE, transfer.FAILED):
+        largest = max(largest, benchmarks.rss())
+        time.sleep(0.05)
+
+    if sent.state == transfer.FAILED:
+        raise Exception("transfer failed: " + sent.error)
+
+    return size / (1024.0 * 1024.0) / (time.time() - sent.started), largest
+
+
+
+def _run(directory, proxy, size):
+    loopback = server.Server(roster={'alice': ['bob@localhost'],
+                                     'bob': ['alice@localhost']},
+                             proxy=proxy)
+    downloads = os.path.join(directory, 'downloads')
+    alice = benchmarks.login(loopback, 'alice')
+    bob = benchmarks.login(loopback, 'bob', download_directory=downloads)
+
+    try:
+        if server.wait(lambda: alice.presence('bob@localhost').show ==
+                       presence.AVAILABLE) is False:
+            raise Exception("bob is offline")
+
+        filename = _create(directory, 'file-%d.bin' % size, size)
+        before = benchmarks.rss()
+        rate, largest = _send(alice, filename, size)
+
+        # The receiver finishes after the sender closes the stream
+        server.wait(lambda: os.path.isfile(os.path.join(
+            downloads, os.path.basename(filename))), timeout=60)
+        os.remove(filename)
+        os.remove(os.path.join(downloads, os.path.basename(filename)))
+
+        return rate, before, largest
+    finally:
+        alice.logout()
+        bob.logout()
+        loopback.close()
+
+
+
+def main():
+    parser = benchmarks.parser(__doc__)
+    parser.add_argument('--size', type=int, default=4096,
+                        help="size of the SOCKS5 file, in MB "
+                        "(default: %(default)s)")
+    parser.add_argument('--ibb-size', type=int, default=16,
+                        help="size of the In-Band file, in MB "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    directory = benchmarks.directory()
+    rows = []
+
+    for name, proxy, size in (("SOCKS5", True, args.size),
+                              ("In-Band", False, args.ibb_size)):
+        rate, before, largest = _run(directory, proxy, size * 1024 * 1024)
+        rows += [("%s, %d MB (MB/s)" % (name, size), rate),
+                 ("%s, RSS before (MB)" % name, before),
+                 ("%s, RSS during, largest (MB)" % name, largest)]
+
+    benchmarks.report("File transfers", rows)
+
+
+
+if __name__ == '__main__':
+    main()
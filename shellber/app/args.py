@@ -24,6 +24,7 @@ Functions do handle command line arguments.
 import argparse
 
 DEFAULT_CONFIG_FILE = 'shellber.yml'
+DEFAULT_SOCKET_FILE = 'shellber.sock'
 
 def parse_command_line_arguments(progname, progversion, description):
     """
@@ -47,6 +48,28 @@ def parse_command_line_arguments(progname, progversion, description):
                         help='Reads some configurations from a file.',
                         dest='config', default=DEFAULT_CONFIG_FILE)
 
+    # Commands come either from a file or from the control socket
+    modes = parser.add_mutually_exclusive_group()
+
+    modes.add_argument('-b', '--batch', nargs='?', const='-',
+                        help='Reads commands from a file, or from the '
+                             'standard input, instead of the terminal.',
+                        dest='batch', metavar='FILE', default=None)
+
+    modes.add_argument('-d', '--daemon', action='store_true',
+                        help='Runs without a terminal, receiving commands '
+                             'through the control socket.',
+                        dest='daemon', default=False)
+
+    parser.add_argument('-c', '--command', action='append',
+                        help='Sends a command to a running daemon and shows '
+                             'its output. May be used several times.',
+                        dest='commands', metavar='COMMAND', default=None)
+
+    parser.add_argument('-S', '--socket',
+                        help='The control socket of the daemon.',
+                        dest='socket', default=DEFAULT_SOCKET_FILE)
+
     args = parser.parse_args()
 
     return args
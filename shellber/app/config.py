@@ -17,27 +17,147 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import hashlib
+import logging
+import marshal
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
 import yaml
 
 DEFAULT_LOG_FILENAME = 'shellber.log'
 DEFAULT_LOG_LEVEL = 'debug'
 DEFAULT_CONFIG_FILENAME = 'shellber.yml'
+DEFAULT_SEND_HIGH_WATER = 512
+DEFAULT_OUTPUT_RATE_LIMIT = 20
+DEFAULT_LOG_QUEUE = False
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_LOG_MAX_BYTES = 0
+DEFAULT_LOG_BACKUP_COUNT = 5
+DEFAULT_LOG_ROTATE_WHEN = ''
+DEFAULT_HISTORY_DIRECTORY = 'history'
+DEFAULT_ROSTER_DIRECTORY = 'roster'
+DEFAULT_DOWNLOAD_DIRECTORY = 'downloads'
+DEFAULT_SPOOL_DIRECTORY = 'spool'
+DEFAULT_GROUP_HISTORY = 20
+DEFAULT_ARCHIVE_PAGE_SIZE = 100
+DEFAULT_ARCHIVE_CONCURRENCY = 8
+
+# Time, in seconds, the configuration must stay unchanged before it's
+# written, so a burst of changes is written once. It's written at most
+# SAVE_MAX_DELAY seconds after the first change, however.
+SAVE_DELAY = 0.5
+SAVE_MAX_DELAY = 5
+
+# Interval, in seconds, between the checks for changes in the config file
+# made while the application runs
+WATCH_INTERVAL = 1
+
+# The parsed configuration is cached into this file, next to the config file
+CACHE_SUFFIX = '.cache'
+
+# The cache starts with a header: its magic, the marshal format version, the
+# size and SHA-1 digest of the config file it was parsed from and the CRC32
+# of the rest of the cache, the configuration serialized by marshal.
+_CACHE_MAGIC = 'SHBC'
+_CACHE_HEADER = struct.Struct('>4sBQ20sI')
+
+# libyaml parses and writes YAML many times faster than the pure Python
+# implementation, when PyYAML is built with it.
+_Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+class _Loader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """
+    The safe YAML loader, which also takes the string tags written by older
+    versions, but no other Python specific tag.
+    """
+    def construct_python_unicode(self, node):
+        return unicode(self.construct_scalar(node))
+
+
+    def construct_python_str(self, node):
+        return self.construct_yaml_str(node)
+
+
+
+_Loader.add_constructor(u'tag:yaml.org,2002:python/unicode',
+                        _Loader.construct_python_unicode)
+_Loader.add_constructor(u'tag:yaml.org,2002:python/str',
+                        _Loader.construct_python_str)
+
+
 
 class ConfigParameters(object):
     """
     A class to hold all application parameters loaded/written into the
     config file.
+
+    Only the values read from the config file and the sections changed
+    through set() are written back, see explicit(), so a value missing from
+    the file keeps following its default.
     """
+    def __init__(self):
+        # The configuration parsed from the file, None if it exists but
+        # can't be read, and the sections changed since.
+        self._file = dict()
+        self._sections = set()
+
+
     def __repr(self):
-        return "ConfigParameters(data=%r)" % self.__dict__
+        return "ConfigParameters(data=%r)" % self.data()
 
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.data())
 
 
     def data(self):
-        return self.__dict__
+        return dict((name, value) for name, value in self.__dict__.items()
+                    if name.startswith('_') is False)
+
+
+    def set(self, section, key, value):
+        """
+        Changes a configuration value.
+
+        :param section: The name of the section, a dict such as 'account'.
+                        It's created if missing.
+        :param key: The value key in the section.
+        :param value: The new value.
+        """
+        values = getattr(self, section, None)
+
+        if values is None:
+            values = dict()
+            setattr(self, section, values)
+
+        values[key] = value
+        self._sections.add(section)
+
+
+    def explicit(self):
+        """
+        Gets the configuration to be written to the config file: the one
+        read from it, with the sections changed through set().
+
+        :return Returns a dict, or None if the config file couldn't be read,
+                so it must not be replaced.
+        """
+        if self._file is None:
+            return None
+
+        cfg = dict(self._file)
+
+        for section in self._sections:
+            if getattr(self, section, None) is not None:
+                cfg[section] = dict(getattr(self, section))
+
+        return cfg
 
 
 
@@ -47,13 +167,215 @@ def _create_default_values(parameters):
     """
     parameters.log_filename = DEFAULT_LOG_FILENAME
     parameters.log_level = DEFAULT_LOG_LEVEL
+    parameters.log_queue = DEFAULT_LOG_QUEUE
+    parameters.log_queue_size = DEFAULT_LOG_QUEUE_SIZE
+    parameters.log_max_bytes = DEFAULT_LOG_MAX_BYTES
+    parameters.log_backup_count = DEFAULT_LOG_BACKUP_COUNT
+    parameters.log_rotate_when = DEFAULT_LOG_ROTATE_WHEN
     parameters.filename = DEFAULT_CONFIG_FILENAME
+    parameters.send_high_water = DEFAULT_SEND_HIGH_WATER
+    parameters.output_rate_limit = DEFAULT_OUTPUT_RATE_LIMIT
+    parameters.history_directory = DEFAULT_HISTORY_DIRECTORY
+    parameters.roster_directory = DEFAULT_ROSTER_DIRECTORY
+    parameters.download_directory = DEFAULT_DOWNLOAD_DIRECTORY
+    parameters.spool_directory = DEFAULT_SPOOL_DIRECTORY
+    parameters.group_history = DEFAULT_GROUP_HISTORY
+    parameters.archive_page_size = DEFAULT_ARCHIVE_PAGE_SIZE
+    parameters.archive_concurrency = DEFAULT_ARCHIVE_CONCURRENCY
+
+
+
+def _write_file(filename, data, sync=True):
+    """
+    Replaces a file atomically. The data goes to a temporary file in the
+    same directory, which is renamed over the file, so a crash leaves
+    either the old or the new file, never a torn one.
+
+    :param filename: The file.
+    :param data: The new file contents.
+    :param sync: Indicates if the data must be on the disk before the
+                 function returns.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temporary = tempfile.mkstemp(prefix='.' + os.path.basename(filename),
+                                     suffix='.tmp', dir=directory)
+
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            temp.write(data)
+
+            if sync:
+                temp.flush()
+                os.fsync(temp.fileno())
+
+        # mkstemp() only lets the user read the file
+        if os.path.exists(filename):
+            os.chmod(temporary, stat.S_IMODE(os.stat(filename).st_mode))
+
+        os.rename(temporary, filename)
+    except:
+        os.unlink(temporary)
+        raise
+
+    if sync:
+        # The rename is only on the disk once the directory is
+        directory_fd = os.open(directory, os.O_RDONLY)
+
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+
+
+def _read_cache(filename, data):
+    """
+    Reads the cached configuration of a config file. The file contents are
+    checked against the digest kept in the cache, since an edit may keep
+    its size and, within the file system timestamp resolution, its
+    modification time.
+
+    :param filename: The config file.
+    :param data: The contents of the config file.
+
+    :return Returns the configuration, as parsed from the file, or None if
+            the cache is missing, corrupted or from another version of the
+            file.
+    """
+    try:
+        with open(filename + CACHE_SUFFIX, 'rb') as fd:
+            cache = fd.read()
+    except (IOError, OSError):
+        return None
+
+    if len(cache) < _CACHE_HEADER.size:
+        return None
+
+    magic, version, size, digest, crc = _CACHE_HEADER.unpack_from(cache)
+    payload = buffer(cache, _CACHE_HEADER.size)
+
+    if magic != _CACHE_MAGIC or version != marshal.version or \
+            size != len(data) or digest != hashlib.sha1(data).digest() or \
+            zlib.crc32(payload) & 0xffffffff != crc:
+        return None
+
+    try:
+        return marshal.loads(payload)
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+
+def _write_cache(filename, data, cfg):
+    """
+    Caches the configuration parsed from a config file. It's kept with
+    marshal, which loads much faster than YAML is parsed.
+
+    :param filename: The config file.
+    :param data: The contents of the config file.
+    :param cfg: The parsed configuration.
+    """
+    try:
+        payload = marshal.dumps(cfg)
+        header = _CACHE_HEADER.pack(_CACHE_MAGIC, marshal.version, len(data),
+                                    hashlib.sha1(data).digest(),
+                                    zlib.crc32(payload) & 0xffffffff)
+
+        # The cache is rebuilt from the config file when it's lost
+        _write_file(filename + CACHE_SUFFIX, header + payload, sync=False)
+    except (IOError, OSError, ValueError) as error:
+        logging.debug("Unable to cache %s: %s", filename, str(error))
+
+
+
+def _parse(data):
+    """
+    Parses a config file.
+
+    :param data: The file contents.
+
+    :return Returns the configuration. Raises yaml.YAMLError on errors.
+    """
+    return yaml.load(data, Loader=_Loader)
+
+
+
+def _read(filename):
+    """
+    Reads a config file. It's only parsed when it changed since it was last
+    cached.
+
+    :param filename: The config file.
+
+    :return Returns the configuration, as parsed from the file. Raises
+            IOError, OSError or yaml.YAMLError on errors.
+    """
+    with open(filename, 'rb') as fd:
+        data = fd.read()
+
+    cfg = _read_cache(filename, data)
+
+    if cfg is None:
+        cfg = _parse(data)
+
+        if isinstance(cfg, dict) is False:
+            raise yaml.YAMLError("no configuration found")
+
+        _write_cache(filename, data, cfg)
+
+    return cfg
+
+
+
+def _load_values(cfg_options, cfg):
+    """
+    Sets the parameters read from a config file.
+
+    :param cfg_options: The ConfigParameters object.
+    :param cfg: The configuration parsed from the file.
+    """
+    cfg_options.log_filename = cfg.get('log_filename', DEFAULT_LOG_FILENAME)
+    cfg_options.log_level = cfg.get('log_level', DEFAULT_LOG_LEVEL)
+    cfg_options.log_queue = cfg.get('log_queue', DEFAULT_LOG_QUEUE)
+    cfg_options.log_queue_size = cfg.get('log_queue_size',
+                                         DEFAULT_LOG_QUEUE_SIZE)
+    cfg_options.log_max_bytes = cfg.get('log_max_bytes', DEFAULT_LOG_MAX_BYTES)
+    cfg_options.log_backup_count = cfg.get('log_backup_count',
+                                           DEFAULT_LOG_BACKUP_COUNT)
+    cfg_options.log_rotate_when = cfg.get('log_rotate_when',
+                                          DEFAULT_LOG_ROTATE_WHEN)
+    cfg_options.send_high_water = cfg.get('send_high_water',
+                                          DEFAULT_SEND_HIGH_WATER)
+    cfg_options.output_rate_limit = cfg.get('output_rate_limit',
+                                            DEFAULT_OUTPUT_RATE_LIMIT)
+    cfg_options.history_directory = cfg.get('history_directory',
+                                            DEFAULT_HISTORY_DIRECTORY)
+    cfg_options.roster_directory = cfg.get('roster_directory',
+                                           DEFAULT_ROSTER_DIRECTORY)
+    cfg_options.download_directory = cfg.get('download_directory',
+                                             DEFAULT_DOWNLOAD_DIRECTORY)
+    cfg_options.spool_directory = cfg.get('spool_directory',
+                                          DEFAULT_SPOOL_DIRECTORY)
+    cfg_options.group_history = cfg.get('group_history',
+                                        DEFAULT_GROUP_HISTORY)
+    cfg_options.archive_page_size = cfg.get('archive_page_size',
+                                            DEFAULT_ARCHIVE_PAGE_SIZE)
+    cfg_options.archive_concurrency = cfg.get('archive_concurrency',
+                                              DEFAULT_ARCHIVE_CONCURRENCY)
+
+    if cfg.has_key('account'):
+        cfg_options.account = cfg.get('account')
+
+    # Named accounts, which may be logged in at the same time
+    if cfg.has_key('accounts'):
+        cfg_options.accounts = cfg.get('accounts')
 
 
 
 def load(filename):
     """
-    A function to load the application config file into the memory.
+    A function to load the application config file into the memory. The
+    file is only parsed when it changed since it was last cached.
 
     :return On success returns a ConfigParameter class with all loaded info or
             None otherwise.
@@ -61,25 +383,22 @@ def load(filename):
     cfg_options = ConfigParameters()
 
     try:
-        with open(filename) as fd:
-            data = fd.read()
-    except:
+        cfg = _read(filename)
+    except (IOError, OSError, yaml.YAMLError):
         _create_default_values(cfg_options)
-        return cfg_options
 
-    cfg_options.filename = filename
+        # The file is created where the user asked once something is set,
+        # but one which exists and can't be read is never replaced.
+        cfg_options.filename = filename
 
-    try:
-        cfg = yaml.load(data)
-    except yaml.YAMLError:
-        _create_default_values(cfg_options)
-        return cfg_options
+        if os.path.exists(filename):
+            cfg_options._file = None
 
-    cfg_options.log_filename = cfg.get('log_filename')
-    cfg_options.log_level = cfg.get('log_level')
+        return cfg_options
 
-    if cfg.has_key('account'):
-        cfg_options.account = cfg.get('account')
+    cfg_options.filename = filename
+    cfg_options._file = cfg
+    _load_values(cfg_options, cfg)
 
     return cfg_options
 
@@ -97,14 +416,325 @@ def save(cfg_options):
     if isinstance(cfg_options, ConfigParameters) is False:
         return False
 
-    with open(cfg_options.filename, 'w+') as fd:
-        yaml.dump(cfg_options.data(), fd, default_flow_style=False,
-                  allow_unicode=True)
+    cfg = cfg_options.explicit()
+
+    if cfg is None:
+        return False
+
+    _save(cfg_options.filename, cfg)
 
     return True
 
 
 
+def _save(filename, cfg):
+    """
+    Writes a configuration into a config file, atomically, and caches it.
+    """
+    data = yaml.dump(cfg, Dumper=_Dumper, default_flow_style=False,
+                     allow_unicode=True, encoding='utf-8')
+    _write_file(filename, data)
+    _write_cache(filename, data, cfg)
+
+
+
+def _stamp(filename):
+    """
+    Identifies a version of a file by its size, modification time and
+    inode, which a replacement through _write_file() changes.
+
+    :return Returns a tuple or None if the file doesn't exist.
+    """
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+
+    return (info.st_size, info.st_mtime, info.st_ino)
+
+
+
+class Store(object):
+    """
+    Keeps the config file in sync with a ConfigParameters object. Changes
+    made through set() are written by a background thread once they settle
+    for SAVE_DELAY seconds, so a burst of them, such as a batch of config
+    commands, costs a single write, and the caller never waits for the
+    disk. The file is replaced atomically, see _write_file(), and cached
+    along with it, so the next start doesn't parse it. Only the explicit
+    configuration is written, see ConfigParameters.explicit(), and a file
+    which exists but can't be read is never replaced.
+
+    The stamp of the last file written, see _stamp(), is kept at @written,
+    so a Watcher can tell our writes from the ones made by the user.
+
+    :param cfg_options: The ConfigParameters object.
+    :param delay: The time, in seconds, without changes before a write.
+    :param max_delay: The maximum time, in seconds, between a change and its
+                      write.
+    """
+    def __init__(self, cfg_options, delay=SAVE_DELAY,
+                 max_delay=SAVE_MAX_DELAY):
+        self._cfg = cfg_options
+        self._delay = delay
+        self._max_delay = max_delay
+        self._changed = threading.Condition(threading.Lock())
+        self._dirty = dict()
+        self._first_change = 0
+        self._last_change = 0
+        self._failed = False
+        self._stop = False
+        self.written = None
+
+        self._writer = threading.Thread(name='config', target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+
+    def __repr__(self):
+        return "Store(filename=%r, dirty=%r)" % (self._cfg.filename,
+                                                 sorted(self._dirty))
+
+
+    def _snapshot(self):
+        """
+        Copies the configuration to be written, with the internal lock held.
+
+        :return Returns a dict, or None if the config file must not be
+                replaced.
+        """
+        self._dirty.clear()
+
+        return self._cfg.explicit()
+
+
+    def _write(self):
+        while True:
+            with self._changed:
+                while not self._dirty and self._stop is False:
+                    self._changed.wait()
+
+                # Waits for the changes to settle
+                while self._dirty and self._stop is False:
+                    delay = min(self._last_change + self._delay,
+                                self._first_change + self._max_delay) - \
+                            time.time()
+
+                    if delay <= 0:
+                        break
+
+                    self._changed.wait(delay)
+
+                # close() writes whatever is left
+                if self._stop:
+                    return
+
+                cfg = self._snapshot()
+
+            # Every write has the whole configuration, so a failed one is
+            # retried along with the next.
+            self._failed = self._save(cfg) is False
+
+
+    def set(self, section, key, value):
+        """
+        Changes a configuration value. The config file is written later.
+
+        :param section: The name of the section, a dict such as 'account'.
+                        It's created if missing.
+        :param key: The value key in the section.
+        :param value: The new value.
+        """
+        with self._changed:
+            self._cfg.set(section, key, value)
+            now = time.time()
+
+            if not self._dirty:
+                self._first_change = now
+
+            self._last_change = now
+            self._dirty.setdefault(section, set()).add(key)
+            self._changed.notify()
+
+
+    def reload(self):
+        """
+        Reads the config file again and applies its changes. Only the
+        parameters which changed are replaced, and the values changed by
+        set() and not written yet are kept over the ones from the file.
+
+        :return Returns a dict with the changed parameters and their new
+                values, the default ones for the parameters removed from
+                the file, or None if they have none. Raises IOError, OSError
+                or yaml.YAMLError if the file can't be read.
+        """
+        cfg = _read(self._cfg.filename)
+        cfg_options = ConfigParameters()
+        _load_values(cfg_options, cfg)
+        values = cfg_options.data()
+        changes = dict()
+
+        with self._changed:
+            self._cfg._file = cfg
+            current = self._cfg.data()
+
+            for name in set(current) | set(values):
+                if name == 'filename':
+                    continue
+
+                # A parameter removed from the file gets its default, from
+                # _load_values(). The sections without one, such as the
+                # accounts, are removed.
+                value = values.get(name, cfg.get(name))
+
+                if name in self._dirty:
+                    value = dict(value or {})
+
+                    for key in self._dirty[name]:
+                        value[key] = current[name][key]
+
+                if name in current and current[name] == value:
+                    continue
+
+                if value is None:
+                    delattr(self._cfg, name)
+                else:
+                    setattr(self._cfg, name, value)
+
+                changes[name] = value
+
+        return changes
+
+
+    def _save(self, cfg):
+        """
+        Writes a configuration from _snapshot() into the config file.
+
+        :return Returns True on success or False otherwise.
+        """
+        if cfg is None:
+            logging.error("%s can't be read, so the changes aren't saved "
+                          "until it's fixed", self._cfg.filename)
+            return False
+
+        try:
+            _save(self._cfg.filename, cfg)
+        except (IOError, OSError, yaml.YAMLError) as error:
+            logging.error("Unable to save %s: %s", self._cfg.filename,
+                          str(error))
+            return False
+
+        self.written = _stamp(self._cfg.filename)
+
+        return True
+
+
+    def close(self):
+        """
+        Writes the changes not written yet and stops the background thread.
+
+        :return Returns True on success or False otherwise.
+        """
+        with self._changed:
+            self._stop = True
+            self._changed.notify()
+
+        self._writer.join()
+
+        if not self._dirty and self._failed is False:
+            return True
+
+        with self._changed:
+            cfg = self._snapshot()
+
+        return self._save(cfg)
+
+
+
+class Watcher(object):
+    """
+    Applies the changes the user makes to the config file while the
+    application runs, through Store.reload(). A background thread checks
+    the file every @interval seconds, so neither the user input nor the
+    chat sessions wait for it, and it only reads the file once it stopped
+    changing for an interval, since editors may write it in several steps.
+    The files written by the Store itself are skipped.
+
+    :param store: The Store object of the configuration.
+    :param filename: The config file.
+    :param handle_changes: A function to be called with the dict of changed
+                           parameters, from the background thread.
+    :param interval: The time, in seconds, between the checks.
+    """
+    def __init__(self, store, filename, handle_changes,
+                 interval=WATCH_INTERVAL):
+        self._store = store
+        self._filename = filename
+        self._handle_changes = handle_changes
+        self._interval = interval
+        self._seen = _stamp(filename)
+        self._stop = threading.Event()
+
+        self._watcher = threading.Thread(name='config-watcher',
+                                         target=self._watch)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+
+    def __repr__(self):
+        return "Watcher(filename=%r, interval=%r)" % (self._filename,
+                                                      self._interval)
+
+
+    def _watch(self):
+        pending = None
+
+        while self._stop.wait(self._interval) is False:
+            stamp = _stamp(self._filename)
+
+            if stamp == self._seen:
+                pending = None
+                continue
+
+            # Waits for the file to settle
+            if stamp != pending:
+                pending = stamp
+                continue
+
+            self._seen = stamp
+            pending = None
+
+            if stamp is None or stamp == self._store.written:
+                continue
+
+            try:
+                changes = self._store.reload()
+            except (IOError, OSError, yaml.YAMLError) as error:
+                logging.warning("Unable to reload %s: %s", self._filename,
+                                str(error))
+                continue
+
+            if changes:
+                logging.info("Reloaded %s: %s", self._filename,
+                             ', '.join(sorted(changes)))
+
+                # The watcher must survive a change it can't apply
+                try:
+                    self._handle_changes(changes)
+                except Exception:
+                    logging.exception("Unable to apply the changes of %s",
+                                      self._filename)
+
+
+    def close(self):
+        """
+        Stops the background thread.
+        """
+        self._stop.set()
+        self._watcher.join()
+
+
+
 def display_configurations(cfg_options):
     output = '\n'
 
@@ -121,6 +751,13 @@ def display_configurations(cfg_options):
             output += ' Server: ' + cfg_options.account['server'] + '\n'
             output += ' Service: ' + cfg_options.account['host'] + '\n'
 
+        if hasattr(cfg_options, 'accounts'):
+            output += '\nAccounts:\n\n'
+
+            for name, account in sorted(cfg_options.accounts.items()):
+                output += ' ' + name + ': ' + account['username'] + '@' + \
+                        account['server'] + '\n'
+
     return output
 
 
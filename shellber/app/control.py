@@ -0,0 +1,287 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Functions and objects to control a running application through a Unix
+domain socket.
+
+Requests and replies are frames: a 4 bytes big endian length followed by
+the payload. A request carries a command line. A reply carries a status
+byte, STATUS_OK or STATUS_FAILED, followed by the command output.
+"""
+
+import atexit
+import logging
+import os
+import Queue
+import socket
+import struct
+import sys
+import threading
+
+# Maximum payload size of a frame
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Interval, in seconds, between the checks for a signal while waiting for
+# a request. Python 2 doesn't interrupt an endless wait on a queue.
+WAIT_INTERVAL = 0.5
+
+# Reply status
+STATUS_OK = '0'
+STATUS_FAILED = '1'
+
+_HEADER = struct.Struct('>I')
+
+def _read_exactly(sock, size):
+    data = []
+
+    while size > 0:
+        chunk = sock.recv(size)
+
+        if not chunk:
+            return None
+
+        data.append(chunk)
+        size -= len(chunk)
+
+    return ''.join(data)
+
+
+
+def read_frame(sock):
+    """
+    Reads a frame from a socket.
+
+    :param sock: The socket.
+
+    :return Returns the frame payload or None if the peer has closed the
+            connection.
+    """
+    header = _read_exactly(sock, _HEADER.size)
+
+    if header is None:
+        return None
+
+    size = _HEADER.unpack(header)[0]
+
+    if size > MAX_FRAME_SIZE:
+        raise Exception("frame too large: %d bytes" % size)
+
+    if size == 0:
+        return ''
+
+    return _read_exactly(sock, size)
+
+
+
+def write_frame(sock, payload):
+    """
+    Writes a frame to a socket.
+
+    :param sock: The socket.
+    :param payload: The frame payload.
+    """
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+
+def send_commands(path, lines):
+    """
+    Sends commands to a running application and prints their output. All
+    the commands are sent before reading the first reply, so they're
+    handled one after another without waiting for the round trips.
+
+    :param path: The control socket path.
+    :param lines: The command lines.
+
+    :return Returns 0 if every command succeeded or 1 otherwise.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except socket.error as error:
+        sys.stderr.write("No shellber daemon at %s: %s\n" % (path, error))
+        return 1
+
+    status = 0
+
+    try:
+        for line in lines:
+            write_frame(sock, line)
+
+        sock.shutdown(socket.SHUT_WR)
+
+        for unused in lines:
+            reply = read_frame(sock)
+
+            if reply is None:
+                sys.stderr.write("The shellber daemon has closed the "
+                                 "connection\n")
+                return 1
+
+            if reply[:1] != STATUS_OK:
+                status = 1
+
+            if len(reply) > 1:
+                sys.stdout.write(reply[1:] + '\n')
+    finally:
+        sock.close()
+
+    return status
+
+
+
+class Server(object):
+    """
+    A control socket, which receives command lines from the clients started
+    by send_commands(). It's used by the application as the input stream of
+    an input.BatchInput object: every readline() call returns the next
+    received command, blocking until there's one, and the application must
+    answer it with reply() before reading another.
+
+    Each client connection has its own thread, but the commands from all of
+    them are handled by the application one at a time, in the order they
+    arrive.
+
+    :param path: The socket path. A stale socket left by a previous run is
+                 replaced, a socket with a running application isn't. It's
+                 removed by close() or, if the application never calls it,
+                 at exit.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._requests = Queue.Queue()
+        self._client = None
+        self._inode = None
+
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.remove(path)
+            else:
+                raise Exception("a daemon is already running at " + path)
+            finally:
+                probe.close()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._inode = os.stat(path).st_ino
+        atexit.register(self.close)
+
+        # Only the user may control the application. Connections are refused
+        # until listen(), so nobody else gets in before the socket is 0600.
+        os.chmod(path, 0600)
+        self._sock.listen(16)
+
+        thread = threading.Thread(name='control', target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+
+    def _accept(self):
+        while True:
+            try:
+                client, unused = self._sock.accept()
+            except socket.error:
+                return
+
+            thread = threading.Thread(name='control_client',
+                                      target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+
+    def _serve(self, client):
+        try:
+            while True:
+                line = read_frame(client)
+
+                if line is None:
+                    break
+
+                self._requests.put((line, client))
+        except Exception:
+            logging.exception("control connection failed")
+
+        # The connection is closed after the replies of its commands
+        self._requests.put((None, client))
+
+
+    def readline(self):
+        """
+        Waits for the next command line.
+
+        :return Returns the command line.
+        """
+        while True:
+            try:
+                line, client = self._requests.get(timeout=WAIT_INTERVAL)
+            except Queue.Empty:
+                continue
+
+            if line is None:
+                client.close()
+            elif not line.strip() or line.lstrip().startswith('#'):
+                # Nothing will be handled, but the client waits for a reply
+                self._client = client
+                self.reply(False, [])
+            else:
+                self._client = client
+                return line + '\n'
+
+
+    def reply(self, failed, lines):
+        """
+        Answers the last command returned by readline().
+
+        :param failed: Indicates if the command has failed.
+        :param lines: The command output lines.
+        """
+        client, self._client = self._client, None
+
+        if client is None:
+            return
+
+        payload = '\n'.join(line.encode('utf-8')
+                            if isinstance(line, unicode) else line
+                            for line in lines)
+
+        try:
+            write_frame(client, (STATUS_FAILED if failed else STATUS_OK) +
+                        payload[:MAX_FRAME_SIZE - 1])
+        except socket.error:
+            pass
+
+
+    def close(self):
+        """
+        Stops receiving commands and removes the socket, unless it was
+        already replaced by another application.
+        """
+        self._sock.close()
+        inode, self._inode = self._inode, None
+
+        try:
+            if inode is not None and os.stat(self._path).st_ino == inode:
+                os.remove(self._path)
+        except OSError:
+            pass
@@ -21,16 +21,86 @@
 The shellber core module to control the application.
 """
 
+import functools
+import logging
 import signal
+import sys
+import time
+from collections import OrderedDict
 
 import shellber.app.config as config
+import shellber.app.control as control
 import shellber.app.log as log
 
 from shellber.ui import input
 from shellber.ui import output
 from shellber.ui import commands
 
+from shellber.chat import broadcast
 from shellber.chat import chat
+from shellber.chat import presence
+from shellber.chat import transfer
+
+# Number of messages shown by the history command without options
+HISTORY_LIMIT = 20
+
+# Maximum number of presence changes shown one by one, more than these are
+# summarized.
+PRESENCE_DETAILS = 5
+
+# The user presence states from the presence sub-commands
+_PRESENCE_STATES = {
+    commands.CMD_PRESENCE_AVAILABLE: presence.CHAT,
+    commands.CMD_PRESENCE_ONLINE: presence.AVAILABLE,
+    commands.CMD_PRESENCE_AWAY: presence.AWAY,
+    commands.CMD_PRESENCE_OFFLINE: presence.OFFLINE,
+    commands.CMD_PRESENCE_INVISIBLE: presence.INVISIBLE,
+}
+
+def _parse_date(value):
+    """
+    Translates a date option, such as 2016-05-01 or 2016-05-01T10:30, into
+    a timestamp.
+    """
+    date_format = '%Y-%m-%dT%H:%M' if 'T' in value else '%Y-%m-%d'
+
+    return time.mktime(time.strptime(value, date_format))
+
+
+
+def _format_size(value):
+    """
+    Formats a number of bytes for humans, such as 1.5 MB.
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if value < 1024:
+            break
+
+        value /= 1024.0
+    else:
+        unit = 'TB'
+
+    return '%.1f %s' % (value, unit)
+
+
+
+def _terminate(signum, unused):
+    """
+    Handles SIGTERM by exiting, so the exit handlers run.
+    """
+    raise SystemExit(128 + signum)
+
+
+
+# Supported command options, with their names and their value parsers
+_OPTIONS = {
+    commands.CMD_OPTION_FROM: ('peer', str),
+    commands.CMD_OPTION_GROUP: ('group', str),
+    commands.CMD_OPTION_LIMIT: ('limit', int),
+    commands.CMD_OPTION_OFFSET: ('offset', int),
+    commands.CMD_OPTION_SINCE: ('since', _parse_date),
+    commands.CMD_OPTION_SORT: ('sort', str),
+}
 
 class Application(object):
     """
@@ -43,6 +113,14 @@ class Application(object):
         cmd = app.wait_for_command()
         app.handle_command(cmd)
 
+    sys.exit(app.finish())
+
+    In batch mode the commands are read from a file, or from the standard
+    input, without any terminal interaction, and the application quits at
+    its end. In daemon mode they're received through the control socket,
+    so the sessions stay logged in between the commands, until a quit
+    command is received.
+
     :param args: An object from the command line options parser.
     """
     def __init__(self, args):
@@ -52,20 +130,88 @@ class Application(object):
         if self._cfg is None:
             raise Exception("Invalid configuration!")
 
+        # Changes are written in the background as they're made
+        self._store = config.Store(self._cfg)
+
+        self._batch = getattr(args, 'batch', None)
+        self._daemon = getattr(args, 'daemon', False)
+        self._interactive = self._batch is None and self._daemon is False
+        self._control = None
+        self._commands = 0
+        self._failed_commands = 0
+
         # Start internals
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-        log.start_log(self._cfg.log_filename, self._cfg.log_level)
+        if self._interactive:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        log.start_log(self._cfg.log_filename, self._cfg.log_level,
+                      queued=self._cfg.log_queue,
+                      queue_size=self._cfg.log_queue_size,
+                      max_bytes=self._cfg.log_max_bytes,
+                      backup_count=self._cfg.log_backup_count,
+                      rotate_when=self._cfg.log_rotate_when)
 
         # Initialize application output environment
-        self._output = output.Output()
+        self._output = output.Output(rate_limit=self._cfg.output_rate_limit,
+                                     colors=self._interactive)
+
+        # Changes to the config file made by the user are applied as they
+        # happen, without restarting the sessions.
+        self._watcher = config.Watcher(self._store, self._cfg.filename,
+                                       self._config_changed)
 
         # Start user-input handling
         self._env = commands.ENV_MAIN
-        self._input = input.Input(self._output, self._env)
-        self._present_credentials()
 
-        # Start XMPP handling
-        self._chat = chat.Chat(self.display_received_message)
+        if self._interactive:
+            self._input = input.Input(self._output, self._env,
+                                      roster=lambda: self._chat.roster())
+            self._present_credentials()
+        elif self._daemon:
+            # A terminated daemon exits as an interrupted one, removing its
+            # control socket
+            signal.signal(signal.SIGTERM, _terminate)
+            self._control = control.Server(args.socket)
+            self._input = input.BatchInput(self._control, self._env)
+        elif self._batch == '-':
+            self._input = input.BatchInput(sys.stdin, self._env)
+        else:
+            self._input = input.BatchInput(open(self._batch), self._env)
+
+        # Start XMPP handling. Every logged in account has its own session,
+        # the active one is always at self._chat.
+        self._sessions = OrderedDict()
+        self._account = None
+        self._chat = self._new_session(None)
+
+        # The actions to take on every supported command, built once since
+        # batch and daemon modes may handle lots of commands.
+        self._actions = {
+            commands.CMD_HELP: self._help,
+            commands.CMD_ACCOUNT: self._accounts,
+            commands.CMD_LOGIN: self._login,
+            commands.CMD_LOGOUT: self._logout,
+            commands.CMD_REGISTER: self._register,
+            commands.CMD_UNREGISTER: self._unregister,
+            commands.CMD_GROUP: self._group,
+            commands.CMD_CHAT: self._start_chat,
+            commands.CMD_UNCHAT: self._stop_chat,
+            commands.CMD_CONFIG: self._config,
+            commands.CMD_CONTACT: self._contacts,
+            commands.CMD_FILE: self._file,
+            commands.CMD_FILETO: self._fileto,
+            commands.CMD_HISTORY: self._history,
+            commands.CMD_SEARCH: self._search,
+            commands.CMD_ARCHIVE: self._archive,
+            commands.CMD_PRESENCE: self._presence,
+            commands.CMD_MSG: self._message,
+            commands.CMD_MSGGR: self._msgto,
+            commands.CMD_MSGTO: self._msgto,
+            commands.CMD_CFG_SET: self._cfg_set,
+            commands.CMD_CFG_SHOW: self._cfg_show,
+            commands.CMD_CLEAR: output.clear,
+            commands.CMD_QUIT: self._quit,
+        }
 
         # Puts the application into the running mode ;-)
         self._args = args
@@ -88,8 +234,70 @@ class Application(object):
         self._output.message(self._input.commands.help(cmd))
 
 
+    def _new_session(self, account):
+        """
+        Creates the chat session of an account. Its notifications are
+        tagged with the account name, so they can be told apart from the
+        ones of the active account.
+
+        :param account: The account name.
+
+        :return Returns a chat.Chat object.
+        """
+        return chat.Chat(functools.partial(self.display_received_message,
+                                           account=account),
+                         functools.partial(self.display_notification,
+                                           account=account),
+                         send_high_water=self._cfg.send_high_water,
+                         history_directory=self._cfg.history_directory,
+                         roster_directory=self._cfg.roster_directory,
+                         handle_presence=functools.partial(
+                             self.display_presence, account=account),
+                         download_directory=self._cfg.download_directory,
+                         handle_transfer=functools.partial(
+                             self.display_transfer, account=account),
+                         handle_broadcast=functools.partial(
+                             self.display_broadcast, account=account),
+                         spool_directory=self._cfg.spool_directory,
+                         group_history=self._cfg.group_history,
+                         archive_page_size=self._cfg.archive_page_size,
+                         archive_concurrency=self._cfg.archive_concurrency)
+
+
+    def _use_account(self, account):
+        """
+        Makes a logged in account the active one.
+
+        :param account: The account name.
+        """
+        self._account = account
+        self._chat = self._sessions[account]
+        self._input.set_prompt(login=self._chat.ID, contact=self._chat.contact)
+
+
     def _login(self, cmd):
         args = cmd.get(input.ARGUMENTS)
+        account = None
+        rooms = list()
+
+        # A single argument is the name of a configured account
+        if args is not None and len(args.split()) == 1:
+            account = args.strip()
+            details = getattr(self._cfg, 'accounts', dict()).get(account)
+
+            if details is None:
+                self._output.error("Unknown account: " + account)
+                return
+
+            rooms = details.get('rooms', list())
+
+            try:
+                args = details['username'] + " " + details['password'] + \
+                        " " + details['server'] + " " + details.get('host', '')
+            except KeyError:
+                self._output.error("Missing account configuration details "
+                                   "for " + account)
+                return
 
         # No arguments, we'll use the configured account
         if args is None:
@@ -104,6 +312,7 @@ class Application(object):
                         self._cfg.account['password'] + " " + \
                         self._cfg.account['server'] + " " + \
                         self._cfg.account['host']
+                    rooms = self._cfg.account.get('rooms', list())
                 else:
                     self._output.error("Missing account configuration details. "
                                        "You may do this through the config "
@@ -117,19 +326,90 @@ class Application(object):
 
                 return
 
+        args = args.split()
+
+        # Accounts given by their details are named by their JID
+        if account is None and len(args) >= 3:
+            account = args[0] + '@' + args[2]
+
+        session = self._sessions.get(account)
+
+        if session is None:
+            session = self._new_session(account)
+
         try:
-            self._chat.login(args.split())
-            self._input.set_prompt(login=self._chat.ID)
+            session.login(args)
         except Exception as error:
             self._output.error("Error: " + str(error))
+            return
+
+        self._sessions[account] = session
+        self._use_account(account)
+
+        # They're all joined at once when the session starts
+        for room in rooms:
+            try:
+                session.group_join(room)
+            except Exception as error:
+                self._output.error("Error: " + str(error))
+
+        # Commands are queued until the session starts, but without a user
+        # looking at the notifications we must tell if the login failed.
+        if self._interactive is False and session.wait_session() is False:
+            self._output.error("Error: unable to start the session")
 
 
     def _logout(self, cmd):
-        try:
-            self._chat.logout()
+        session = self._sessions.pop(self._account, None)
+
+        if session is None:
+            self._output.error("Error: not connected")
+            return
+
+        # A session dropped by the server only needs to be forgotten
+        if session.connected():
+            try:
+                session.logout()
+            except Exception as error:
+                self._output.error("Error: " + str(error))
+        else:
+            session.close()
+
+        # Another session becomes the active one, if there is any left
+        if self._sessions:
+            self._use_account(next(reversed(self._sessions)))
+        else:
+            self._account = None
             self._input.set_prompt()
-        except Exception as error:
-            self._output.error("Error: " + str(error))
+
+
+    def _accounts(self, cmd):
+        """
+        Lists the logged in accounts or changes the active one.
+
+        :param cmd: The command entered by the user.
+        """
+        args = cmd.get(input.ARGUMENTS).split()
+
+        if args[0] == commands.CMD_ACCOUNT_LIST:
+            if not self._sessions:
+                self._output.message("No accounts logged in")
+
+            for account, session in self._sessions.items():
+                self._output.message("%s ${FG_MAGENTA}%-20s${FG_RESET} %-40s "
+                                     "%s",
+                                     '*' if account == self._account else ' ',
+                                     account, session.ID,
+                                     'connected' if session.connected()
+                                     else 'disconnected')
+        elif args[0] == commands.CMD_ACCOUNT_USE and len(args) > 1:
+            if args[1] not in self._sessions:
+                self._output.error("Error: account not logged in")
+                return
+
+            self._use_account(args[1])
+        else:
+            self._unsupported_command(args)
 
 
     def _start_chat(self, cmd):
@@ -166,17 +446,38 @@ class Application(object):
 
         try:
             if args[0] == commands.CMD_GROUP_CREATE:
-                self._chat.group_create(args[1])
+                self._chat.group_create(*args[1:3])
             elif args[0] == commands.CMD_GROUP_INVITE:
                 self._chat.group_invite(args[1:])
-            elif args[0] == commands.GROUP_JOIN:
-                self._chat.group_join(args[1])
+            elif args[0] == commands.CMD_GROUP_JOIN:
+                self._chat.group_join(*args[1:3])
+            elif args[0] == commands.CMD_GROUP_LEAVE:
+                self._chat.group_leave(args[1])
+            elif args[0] == commands.CMD_GROUP_OCCUPANTS:
+                self._group_occupants(args[1])
             else:
                 self._unsupported_command(args)
         except Exception as error:
             self._output.error("Error: " + str(error))
 
 
+    def _group_occupants(self, group_name):
+        """
+        Shows the occupants of a group.
+
+        :param group_name: The group JID.
+        """
+        occupants = self._chat.group_occupants(group_name)
+
+        if not occupants:
+            self._output.message("No occupants")
+
+        for nick, occupant in occupants:
+            self._output.message("${FG_MAGENTA}%-30s${FG_RESET} %-12s %-10s "
+                                 "%s", nick, occupant.role or '',
+                                 occupant.show, occupant.jid or '')
+
+
     def _quit(self, cmd):
         """
         Quits an application environment or the application itself.
@@ -190,6 +491,16 @@ class Application(object):
         ]
 
         if any(tests):
+            # The stream threads keep the application alive, so we must
+            # leave the servers before quitting.
+            for session in self._sessions.values():
+                if session.connected():
+                    session.logout()
+                else:
+                    session.close()
+
+            self._sessions.clear()
+
             self._run = False
         elif self._env == commands.ENV_CONFIG:
             self._input.set_prompt(login=self._chat.ID,
@@ -221,20 +532,95 @@ class Application(object):
             elif args[0] == commands.CMD_CONTACT_DEL:
                 self._chat.contact_del(args[1])
             elif args[0] == commands.CMD_CONTACT_LIST:
-                self._chat.contact_list()
+                self._contact_list(args[1:])
             else:
                 self._unsupported_command(args)
         except Exception as error:
             self._output.error("Error: " + str(error))
 
 
+    def _contact_list(self, args):
+        """
+        Shows the contacts from the roster.
+
+        :param args: The contact list arguments: an optional text to search
+                     in the contacts and the sorting, filtering and paging
+                     options.
+        """
+        try:
+            args, options = self._parse_options(args,
+                                                commands.CMD_OPTION_GROUP,
+                                                commands.CMD_OPTION_SORT,
+                                                commands.CMD_OPTION_OFFSET,
+                                                commands.CMD_OPTION_LIMIT)
+
+            if len(args) > 1:
+                raise ValueError(args)
+        except ValueError:
+            self._output.error("Wrong arguments, see help for details")
+            return
+
+        if args:
+            options['pattern'] = args[0]
+
+        contacts = self._chat.contact_list(**options)
+
+        if not contacts:
+            self._output.message("No contacts found")
+            return
+
+        for jid, contact in contacts:
+            self._output.message("${FG_MAGENTA}%-40s${FG_RESET} %-20s %-5s "
+                                 "%-10s %s", jid, contact.name,
+                                 contact.subscription,
+                                 self._chat.presence(jid).show,
+                                 ', '.join(contact.groups))
+
+
+    def _presence(self, cmd):
+        """
+        Sets the user presence, with an optional status message, such as:
+        presence away out for lunch.
+
+        :param cmd: The command entered by the user.
+        """
+        args = cmd.get(input.ARGUMENTS, '').split(' ', 1)
+        state = _PRESENCE_STATES.get(args[0])
+
+        if state is None:
+            self._unsupported_command(args)
+            return
+
+        try:
+            self._chat.set_presence(state, args[1] if len(args) > 1 else '')
+        except Exception as error:
+            self._output.error("Error: " + str(error))
+
+
     def _file(self, cmd):
         """
-        Sends a file to the active contact in the chat.
+        Sends a file to the active contact in the chat. Without arguments
+        shows the file transfers in progress.
 
         :param cmd: The command entered by the user.
         """
-        pass
+        args = cmd.get(input.ARGUMENTS)
+
+        if args is None:
+            transfers = self._chat.transfers()
+
+            if not transfers:
+                self._output.message("No file transfers")
+
+            for transfer_ in transfers:
+                self.display_transfer(transfer_)
+
+            return
+
+        try:
+            self._chat.send_file(args.strip())
+        except Exception as error:
+            self._output.error("Error: " + str(error))
 
 
     def _fileto(self, cmd):
@@ -244,7 +630,16 @@ class Application(object):
 
         :param cmd: The command entered by the user.
         """
-        pass
+        args = cmd.get(input.ARGUMENTS).split(' ', 1)
+
+        if len(args) < 2:
+            self._output.error("Wrong arguments, see help for details")
+            return
+
+        try:
+            self._chat.send_file(args[1].strip(), destination=args[0])
+        except Exception as error:
+            self._output.error("Error: " + str(error))
 
 
     def _message(self, cmd):
@@ -269,28 +664,285 @@ class Application(object):
         :param cmd: The command entered by the user.
         """
         args = cmd.get(input.ARGUMENTS).split(' ', 1)
+        recipients = list()
 
+        # Several recipients may be given, separated by commas, and also
+        # files with lists of recipients, as @filename.
         try:
-            self._chat.message(args[1], destination=args[0])
+            for recipient in args[0].split(','):
+                if recipient.startswith('@'):
+                    recipients.extend(broadcast.load_recipients(recipient[1:]))
+                elif recipient:
+                    recipients.append(recipient)
+        except IOError as error:
+            self._output.error("Error: " + str(error))
+            return
+
+        try:
+            if len(recipients) == 1 and not args[0].startswith('@'):
+                self._chat.message(args[1], destination=recipients[0])
+            elif recipients:
+                self._chat.broadcast(args[1], recipients)
+            else:
+                self._output.error("Error: no recipients")
         except Exception as error:
             self._output.error("Error: " + str(error))
 
 
-    def _cfg_set(self, cmd):
-        args = cmd.get(input.ARGUMENTS).split()
+    def _parse_options(self, args, *supported):
+        """
+        Splits the arguments of a command into its plain arguments and its
+        options, such as: --since 2016-05-01 --limit 100.
 
-        if hasattr(self._cfg, 'account') is False:
-            self._cfg.account = dict()
+        :param args: The command arguments, already split.
+        :param supported: The options supported by the command.
 
-        self._cfg.account[args[0]] = args[1]
+        :return Returns a tuple with the list of plain arguments and a dict
+                with the options. Raises ValueError on wrong options.
+        """
+        arguments = list()
+        options = dict()
+        args = iter(args)
+
+        try:
+            for arg in args:
+                option = _OPTIONS.get(arg)
+
+                if option is None:
+                    arguments.append(arg)
+                elif arg not in supported:
+                    raise ValueError("unsupported option: " + arg)
+                else:
+                    key, parse = option
+                    options[key] = parse(next(args))
+        except StopIteration:
+            raise ValueError("missing option value")
+
+        return arguments, options
+
+
+    def _display_history_message(self, message, text):
+        self._output.message("${FG_BLUE}%s${FG_RESET} "
+                             "[${FG_MAGENTA}%s${FG_RESET}] %s",
+                             time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.localtime(message.timestamp)),
+                             message.sender, text)
+
+
+    def _history(self, cmd):
+        """
+        Shows the messages exchanged with a contact or a group. The messages
+        are read from the history while they're displayed.
+
+        :param cmd: The command entered by the user.
+        """
+        try:
+            args, options = self._parse_options(
+                cmd.get(input.ARGUMENTS).split(), commands.CMD_OPTION_SINCE,
+                commands.CMD_OPTION_LIMIT)
+
+            if len(args) != 1:
+                raise ValueError(args)
+        except ValueError:
+            self._output.error("Wrong arguments, see help for details")
+            return
+
+        if 'since' not in options:
+            options.setdefault('limit', HISTORY_LIMIT)
+
+        try:
+            for message in self._chat.history(args[0], **options):
+                self._display_history_message(message, message.body)
+        except Exception as error:
+            self._output.error("Error: " + str(error))
+
+
+    def _search(self, cmd):
+        """
+        Searches the history for messages containing some terms.
+
+        :param cmd: The command entered by the user.
+        """
+        try:
+            args, options = self._parse_options(
+                cmd.get(input.ARGUMENTS).split(), commands.CMD_OPTION_FROM,
+                commands.CMD_OPTION_SINCE, commands.CMD_OPTION_LIMIT)
+
+            if not args:
+                raise ValueError(args)
+        except ValueError:
+            self._output.error("Wrong arguments, see help for details")
+            return
+
+        try:
+            results = self._chat.search(' '.join(args), **options)
+        except Exception as error:
+            self._output.error("Error: " + str(error))
+            return
+
+        if not results:
+            self._output.message("No messages found")
+
+        for message, snippet in results:
+            self._output.message("${FG_CYAN}%s${FG_RESET}", message.peer)
+            self._display_history_message(message, snippet)
+
+
+    def _archive(self, cmd):
+        """
+        Fetches the messages kept by the server archive. They're shown as
+        they arrive, like the received ones.
+
+        :param cmd: The command entered by the user.
+        """
+        try:
+            args, options = self._parse_options(
+                cmd.get(input.ARGUMENTS).split(), commands.CMD_OPTION_SINCE)
+        except ValueError:
+            self._output.error("Wrong arguments, see help for details")
+            return
+
+        try:
+            self._chat.fetch_archive(args or None, **options)
+        except Exception as error:
+            self._output.error("Error: " + str(error))
+
+
+    def _cfg_set(self, cmd):
+        args = cmd.get(input.ARGUMENTS).split()
+        self._store.set('account', args[0], args[1])
 
 
     def _cfg_show(self, *unused):
         self._output.message(config.display_configurations(self._cfg))
 
 
-    def display_received_message(self, message):
-        pass
+    def _account_tag(self, account):
+        """
+        Gets the prefix for notifications of an account, which is empty for
+        the active one.
+        """
+        if account == self._account:
+            return ''
+
+        return '{' + str(account) + '} '
+
+
+    def display_received_message(self, sender, message, account=None):
+        """
+        Shows a message received from a contact. It's called from the chat
+        stream thread, while the user may be typing a command.
+
+        :param sender: The contact who sent the message.
+        :param message: The message body.
+        :param account: The account which received the message.
+        """
+        self._output.received(sender, "${FG_CYAN}%s${FG_RESET}"
+                              "[${FG_MAGENTA}%s${FG_RESET}] %s",
+                              self._account_tag(account), sender, message)
+
+
+    def display_presence(self, changes, account=None):
+        """
+        Shows the contacts which changed their presence. It's called from the
+        chat with all the changes of a short period, so a presence storm is
+        shown as a single summary.
+
+        :param changes: A list of (jid, presence.Status) tuples.
+        :param account: The account whose contacts changed.
+        """
+        tag = self._account_tag(account)
+
+        if len(changes) <= PRESENCE_DETAILS:
+            for jid, status in changes:
+                self._output.message("${FG_CYAN}%s${FG_RESET}"
+                                     "${FG_MAGENTA}%s${FG_RESET} is now %s%s",
+                                     tag, jid, status.show,
+                                     ' (' + status.status + ')'
+                                     if status.status else '')
+
+            return
+
+        states = dict()
+
+        for jid, status in changes:
+            states[status.show] = states.get(status.show, 0) + 1
+
+        self._output.message("${FG_CYAN}%s${FG_RESET}%d contacts changed "
+                             "their presence: %s", tag, len(changes),
+                             ', '.join('%d %s' % (count, show)
+                                       for show, count in sorted(
+                                           states.items())))
+
+
+    def display_transfer(self, transfer_, account=None):
+        """
+        Shows the progress of a file transfer. It's called from the transfer
+        thread when the transfer starts, finishes and, in between, about
+        once a second.
+
+        :param transfer_: The transfer.Transfer object.
+        :param account: The account of the transfer.
+        """
+        tag = self._account_tag(account)
+        name = transfer_.filename
+
+        if transfer_.direction == transfer.SEND:
+            action, preposition = 'Sending', 'to'
+        else:
+            action, preposition = 'Receiving', 'from'
+
+        if transfer_.state == transfer.FAILED:
+            self._output.error("%s%s %s %s failed: %s", tag, name,
+                               preposition, transfer_.peer, transfer_.error)
+        elif transfer_.state == transfer.DONE:
+            self._output.message("${FG_CYAN}%s${FG_RESET}%s %s %s: done, "
+                                 "%s at %s/s", tag, name, preposition,
+                                 transfer_.peer,
+                                 _format_size(transfer_.size),
+                                 _format_size(transfer_.rate))
+        else:
+            self._output.message("${FG_CYAN}%s${FG_RESET}%s %s %s %s: "
+                                 "%.1f%% at %s/s", tag, action, name,
+                                 preposition, transfer_.peer,
+                                 transfer_.progress,
+                                 _format_size(transfer_.rate))
+
+
+    def display_broadcast(self, tracker, account=None):
+        """
+        Shows the recipients which a message sent to several contacts failed
+        to reach and a summary of the others, once all of them answered or
+        the receipts timed out.
+
+        :param tracker: The broadcast.Broadcast object.
+        :param account: The account which sent the message.
+        """
+        tag = self._account_tag(account)
+
+        for recipient, (state, reason) in tracker.recipients.items():
+            if state == broadcast.FAILED:
+                self._output.error("%s%s: %s %s", tag, recipient, state,
+                                   reason)
+
+        self._output.message("${FG_CYAN}%s${FG_RESET}Message sent to %d "
+                             "recipients: %d delivered, %d without receipt, "
+                             "%d failed", tag, len(tracker.recipients),
+                             tracker.count(broadcast.DELIVERED),
+                             tracker.count(broadcast.SENT),
+                             tracker.count(broadcast.FAILED))
+
+
+    def display_notification(self, notification, account=None):
+        """
+        Shows a notification from the chat session, such as an authentication
+        failure or a disconnection from the server.
+
+        :param notification: The notification text.
+        :param account: The account of the session.
+        """
+        self._output.message("${FG_CYAN}%s${FG_RESET}${FG_YELLOW}%s${FG_RESET}",
+                             self._account_tag(account), notification)
 
 
     def run(self):
@@ -309,14 +961,78 @@ class Application(object):
 
         :return Returns the command entered by the user.
         """
-        return self._input.readline()
+        cmd = self._input.readline()
+
+        # The end of a batch quits the application
+        if cmd is None and self._batch is not None:
+            self._quit({input.ARGUMENTS: commands.CMD_QUIT_APP})
+
+        return cmd
+
+
+    def finish(self):
+        """
+        Shows a summary of the executed commands, in batch mode, or removes
+        the control socket, in daemon mode.
+
+        :return Returns the application exit status: 1 if any batch command
+                failed or 0 otherwise.
+        """
+        if self._control is not None:
+            self._control.close()
+
+        if self._batch is None or self._daemon:
+            return 0
+
+        self._output.message("%d commands executed, %d failed",
+                             self._commands, self._failed_commands)
+
+        return 1 if self._failed_commands else 0
 
 
     def sync_configuration(self):
         """
-        Writes our internal configuration to the application config file.
+        Writes the configuration changes not written yet to the application
+        config file.
         """
-        config.save(self._cfg)
+        self._watcher.close()
+        self._store.close()
+
+
+    def _config_changed(self, changes):
+        """
+        Applies the changes read from the config file. The logging is set up
+        again and the account changes take effect at the next login. The
+        other parameters are only read at start, so the user is told to
+        restart the application to apply them.
+
+        :param changes: A dict with the changed parameters.
+        """
+        log_changes = [name for name in changes if name.startswith('log_')]
+        applied = [name for name in changes if name in ('account', 'accounts')]
+        ignored = [name for name in changes
+                   if name not in log_changes and name not in applied]
+
+        if log_changes:
+            try:
+                log.start_log(self._cfg.log_filename, self._cfg.log_level,
+                              queued=self._cfg.log_queue,
+                              queue_size=self._cfg.log_queue_size,
+                              max_bytes=self._cfg.log_max_bytes,
+                              backup_count=self._cfg.log_backup_count,
+                              rotate_when=self._cfg.log_rotate_when)
+                applied += log_changes
+            except (IOError, ValueError) as error:
+                self._output.error("Error: unable to restart the log: " +
+                                   str(error))
+
+        if applied:
+            self._output.message("${FG_CYAN}Configuration reloaded"
+                                 "${FG_RESET}: %s", ', '.join(sorted(applied)))
+
+        if ignored:
+            self._output.message("${FG_YELLOW}Restart to apply${FG_RESET}: %s",
+                                 ', '.join(sorted(ignored)))
 
 
     def handle_command(self, cmd):
@@ -327,7 +1043,34 @@ class Application(object):
 
         :param cmd: The previously entered command.
         """
-        if len(cmd.get(input.COMMAND)) < 1:
+        errors = self._output.errors
+
+        # The output of a command from the control socket is sent back
+        if self._control is not None:
+            self._output.capture()
+            self._handle_command(cmd)
+            captured = self._output.release()
+
+            self._control.reply(any(level >= logging.ERROR
+                                    for level, unused in captured),
+                                [plain for unused, plain in captured])
+            return
+
+        self._handle_command(cmd)
+
+        # Errors from the stream threads may be counted too, which is fine
+        # for a summary.
+        if self._batch is not None:
+            self._commands += 1
+
+            if self._output.errors != errors:
+                self._failed_commands += 1
+                logging.error("batch command at line %d failed",
+                              self._input.line_number)
+
+
+    def _handle_command(self, cmd):
+        if not cmd[input.COMMAND]:
             return
 
         try:
@@ -336,33 +1079,7 @@ class Application(object):
             self._output.error(str(error))
             return
 
-        # A list of actions to take on every supported command
-        action = {
-            commands.CMD_HELP: self._help,
-            commands.CMD_LOGIN: self._login,
-            commands.CMD_LOGOUT: self._logout,
-            commands.CMD_REGISTER: self._register,
-            commands.CMD_UNREGISTER: self._unregister,
-            commands.CMD_GROUP: self._group,
-            commands.CMD_CHAT: self._start_chat,
-            commands.CMD_UNCHAT: self._stop_chat,
-            commands.CMD_CONFIG: self._config,
-            commands.CMD_CONTACT: self._contacts,
-            commands.CMD_FILE: self._file,
-            commands.CMD_FILETO: self._fileto,
-            commands.CMD_MSG: self._message,
-            commands.CMD_MSGGR: self._msgto,
-            commands.CMD_MSGTO: self._msgto,
-            commands.CMD_CFG_SET: self._cfg_set,
-            commands.CMD_CFG_SHOW: self._cfg_show,
-            commands.CMD_CLEAR: output.clear,
-            commands.CMD_QUIT: self._quit,
-        }.get(cmd[input.COMMAND], self._unsupported_command)
-
-        if callable(action):
-            action(cmd)
-        else:
-            self._run = action
+        self._actions.get(cmd[input.COMMAND], self._unsupported_command)(cmd)
 
 
 
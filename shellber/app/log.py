@@ -21,7 +21,125 @@
 Module to handle internal logging facility.
 """
 
+import atexit
 import logging
+import logging.handlers
+import Queue
+import threading
+
+# Default values for the queued logging mode
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BACKUP_COUNT = 5
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(process)s:%(module)s:%(message)s'
+
+# The handler installed by start_log and, in the queued mode, its listener
+_handler = None
+_listener = None
+
+class _QueueHandler(logging.Handler):
+    """
+    A logging handler which only puts the records into a bounded queue, to
+    be written by a _QueueListener thread. When the queue is full the record
+    is dropped and counted, instead of blocking the caller.
+
+    :param queue: The queue shared with the listener.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self._queue = queue
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+
+
+    def take_dropped(self):
+        """
+        Gets and resets the number of dropped records.
+        """
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+
+        return dropped
+
+
+    def emit(self, record):
+        try:
+            # Merge the message arguments here, so the listener don't need
+            # any object that may change after this call.
+            record.msg = record.getMessage()
+            record.args = None
+
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+
+                record.exc_info = None
+
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+        except:
+            self.handleError(record)
+
+
+
+class _QueueListener(object):
+    """
+    A thread writing the records from a _QueueHandler into the real
+    handler, so the file I/O never happens on the caller thread.
+
+    :param queue: The queue shared with the handler.
+    :param queue_handler: The _QueueHandler feeding the queue.
+    :param handler: The handler which will write the records.
+    """
+    def __init__(self, queue, queue_handler, handler):
+        self._queue = queue
+        self._queue_handler = queue_handler
+        self._handler = handler
+        self._thread = threading.Thread(name='log', target=self._run)
+        self._thread.daemon = True
+
+
+    def _report_dropped(self):
+        dropped = self._queue_handler.take_dropped()
+
+        if dropped == 0:
+            return
+
+        record = logging.LogRecord('shellber', logging.WARNING, __file__, 0,
+                                   '%d log messages dropped, the log queue '
+                                   'is full', (dropped,), None)
+
+        self._handler.handle(record)
+
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+
+            if record is None:
+                break
+
+            self._report_dropped()
+            self._handler.handle(record)
+
+        self._report_dropped()
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Writes every queued record and stops the listener thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._handler.close()
+
+
 
 def _translate_level(level):
     """
@@ -41,11 +159,93 @@ def _translate_level(level):
 
 
 
-def start_log(filename, level):
-    log_format = '%(asctime)s:%(levelname)s:%(process)s:%(module)s:%(message)s'
-    msg_level = _translate_level(level)
-    logging.basicConfig(filename=filename, level=msg_level,
-                        format=log_format)
+def _file_handler(filename, max_bytes, backup_count, rotate_when):
+    """
+    Creates the handler which writes into the log file, rotating it by size
+    or by time if requested.
+    """
+    # Without a file we log to the standard error, as logging.basicConfig
+    if not filename:
+        return logging.StreamHandler()
+
+    if max_bytes:
+        return logging.handlers.RotatingFileHandler(filename,
+                                                    maxBytes=max_bytes,
+                                                    backupCount=backup_count)
+
+    if rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            filename, when=rotate_when, backupCount=backup_count)
+
+    return logging.FileHandler(filename)
+
+
+
+def stop_log():
+    """
+    Removes the handler installed by start_log. In the queued mode, every
+    queued message is written before returning.
+    """
+    global _handler, _listener
+
+    if _handler is None:
+        return
+
+    logging.getLogger().removeHandler(_handler)
+
+    if _listener is not None:
+        _listener.stop()
+    else:
+        _handler.close()
+
+    _handler = None
+    _listener = None
+
+
+
+def start_log(filename, level, queued=False, queue_size=DEFAULT_QUEUE_SIZE,
+              max_bytes=0, backup_count=DEFAULT_BACKUP_COUNT, rotate_when=''):
+    """
+    Starts the logging facility, replacing a previous one if called again.
+    If the new handler can't be created, such as for a bad file name or
+    rotation interval, the previous one is kept and the error is raised.
+
+    :param filename: The log file.
+    :param level: The log level name, such as: info, debug, etc.
+    :param queued: If True the messages are written by a background thread,
+                   so a slow disk never delays the application.
+    :param queue_size: The maximum number of messages waiting to be written
+                       in the queued mode. Messages above it are dropped.
+    :param max_bytes: Rotates the log file when it reaches this size.
+    :param backup_count: The number of rotated files to keep.
+    :param rotate_when: Rotates the log file at time intervals, using the
+                        logging.handlers.TimedRotatingFileHandler units,
+                        such as: 'midnight', 'h', etc.
+    """
+    global _handler, _listener
+
+    # The new handler is created first, so the previous one is kept if it
+    # can't be.
+    handler = _file_handler(filename, max_bytes, backup_count, rotate_when)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    stop_log()
+
+    if queued:
+        queue = Queue.Queue(queue_size)
+        _handler = _QueueHandler(queue)
+        _listener = _QueueListener(queue, _handler, handler)
+        _listener.start()
+    else:
+        _handler = handler
+
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(_translate_level(level))
+
+
+
+atexit.register(stop_log)
 
 
 
@@ -0,0 +1,345 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to fetch the messages kept by the server in the user archive
+(XEP-0313), such as the ones exchanged while the user was offline.
+"""
+
+import calendar
+import logging
+import threading
+import time
+from collections import deque
+from xml.sax.saxutils import escape
+
+# Number of messages in each page of the archive
+PAGE_SIZE = 100
+
+# Number of conversations fetched at the same time
+CONCURRENCY = 8
+
+# How far back, in seconds, the messages are fetched
+PERIOD = 24 * 60 * 60
+
+# XML namespaces
+NS_MAM = 'urn:xmpp:mam:2'
+NS_RSM = 'http://jabber.org/protocol/rsm'
+NS_FORWARD = 'urn:xmpp:forward:0'
+NS_DELAY = 'urn:xmpp:delay'
+NS_CLIENT = 'jabber:client'
+
+_FIN = '{%s}fin' % NS_MAM
+_LAST = '{%s}set/{%s}last' % (NS_RSM, NS_RSM)
+_FORWARDED = '{%s}forwarded' % NS_FORWARD
+_DELAY = '{%s}delay' % NS_DELAY
+_MESSAGE = '{%s}message' % NS_CLIENT
+_BODY = '{%s}body' % NS_CLIENT
+
+def format_stamp(timestamp):
+    """
+    Formats a timestamp as a XEP-0082 date and time, in UTC.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+
+def parse_stamp(stamp):
+    """
+    Translates a XEP-0082 date and time, such as 2016-05-01T10:30:00.123Z
+    or 2016-05-01T07:30:00-03:00, into a timestamp.
+
+    :return Returns the timestamp or None if the stamp is malformed.
+    """
+    # Every archived message has a stamp, and time.strptime() would take
+    # longer than handling the rest of the message.
+    try:
+        seconds = calendar.timegm((int(stamp[0:4]), int(stamp[5:7]),
+                                   int(stamp[8:10]), int(stamp[11:13]),
+                                   int(stamp[14:16]), int(stamp[17:19]),
+                                   0, 0, 0))
+    except ValueError:
+        return None
+
+    rest = stamp[19:]
+    fraction = ''
+
+    if rest.startswith('.'):
+        fraction = rest[1:].rstrip('Z').split('+')[0].split('-')[0]
+        rest = rest[1 + len(fraction):]
+
+    if fraction.isdigit():
+        seconds += float('0.' + fraction)
+
+    # The offset is the local time minus UTC
+    if len(rest) == 6 and rest[0] in '+-':
+        offset = int(rest[1:3]) * 3600 + int(rest[4:6]) * 60
+        seconds += -offset if rest[0] == '+' else offset
+
+    return seconds
+
+
+
+def query_stanza(query_id, peer, since, after, page_size):
+    """
+    Builds the request for a page of the archive. The same ID is used for
+    the request and for the query, which tags the archived messages.
+
+    :param query_id: The request ID.
+    :param peer: The JID of the conversation.
+    :param since: Only messages from this timestamp on.
+    :param after: The archive ID of the last message of the previous page,
+                  None for the first one.
+    :param page_size: The maximum number of messages in the page.
+
+    :return Returns the serialized stanza.
+    """
+    after = u'<after>%s</after>' % escape(after) if after else u''
+
+    return u'<iq type="set" id="%s"><query xmlns="%s" queryid="%s">' \
+            u'<x xmlns="jabber:x:data" type="submit">' \
+            u'<field var="FORM_TYPE" type="hidden"><value>%s</value></field>' \
+            u'<field var="with"><value>%s</value></field>' \
+            u'<field var="start"><value>%s</value></field></x>' \
+            u'<set xmlns="%s"><max>%d</max>%s</set></query></iq>' % \
+            (query_id, NS_MAM, query_id, NS_MAM, escape(peer),
+             format_stamp(since), NS_RSM, page_size, after)
+
+
+
+class Message(object):
+    """
+    A message read from the archive.
+
+    :param sender: The sender full JID.
+    :param recipient: The recipient full JID.
+    :param stanza_id: The ID of the original stanza.
+    :param body: The message body.
+    :param timestamp: The time the server received the message.
+    """
+    __slots__ = ('sender', 'recipient', 'stanza_id', 'body', 'timestamp')
+
+    def __init__(self, sender, recipient, stanza_id, body, timestamp):
+        self.sender = sender
+        self.recipient = recipient
+        self.stanza_id = stanza_id
+        self.body = body
+        self.timestamp = timestamp
+
+
+    def __repr__(self):
+        return "Message(sender=%r, recipient=%r, timestamp=%r, body=%r)" % \
+                (self.sender, self.recipient, self.timestamp, self.body)
+
+
+
+class _Conversation(object):
+    """
+    The fetch state of a single conversation.
+    """
+    __slots__ = ('peer', 'since', 'after', 'messages')
+
+    def __init__(self, peer, since):
+        self.peer = peer
+        self.since = since
+        self.after = None
+        self.messages = 0
+
+
+
+class Fetch(object):
+    """
+    Fetches the archived messages of several conversations. Each one is
+    read page by page, through Result Set Management (XEP-0059), asking for
+    the next page once the previous one is over, and up to @concurrency
+    conversations are read at the same time. Every message is handed to
+    @handle_message as soon as it arrives, so it's shown and saved while
+    the rest is still being downloaded.
+
+    The stanzas of the fetch are given to it by received() and finished(),
+    from the stream event thread.
+
+    :param prefix: A prefix for the IDs of the requests, unique in the
+                   session.
+    :param conversations: A list of (jid, since) tuples, with the bare JID of
+                          each conversation and the timestamp of the oldest
+                          message to fetch.
+    :param send: A function to be called with a list of serialized stanzas
+                 to send.
+    :param handle_message: A function to be called with every Message.
+    :param handle_done: A function to be called with this object once
+                        every conversation is read.
+    :param page_size: The maximum number of messages in each page.
+    :param concurrency: The maximum number of conversations fetched at the
+                        same time.
+    """
+    def __init__(self, prefix, conversations, send, handle_message,
+                 handle_done, page_size=PAGE_SIZE, concurrency=CONCURRENCY):
+        self.prefix = prefix
+        self.conversations = len(conversations)
+        self.messages = 0
+        self.failed = 0
+        self.started = None
+        self.finished_at = None
+        self._waiting = deque(_Conversation(jid, since)
+                              for jid, since in conversations)
+        self._active = dict()
+        self._sequence = 0
+        self._send = send
+        self._handle_message = handle_message
+        self._handle_done = handle_done
+        self._page_size = page_size
+        self._concurrency = concurrency
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+        return "Fetch(conversations=%r, messages=%r, failed=%r)" % \
+                (self.conversations, self.messages, self.failed)
+
+
+    def _request(self, conversation):
+        """
+        Builds the request for the next page of a conversation. Must be
+        called with the internal lock held.
+        """
+        self._sequence += 1
+        query_id = '%s-%d' % (self.prefix, self._sequence)
+        self._active[query_id] = conversation
+
+        return query_stanza(query_id, conversation.peer, conversation.since,
+                            conversation.after, self._page_size)
+
+
+    def start(self):
+        """
+        Sends the requests for the first conversations.
+        """
+        with self._lock:
+            self.started = time.time()
+            requests = list()
+
+            while self._waiting and len(requests) < self._concurrency:
+                requests.append(self._request(self._waiting.popleft()))
+
+        if requests:
+            self._send(requests)
+        else:
+            self._done()
+
+
+    def received(self, query_id, result):
+        """
+        Handles a message from the archive.
+
+        :param query_id: The query ID of the message.
+        :param result: The XML of its result element.
+        """
+        conversation = self._active.get(query_id)
+
+        if conversation is None:
+            return
+
+        forwarded = result.find(_FORWARDED)
+
+        if forwarded is None:
+            return
+
+        message = forwarded.find(_MESSAGE)
+
+        if message is None:
+            return
+
+        delay = forwarded.find(_DELAY)
+        timestamp = None
+
+        if delay is not None:
+            timestamp = parse_stamp(delay.get('stamp', ''))
+
+        conversation.after = result.get('id')
+        conversation.messages += 1
+        self.messages += 1
+
+        body = message.findtext(_BODY)
+
+        # Group messages are kept by the archive of each group
+        if body and message.get('type') != 'groupchat':
+            self._handle_message(Message(message.get('from', ''),
+                                         message.get('to', ''),
+                                         message.get('id', ''), body,
+                                         timestamp or time.time()))
+
+
+    def finished(self, query_id, iq):
+        """
+        Handles the answer to a page request, which comes after every
+        message of the page.
+
+        :param query_id: The request ID.
+        :param iq: The XML of the answer.
+        """
+        with self._lock:
+            conversation = self._active.pop(query_id, None)
+
+            if conversation is None:
+                return
+
+            fin = iq.find(_FIN)
+
+            if iq.get('type') != 'result' or fin is None:
+                logging.warning("Unable to fetch the archive of %s",
+                                conversation.peer)
+                self.failed += 1
+                conversation = None
+            else:
+                last = fin.findtext(_LAST)
+
+                if last:
+                    conversation.after = last
+
+                # Servers which don't tell if the result is complete end it
+                # with a page that isn't full.
+                if fin.get('complete') in ('true', '1') or not last:
+                    conversation = None
+
+            if conversation is None and self._waiting:
+                conversation = self._waiting.popleft()
+
+            request = None
+
+            if conversation is not None:
+                request = self._request(conversation)
+
+            done = not self._active
+
+        if request is not None:
+            self._send([request])
+        elif done:
+            self._done()
+
+
+    def _done(self):
+        self.finished_at = time.time()
+        self._handle_done(self)
+
+
+    def owns(self, query_id):
+        """
+        Tells if a request or query ID belongs to this fetch.
+        """
+        return query_id in self._active
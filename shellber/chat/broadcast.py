@@ -0,0 +1,186 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to keep track of a message sent to several recipients at once.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Time, in seconds, to wait for the delivery receipts of a broadcast
+DELIVERY_TIMEOUT = 30
+
+# Recipient states
+SENT = 'sent'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+def load_recipients(filename):
+    """
+    Reads a recipient list file, with one JID per line. Empty lines and
+    lines starting with # are ignored.
+
+    :param filename: The file name.
+
+    :return Returns a list of JIDs.
+    """
+    recipients = list()
+
+    with open(filename) as fd:
+        for line in fd:
+            line = line.strip()
+
+            if line and not line.startswith('#'):
+                recipients.append(line)
+
+    return recipients
+
+
+
+class Broadcast(object):
+    """
+    The delivery state of a message sent to several recipients. Every
+    recipient starts as SENT, when its stanza is queued, and becomes
+    DELIVERED when its delivery receipt (XEP-0184) arrives or FAILED when
+    the message bounces. @handle_report is called once, when every recipient
+    has an answer or after @timeout seconds, but never before start(), as
+    answers may arrive while the stanzas are still being queued. Recipients
+    whose clients don't support receipts remain as SENT.
+
+    :param message: The message body.
+    :param handle_report: A function to be called with this object.
+    :param timeout: The time, in seconds, to wait for the receipts.
+    """
+    def __init__(self, message, handle_report, timeout=DELIVERY_TIMEOUT):
+        self.message = message
+        self.recipients = OrderedDict()
+        self._handle_report = handle_report
+        self._timeout = timeout
+        self._ids = dict()
+        self._waiting = 0
+        self._timer = None
+        self._started = False
+        self._reported = False
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+        return "Broadcast(recipients=%r)" % self.recipients
+
+
+    def sent(self, stanza_id, recipient):
+        """
+        Tells that the message was queued to a recipient.
+
+        :param stanza_id: The message stanza ID.
+        :param recipient: The recipient JID.
+        """
+        with self._lock:
+            self._ids[stanza_id] = recipient
+            self.recipients[recipient] = (SENT, '')
+            self._waiting += 1
+
+
+    def failed(self, recipient, reason):
+        """
+        Tells that the message could not be sent to a recipient.
+
+        :param recipient: The recipient JID.
+        :param reason: The failure reason.
+        """
+        with self._lock:
+            self.recipients[recipient] = (FAILED, reason)
+
+
+    def start(self):
+        """
+        Starts to wait for the receipts, once every stanza is queued.
+        """
+        with self._lock:
+            self._started = True
+
+            if self._waiting:
+                self._timer = threading.Timer(self._timeout, self.report)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+
+        self.report()
+
+
+    def answer(self, stanza_id, state, reason=''):
+        """
+        Sets the answer of a recipient, from a receipt or a bounce.
+
+        :param stanza_id: The ID of the answered message stanza.
+        :param state: DELIVERED or FAILED.
+        :param reason: The failure reason.
+
+        :return Returns True if every recipient has an answer.
+        """
+        with self._lock:
+            recipient = self._ids.pop(stanza_id, None)
+
+            if recipient is None:
+                return False
+
+            self.recipients[recipient] = (state, reason)
+            self._waiting -= 1
+            done = self._waiting == 0
+
+            # Otherwise start() reports it
+            report = done and self._started
+
+        if report:
+            self.report()
+
+        return done
+
+
+    def ids(self):
+        """
+        Gets the stanza IDs still waiting for an answer.
+        """
+        with self._lock:
+            return self._ids.keys()
+
+
+    def count(self, state):
+        """
+        Gets the number of recipients in a state.
+        """
+        with self._lock:
+            return sum(1 for s, _ in self.recipients.itervalues()
+                       if s == state)
+
+
+    def report(self):
+        """
+        Reports the recipients state. Only the first call has any effect.
+        """
+        with self._lock:
+            if self._reported:
+                return
+
+            self._reported = True
+
+            if self._timer is not None:
+                self._timer.cancel()
+
+        self._handle_report(self)
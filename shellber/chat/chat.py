@@ -21,18 +21,1383 @@
 A module to handle chat between users.
 """
 
+import atexit
 import logging
+import os
+import Queue
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+from shellber.chat import archive
+from shellber.chat import broadcast
+from shellber.chat import compat
+from shellber.chat import history
+from shellber.chat import muc
+from shellber.chat import presence
+from shellber.chat import roster
+from shellber.chat import spool
+from shellber.chat import transfer
+
+# Maximum number of parsed stanzas waiting to be handled
+STANZA_HIGH_WATER = 1024
+
+# Maximum number of outgoing stanzas waiting to be written
+SEND_HIGH_WATER = 512
+
+# Maximum size of a single coalesced write
+SEND_BATCH_SIZE = 65536
+
+# Time, in seconds, which a sender waits for room in the send queue
+SEND_TIMEOUT = 10
+
+# Time, in seconds, to wait for the stream negotiation and the authentication
+SESSION_TIMEOUT = 30
+
+# Number of spooled messages sent between two checks that the server got
+# them, and the number of checks which may be pending at once
+REPLAY_BATCH_SIZE = 512
+REPLAY_WINDOW = 4
+
+# Time, in seconds, which the replay waits for the spool writer or for the
+# pending checks
+REPLAY_INTERVAL = 0.05
+
+# Number of received message IDs kept to drop repeated messages
+RECEIVED_IDS = 1024
+
+# Maximum delay, in seconds, before the first attempt to reconnect a dropped
+# session. The maximum doubles at every failed attempt, up to
+# RECONNECT_MAX_DELAY, and the actual delay is a random value below it, so
+# the clients dropped together don't come back together.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 300
+
+# Number of outgoing stanzas between two stream management (XEP-0198) ack
+# requests
+SM_ACK_WINDOW = 32
+
+# Stream management sequence numbers wrap at 2^32
+_SM_MAX_SEQ = 2 ** 32
+
+# Time, in seconds, by which the archive fetch of a conversation starts
+# before its last message in the history, as the server and local clocks
+# don't agree. The messages of this overlap already in the history are
+# dropped.
+ARCHIVE_OVERLAP = 60
+
+# The tags of the top level stanzas
+_PRESENCE_TAG = '{jabber:client}presence'
+_MESSAGE_TAG = '{jabber:client}message'
+_IQ_TAG = '{jabber:client}iq'
+
+# The path of a message from the archive (XEP-0313) in a message
+_ARCHIVE_RESULT = '{%s}result' % archive.NS_MAM
+
+# The time a message was sent at, when it was delayed (XEP-0203)
+_DELAY = '{%s}delay' % archive.NS_DELAY
+
+# The path of the invitation to a group (XEP-0045) in a message
+_INVITE = '{%s}x/{%s}invite' % (muc.NS_MUC_USER, muc.NS_MUC_USER)
+
+# The SleekXMPP thread which parses the incoming stream
+_READ_THREAD = 'read_thread'
+
+# The thread which runs the events of every session
+_LOOP_THREAD = 'event_loop'
+
+# SleekXMPP takes about as long to import as everything else together, so
+# it's only loaded by the first login. Commands which don't need a session,
+# such as help or the config environment, start without it.
+sleekxmpp = None
+
+def _load_sleekxmpp():
+    global sleekxmpp
+
+    if sleekxmpp is None:
+        import sleekxmpp as module
+        compat.check(module)
+        sleekxmpp = module
+
+
+
+def _peer(jid):
+    """
+    Gets the key of a contact or group in the history, its bare JID in
+    lowercase, as the messages are saved.
+    """
+    return sleekxmpp.JID(jid).bare.lower()
+
+
+
+class _StanzaQueue(Queue.Queue):
+    """
+    A replacement for the SleekXMPP event queue. The stream parser already
+    drops every stanza subtree after dispatching it, but the dispatched
+    stanzas wait here until the event loop handles them. Under a flood of
+    incoming traffic the parser is faster than the handlers, so we make only
+    the stream reader wait when the queue is above @high_water. This lets
+    TCP flow control hold the pending data at the server side and keeps our
+    memory usage flat. Any other thread, such as the event loop itself, is
+    never blocked here.
+
+    :param high_water: The maximum number of queued stanzas.
+    :param stop: A threading.Event telling that the stream is going down.
+    :param ready: A function called after every put, see _EventLoop.
+    """
+    def __init__(self, high_water, stop, ready):
+        Queue.Queue.__init__(self)
+        self._high_water = high_water
+        self._stop = stop
+        self._ready = ready
+
+
+    def put(self, item, block=True, timeout=None):
+        if threading.current_thread().name == _READ_THREAD:
+            with self.not_full:
+                while self._qsize() >= self._high_water and \
+                        not self._stop.is_set():
+                    self.not_full.wait(0.1)
+
+        Queue.Queue.put(self, item, block, timeout)
+        self._ready()
+
+
+
+class _EventLoop(object):
+    """
+    Runs the events of every session in a single thread, instead of the
+    event thread SleekXMPP starts for each one. Each session keeps its own
+    event queue, which tells the loop about every event put in it, so the
+    events of a session run in order and the sessions take turns. The tasks
+    of every session are timed by a single SleekXMPP scheduler, whose thread
+    puts them in the session queue when they're due. Timed waits poll in
+    Python 2, so the loop itself only waits for the queues.
+
+    Each session is left with the SleekXMPP threads which read and write
+    its stream, since they block on its socket.
+    """
+    def __init__(self):
+        self._ready = Queue.Queue()
+        self._stop = threading.Event()
+        self.scheduler = sleekxmpp.xmlstream.Scheduler(self._stop)
+        self.scheduler.process(threaded=True, daemon=True)
+
+        self._thread = threading.Thread(name=_LOOP_THREAD, target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        # Both threads are stopped before the interpreter goes down
+        # under them, once the stream threads are done.
+        atexit.register(self._close)
+
+
+    def ready(self, xmpp, queue):
+        """
+        Tells the loop about an event put in the queue of a session.
+
+        :param xmpp: The sleekxmpp.ClientXMPP object of the session.
+        :param queue: Its event queue.
+        """
+        self._ready.put((xmpp, queue))
+
+
+    def _close(self):
+        self._stop.set()
+        self.scheduler.addq.put(None)
+        self._ready.put(None)
+        self.scheduler.thread.join()
+        self._thread.join()
+
+
+    def _run(self):
+        while True:
+            ready = self._ready.get()
+
+            if ready is None:
+                return
+
+            xmpp, queue = ready
+
+            try:
+                event = queue.get_nowait()
+            except Queue.Empty:
+                continue
+
+            # The events left by a stopped client are dropped, as its event
+            # thread did.
+            if xmpp.stop.is_set():
+                continue
+
+            try:
+                compat.run_event(xmpp, event)
+            except Exception:
+                logging.exception("Error running an event of %s", xmpp.jid)
+
+
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def _get_event_loop():
+    """
+    Gets the event loop shared by the sessions, started by the first login.
+    """
+    global _event_loop
+
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = _EventLoop()
+
+    return _event_loop
+
+
+
+class _SendQueue(Queue.Queue):
+    """
+    A replacement for the SleekXMPP send queue. Every time the send thread
+    wakes up it receives all the stanzas queued so far, up to @batch_size
+    bytes, joined together, so a burst of messages is written to the socket
+    with a single call instead of one call per stanza.
+
+    Senders should call wait_for_room() before queueing, so they wait for
+    the send thread when there are already @high_water stanzas pending.
+
+    :param high_water: The maximum number of pending stanzas.
+    :param batch_size: The maximum number of bytes in a single write.
+    :param session: The threading.Event set while there's a session.
+    """
+    def __init__(self, high_water, batch_size, session):
+        Queue.Queue.__init__(self)
+        self._high_water = high_water
+        self._batch_size = batch_size
+        self._session = session
+        self._batch = 1
+
+
+    def wait_for_room(self, timeout):
+        """
+        Waits until the queue is below its high water mark.
+
+        :param timeout: The maximum time to wait, in seconds.
+
+        :return Returns True if a stanza may be queued or False otherwise.
+        """
+        with self.not_full:
+            if self._qsize() >= self._high_water:
+                self.not_full.wait(timeout)
+
+            return self._qsize() < self._high_water
+
+
+    def get(self, block=True, timeout=None):
+        data = Queue.Queue.get(self, block, timeout)
+        self._batch = 1
+
+        # None is the stop mark for the send thread
+        if data is None:
+            return data
+
+        # A send thread already waiting here when the session went down
+        # would drop the stanza, so it's kept until the next session and the
+        # thread goes back to wait for it.
+        if self._session.is_set() is False:
+            with self.mutex:
+                self.queue.appendleft(data)
+                self.not_empty.notify()
+
+            return None
+
+        batch = [data]
+        size = len(data)
+
+        with self.mutex:
+            while self.queue and self.queue[0] is not None and \
+                    size < self._batch_size:
+                data = self._get()
+                batch.append(data)
+                size += len(data)
+
+            self.not_full.notify()
+
+        self._batch = len(batch)
+
+        return ''.join(batch)
+
+
+    def task_done(self):
+        # The send thread marks a whole batch as done at once
+        for _ in range(self._batch):
+            Queue.Queue.task_done(self)
+
+
+    def clear(self):
+        """
+        Drops every pending stanza, keeping the stop mark, if there's one.
+        """
+        with self.mutex:
+            stop = None in self.queue
+            dropped = len(self.queue) - stop
+            self.queue.clear()
+
+            if stop:
+                self.queue.append(None)
+
+            self.unfinished_tasks -= dropped
+
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+
+            self.not_full.notify_all()
+
+
+
+class _Spooled(unicode):
+    """
+    A serialized stanza replayed from the spool. Stream management keeps it
+    to be sent again when the stream is resumed, but not when the session
+    starts over, since the replay also starts over then.
+    """
+    __slots__ = ()
+
+
 
 class Chat(object):
-    def __init__(self, handle_received_message):
+    """
+    A class to hold a XMPP session with a server. All the network traffic is
+    handled by the SleekXMPP stream threads, so none of its methods block the
+    application while waiting for the server. Received messages are delivered
+    through the @handle_received_message callback, from the stream thread.
+
+    :param handle_received_message: A function to be called with the sender
+                                    and the body of every received message.
+    :param handle_notification: An optional function to be called with
+                                session notifications, such as an
+                                authentication failure.
+    :param send_high_water: The maximum number of outgoing stanzas waiting to
+                            be written before message() starts to wait.
+    :param history_directory: The directory where the message history of
+                              each account is saved. If omitted, no history
+                              is kept.
+    :param roster_directory: The directory where the roster of each account
+                             is saved. If omitted, the whole roster is
+                             downloaded at every login.
+    :param handle_presence: An optional function to be called with a list of
+                            (jid, presence.Status) tuples, when contacts
+                            change their presence. Changes are gathered and
+                            reported together, see presence.Presences.
+    :param download_directory: The directory where files received from the
+                               contacts are saved. If omitted, no file is
+                               accepted.
+    :param handle_transfer: An optional function to be called with a
+                            transfer.Transfer object to report the progress
+                            of file transfers.
+    :param handle_broadcast: An optional function to be called with a
+                             broadcast.Broadcast object when the recipients
+                             of a broadcast() answer or time out.
+    :param spool_directory: The directory where the messages sent while the
+                            session is down are kept until they can be sent.
+                            If omitted, message() fails without a session.
+    :param group_history: The maximum number of old messages sent by a group
+                          when it's joined.
+    :param archive_page_size: The maximum number of messages in each page
+                              read from the server archive.
+    :param archive_concurrency: The maximum number of conversations read
+                                from the server archive at the same time.
+    """
+    def __init__(self, handle_received_message, handle_notification=None,
+                 send_high_water=SEND_HIGH_WATER, history_directory=None,
+                 roster_directory=None, handle_presence=None,
+                 download_directory=None, handle_transfer=None,
+                 handle_broadcast=None, spool_directory=None,
+                 group_history=muc.HISTORY_STANZAS,
+                 archive_page_size=archive.PAGE_SIZE,
+                 archive_concurrency=archive.CONCURRENCY):
         self._connected = False
+        self._send_high_water = send_high_water
+        self._history_directory = history_directory
+        self._history = None
+        self._roster_directory = roster_directory
+        self._roster = None
+        self._presences = presence.Presences(self._presence_changes)
+        self._state = presence.AVAILABLE
+        self._status = ''
+        self._invisible = False
+        self._transfers = transfer.Transfers(handle_transfer,
+                                             download_directory)
+        self._broadcasts = dict()
+        self._broadcasts_lock = threading.Lock()
+        self._handle_broadcast = handle_broadcast
+        self._spool_directory = spool_directory
+        self._spool = None
+        self._spooling = False
+        self._spool_lock = threading.Lock()
+        self._session_number = 0
+        self._replay_epoch = 0
+        self._reconnect_delay = RECONNECT_DELAY
+        self._unacked = list()
+        self._received = OrderedDict()
+        self._rooms = dict()
+        self._group_history = group_history
+        self._fetches = dict()
+        self._archive_known = dict()
+        self._archive_page_size = archive_page_size
+        self._archive_concurrency = archive_concurrency
         self._password = ''
+        self._session_event = threading.Event()
+        self._xmpp = None
         self.username = ''
         self.server = ''
         self.host = ''
         self.ID = ''
         self.contact = ''
         self._handle_received_message = handle_received_message
+        self._handle_notification = handle_notification
+        self._handle_presence = handle_presence
+
+
+    def _notify(self, notification):
+        logging.info("%s", notification)
+
+        if self._handle_notification is not None:
+            self._handle_notification(notification)
+
+
+    def _start_replay(self, rewind):
+        """
+        Starts sending the spooled messages, if there are any, in a new
+        session.
+
+        :param rewind: Indicates if the messages already sent, but not
+                       acknowledged, must be sent again. A resumed stream
+                       sends them by itself.
+        """
+        with self._spool_lock:
+            self._session_number += 1
+
+            # Answers to the pings of a previous replay are meaningless
+            # once it starts over.
+            if rewind:
+                self._replay_epoch += 1
+
+            if self._spooling:
+                if rewind:
+                    self._spool.rewind()
+
+                thread = threading.Thread(name='replay', target=self._replay,
+                                          args=(self._xmpp, self._spool,
+                                                self._session_number,
+                                                self._replay_epoch))
+                thread.daemon = True
+                thread.start()
+
+
+    def _session_start(self, event):
+        self._invisible = False
+
+        # A new session gets every presence again
+        self._presences.clear()
+        self._send_presence()
+        self._xmpp.get_roster(block=False)
+
+        # Messages left without an ack by a stream which couldn't be resumed
+        unacked, self._unacked = self._unacked, list()
+
+        for data in unacked:
+            if isinstance(data, unicode):
+                self._send_stanzas(self._xmpp, [data])
+            else:
+                self._xmpp.send(data)
+
+        # A resumed stream keeps its groups, a new session joins them again
+        self._join_rooms(self._rooms.values())
+
+        # The fetches of the previous session won't be answered anymore, and
+        # the new one catches up with the conversations of the history.
+        self._fetches.clear()
+        self._archive_known.clear()
+
+        if self._history is not None:
+            self._fetch_archive()
+
+        self._start_replay(rewind=True)
+        self._reconnect_delay = RECONNECT_DELAY
+        self._session_event.set()
+        self._notify("Session started as " + self._xmpp.boundjid.full)
+
+
+    def _session_resumed(self, event):
+        self._start_replay(rewind=False)
+        self._reconnect_delay = RECONNECT_DELAY
+        self._session_event.set()
+        self._notify("Session resumed as " + self._xmpp.boundjid.full)
+
+
+    def _failed_auth(self, event):
+        self._session_event.set()
+        self._notify("Authentication failed")
+
+
+    def _disconnected(self, event):
+        self._session_event.set()
+
+        # Messages go to the spool until the next session
+        with self._spool_lock:
+            self._spooling = self._spool is not None
+
+        xmpp = self._xmpp
+
+        # The stream threads keep trying to reconnect, see _reconnect()
+        if self._connected and xmpp is not None and xmpp.auto_reconnect:
+            self._notify("Connection to %s lost, reconnecting" % self.server)
+            return
+
+        # The client is done, its repeated tasks would outlive it in the
+        # shared scheduler.
+        if xmpp is not None:
+            compat.clear_tasks(xmpp)
+
+        if self._connected:
+            self._connected = False
+            self.contact = ''
+            self._presences.clear()
+            self._rooms.clear()
+            self._fetches.clear()
+            self._notify("Disconnected from " + self.server)
+
+            if self._roster is not None:
+                self._roster.flush()
+
+
+    def _roster_update(self, iq):
+        if self._roster is None:
+            return
+
+        # A result with the roster means the server has sent all of it,
+        # instead of only the changes since our version.
+        query = iq.xml.find('{jabber:iq:roster}query')
+
+        if iq['type'] == 'result' and query is not None:
+            # Read the JIDs straight from the XML, iq['roster']['items']
+            # would parse every item of a large roster a second time.
+            jids = [item.get('jid', '').lower()
+                    for item in query.findall('{jabber:iq:roster}item')]
+
+            for jid in self._roster.retain(jids):
+                del self._xmpp.client_roster[jid]
+
+        self._roster.flush()
+
+
+    def _presence(self, pres):
+        if pres['type'] not in ('available', 'unavailable') and \
+                pres['type'] not in pres.showtypes:
+            return
+
+        # The sender is split here instead of using pres['from'], as
+        # building JID objects dominates the cost of a presence storm.
+        jid, _, resource = pres.xml.get('from', '').partition('/')
+        jid = jid.lower()
+
+        # Our own resources aren't contacts
+        if jid == self._xmpp.boundjid.bare:
+            return
+
+        if pres['type'] == 'unavailable':
+            self._presences.remove(jid, resource)
+        else:
+            self._presences.update(jid, resource, pres['show'],
+                                   pres['status'], pres['priority'])
+
+
+    def _filter_room_presence(self, stanza):
+        """
+        Takes the presences of the group occupants out of the incoming
+        stanzas. A group sends one for each of its occupants when it's
+        joined, and SleekXMPP would match every one of them against all its
+        handlers, which costs far more than handling them. They go straight
+        to the event queue instead, still in order with the other stanzas.
+
+        :param stanza: The incoming stanza.
+
+        :return Returns the stanza, or None if it was taken.
+        """
+        if stanza.xml.tag != _PRESENCE_TAG:
+            return stanza
+
+        jid, _, nick = stanza.xml.get('from', '').partition('/')
+        room = self._rooms.get(jid.lower())
+
+        if room is None:
+            return stanza
+
+        self._xmpp.event_queue.put(('schedule', self._room_presence,
+                                    (room, nick, stanza), {},
+                                    'Group presence'))
+
+
+    def _room_presence(self, room, nick, pres):
+        """
+        Handles the presence of a group occupant, see
+        _filter_room_presence(). It's read straight from the XML, without
+        the SleekXMPP stanza interfaces.
+
+        :param room: The muc.Room object.
+        :param nick: The occupant nick.
+        :param pres: The presence stanza.
+        """
+        xml = pres.xml
+        ptype = xml.get('type')
+
+        if ptype == 'error':
+            if room.state == muc.JOINING:
+                self._rooms.pop(room.jid, None)
+                self._notify("Unable to join %s: %s" %
+                             (room.jid, pres['error']['condition']))
+
+            return
+
+        x = xml.find('{%s}x' % muc.NS_MUC_USER)
+        item = None
+        codes = ()
+
+        if x is not None:
+            item = x.find('{%s}item' % muc.NS_MUC_USER)
+            codes = [status.get('code')
+                     for status in x.findall('{%s}status' % muc.NS_MUC_USER)]
+
+        if item is None:
+            item = dict()
+
+        own = muc.STATUS_SELF in codes or nick == room.nick
+
+        if ptype == 'unavailable':
+            if muc.STATUS_NICK_CHANGED in codes and item.get('nick'):
+                room.rename(nick, item.get('nick'))
+                return
+
+            room.remove(nick)
+
+            if own:
+                self._rooms.pop(room.jid, None)
+
+                if muc.STATUS_BANNED in codes:
+                    self._notify("Banned from " + room.jid)
+                elif muc.STATUS_KICKED in codes:
+                    self._notify("Kicked from " + room.jid)
+                else:
+                    self._notify("Left " + room.jid)
+
+            return
+
+        if ptype is not None:
+            return
+
+        namespace = self._xmpp.default_ns
+        room.update(nick, item.get('jid'), item.get('role'),
+                    item.get('affiliation'),
+                    xml.findtext('{%s}show' % namespace) or presence.AVAILABLE,
+                    xml.findtext('{%s}status' % namespace) or '')
+
+        if own is False or room.state != muc.JOINING:
+            return
+
+        # Our own presence comes after everyone else's
+        room.state = muc.JOINED
+        create, room.create = room.create, False
+
+        if muc.STATUS_CREATED in codes:
+            # A new room is locked until it's configured
+            self._send_stanzas(self._xmpp,
+                               [muc.instant_stanza(room, self._xmpp.new_id())])
+            self._notify("Created " + room.jid)
+        elif create:
+            self._notify("%s already exists, joined as %s" % (room.jid,
+                                                              room.nick))
+        else:
+            self._notify("Joined %s as %s, %d occupants" % (room.jid,
+                                                            room.nick,
+                                                            len(room)))
+
+
+    def _join_rooms(self, rooms):
+        """
+        Joins groups. The presences joining all of them are sent together,
+        without waiting for any answer, so joining many groups takes about
+        as long as joining the slowest. Each group only sends back the
+        messages after the last one in the local history, up to
+        @group_history of them.
+
+        :param rooms: The muc.Room objects.
+        """
+        stanzas = list()
+
+        for room in rooms:
+            room.clear()
+            since = None
+
+            if self._history is not None:
+                for message in self._history.lookup(room.jid, limit=1):
+                    since = message.timestamp
+
+            stanzas.append(muc.join_stanza(room, self._group_history, since))
+
+        if stanzas:
+            self._send_stanzas(self._xmpp, stanzas)
+
+
+    def _filter_archive(self, stanza):
+        """
+        Takes the messages and answers of the archive fetches out of the
+        incoming stanzas, as _filter_room_presence() does for the group
+        presences. A fetch gets thousands of them, which would only be
+        matched against every SleekXMPP handler to no use.
+
+        :param stanza: The incoming stanza.
+
+        :return Returns the stanza, or None if it was taken.
+        """
+        xml = stanza.xml
+
+        if xml.tag == _MESSAGE_TAG:
+            result = xml.find(_ARCHIVE_RESULT)
+
+            if result is None:
+                return stanza
+
+            query_id = result.get('queryid', '')
+        elif xml.tag == _IQ_TAG and xml.get('type') in ('result', 'error'):
+            result = xml
+            query_id = xml.get('id', '')
+        else:
+            return stanza
+
+        fetch = self._fetches.get(query_id.rpartition('-')[0])
+
+        if fetch is None or fetch.owns(query_id) is False:
+            return stanza
+
+        # Only our own server may answer for our archive
+        sender = xml.get('from')
+
+        if sender and sender.lower() != self._xmpp.boundjid.bare:
+            return stanza
+
+        if xml.tag == _MESSAGE_TAG:
+            handler = fetch.received
+        else:
+            handler = fetch.finished
+
+        self._xmpp.event_queue.put(('schedule', handler, (query_id, result),
+                                    {}, 'Archive'))
+
+
+    def _archived(self, message):
+        """
+        Handles a message from the archive, as soon as it arrives. It's saved
+        in the history and, if it was received, delivered as well.
+
+        :param message: The archive.Message object.
+        """
+        sender = message.sender.partition('/')[0].lower()
+
+        # Messages sent by any of our resources are archived too
+        if sender == self._xmpp.boundjid.bare:
+            peer = message.recipient.partition('/')[0].lower()
+            direction = history.OUTGOING
+        else:
+            peer = sender
+            direction = history.INCOMING
+
+        # The server also delivers the messages received while we were
+        # offline, which are archived as well.
+        if message.stanza_id:
+            key = (sender, message.stanza_id)
+
+            if key in self._received:
+                return
+
+            self._received[key] = None
+
+            if len(self._received) > RECEIVED_IDS:
+                self._received.popitem(last=False)
+
+        known = self._archive_known.get(peer)
+
+        if known and known[(direction, message.body)] > 0:
+            known[(direction, message.body)] -= 1
+            return
+
+        if self._history is not None:
+            self._history.append(peer, direction,
+                                 sender if direction == history.INCOMING
+                                 else message.sender, message.body,
+                                 message.timestamp)
+
+        if direction == history.INCOMING:
+            self._handle_received_message(peer, message.body)
+
+
+    def _archive_done(self, fetch):
+        self._fetches.pop(fetch.prefix, None)
+
+        if not self._fetches:
+            self._archive_known.clear()
+
+        if fetch.failed:
+            self._notify("Fetched %d messages from the archive, %d of %d "
+                         "conversations failed" % (fetch.messages,
+                                                   fetch.failed,
+                                                   fetch.conversations))
+        elif fetch.conversations:
+            self._notify("Fetched %d messages from %d conversations in %.2f "
+                         "seconds" % (fetch.messages, fetch.conversations,
+                                      fetch.finished_at - fetch.started))
+
+
+    def _fetch_archive(self, peers=None, since=None):
+        """
+        Starts an archive fetch, see fetch_archive().
+        """
+        oldest = time.time() - archive.PERIOD
+        last = dict()
+
+        if self._history is not None:
+            # The messages still queued count as well
+            self._history.flush()
+
+            if peers is None:
+                last = dict(self._history.conversations(oldest))
+            else:
+                for peer in peers:
+                    for message in self._history.lookup(peer, limit=1):
+                        last[peer] = message.timestamp
+
+        if peers is None:
+            # Groups have their own history, see _join_rooms()
+            peers = [peer for peer in last if peer not in self._rooms]
+
+        conversations = list()
+
+        for peer in peers:
+            if since is not None:
+                start = since
+            elif peer in last:
+                start = last[peer] - ARCHIVE_OVERLAP
+            else:
+                start = oldest
+
+            # Messages already in the history aren't fetched twice
+            if self._history is not None and peer in last:
+                self._archive_known[peer] = Counter(
+                    (message.direction, message.body)
+                    for message in self._history.lookup(peer, since=start))
+
+            conversations.append((peer, start))
+
+        xmpp = self._xmpp
+        fetch = archive.Fetch(xmpp.new_id(), conversations,
+                              lambda stanzas: self._send_stanzas(xmpp,
+                                                                 stanzas),
+                              self._archived, self._archive_done,
+                              self._archive_page_size,
+                              self._archive_concurrency)
+
+        self._fetches[fetch.prefix] = fetch
+        fetch.start()
+
+        return fetch
+
+
+    def _presence_changes(self, changes):
+        if self._handle_presence is not None:
+            self._handle_presence(changes)
+
+
+    def _send_presence(self):
+        """
+        Sends the user presence, as set by set_presence().
+        """
+        if self._state == presence.INVISIBLE:
+            self._xmpp['xep_0186'].set_invisible(block=False)
+            self._invisible = True
+            return
+
+        # An invisible session must become visible before sending presence
+        if self._invisible:
+            self._xmpp['xep_0186'].set_visible(block=False)
+            self._invisible = False
+
+        if self._state == presence.OFFLINE:
+            self._xmpp.send_presence(ptype='unavailable',
+                                     pstatus=self._status or None)
+        elif self._state in (presence.AWAY, presence.CHAT):
+            self._xmpp.send_presence(pshow=self._state,
+                                     pstatus=self._status or None)
+        else:
+            self._xmpp.send_presence(pstatus=self._status or None)
+
+
+    def _answer_broadcast(self, stanza_id, state, reason=''):
+        with self._broadcasts_lock:
+            tracker = self._broadcasts.pop(stanza_id, None)
+
+        if tracker is not None:
+            tracker.answer(stanza_id, state, reason)
+
+
+    def _broadcast_report(self, tracker):
+        with self._broadcasts_lock:
+            for stanza_id in tracker.ids():
+                self._broadcasts.pop(stanza_id, None)
+
+        if self._handle_broadcast is not None:
+            self._handle_broadcast(tracker)
+
+
+    def _receipt(self, msg):
+        self._answer_broadcast(msg['receipt'], broadcast.DELIVERED)
+
+
+    def _bounce(self, msg):
+        self._answer_broadcast(msg['id'], broadcast.FAILED,
+                               msg['error']['condition'])
+
+
+    def _replay(self, xmpp, spool_, session, epoch):
+        """
+        Sends the spooled messages, in order, with their spooled IDs. After
+        each batch we ping the server, and since it handles the stanzas of a
+        stream in order, its answer tells that it got the whole batch, which
+        is then removed from the spool. A few batches are sent ahead of the
+        answers. New messages are spooled as well until the spool is empty,
+        so they can't be sent before the older ones.
+
+        :param xmpp: The sleekxmpp.ClientXMPP object.
+        :param spool_: The spool.Spool object.
+        :param session: The number of the session which started the replay.
+        :param epoch: The replay epoch, which changes when the replay starts
+                      over.
+        """
+        window = Queue.Queue(REPLAY_WINDOW)
+
+        def received(offset, count):
+            if epoch == self._replay_epoch:
+                spool_.ack(offset, count)
+
+            window.get_nowait()
+
+        # The next session, if any, has its own replay
+        def active():
+            return session == self._session_number and \
+                    self._spool is spool_ and \
+                    xmpp.session_started_event.is_set()
+
+        while True:
+            try:
+                window.put(None, timeout=REPLAY_INTERVAL)
+            except Queue.Full:
+                if active():
+                    continue
+
+                return
+
+            with self._spool_lock:
+                if active() is False:
+                    return
+
+                if spool_.pending() == 0:
+                    self._spooling = False
+                    logging.info("Spooled messages sent")
+                    return
+
+                messages, offset = spool_.read(REPLAY_BATCH_SIZE)
+
+                # Sent along with the read, so a session starting over in
+                # between can't get a batch it will also read.
+                if messages:
+                    self._send_stanzas(xmpp, [_Spooled(m.decode('utf-8'))
+                                              for m in messages])
+
+            if not messages:
+                # The rest is either being written or waiting for the server
+                window.get_nowait()
+                time.sleep(REPLAY_INTERVAL)
+                continue
+
+            xmpp['xep_0199'].send_ping(
+                xmpp.boundjid.domain, block=False,
+                callback=lambda iq, offset=offset, count=len(messages):
+                received(offset, count))
+
+
+    def _send_stanzas(self, xmpp, stanzas):
+        """
+        Queues serialized stanzas. Stream management (XEP-0198) only counts
+        the stanza objects given to xmpp.send(), so they're counted here, in
+        the same way, or the server acks wouldn't match our count anymore.
+
+        :param xmpp: The sleekxmpp.ClientXMPP object.
+        :param stanzas: A list of serialized stanzas, as unicode strings.
+        """
+        sm = xmpp['xep_0198']
+        request = False
+
+        with xmpp.send_queue_lock:
+            if sm.enabled.is_set():
+                with sm.seq_lock:
+                    for data in stanzas:
+                        sm.seq = (sm.seq + 1) % _SM_MAX_SEQ
+                        sm.unacked_queue.append((sm.seq, data))
+
+                # A batch may cross the window, so it can't wait for the
+                # counter to be exactly zero.
+                with sm.window_counter_lock:
+                    sm.window_counter -= len(stanzas)
+
+                    if sm.window_counter <= 0:
+                        sm.window_counter = sm.window
+                        request = True
+
+            xmpp.send_raw(u''.join(stanzas))
+
+            if request:
+                sm.request_ack()
+
+
+    def _reconnect(self, xmpp, reattempt=True, wait=False, send_close=True):
+        """
+        Replaces the reconnect() method of the SleekXMPP client, which its
+        threads call when the connection drops. The stream isn't closed, so
+        the server keeps it to be resumed, and every attempt waits a random
+        delay below a maximum that doubles after each failure, so the
+        clients dropped by a server restart don't come back all at once.
+
+        :param xmpp: The sleekxmpp.ClientXMPP object.
+
+        :return Returns True once connected or False if the client was
+                stopped meanwhile.
+        """
+        compat.disconnect(xmpp, wait)
+
+        sm = xmpp['xep_0198']
+
+        # Without an ID the server doesn't keep the stream
+        if sm.enabled.is_set() and not sm.sm_id:
+            self._restart_stream(xmpp)
+
+        while xmpp.stop.is_set() is False:
+            # A connection may also drop before the session starts, so the
+            # delay only goes back to its minimum with a new session.
+            delay = self._reconnect_delay
+            self._reconnect_delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+            if xmpp.stop.wait(random.uniform(0, delay)):
+                break
+
+            if compat.connect(xmpp):
+                return True
+
+        return False
+
+
+    def _restart_stream(self, xmpp):
+        """
+        Gets ready for a new session, when the previous stream can't be
+        resumed. The messages not acknowledged by the server are sent again
+        once the session starts, except the spooled ones, which the replay
+        sends again. Anything else belonged to the old session.
+
+        :param xmpp: The sleekxmpp.ClientXMPP object.
+        """
+        sm = xmpp['xep_0198']
+
+        with xmpp.send_queue_lock:
+            self._unacked = [data for unused, data in sm.unacked_queue
+                             if isinstance(data, sleekxmpp.Message) or
+                             (isinstance(data, unicode) and
+                              not isinstance(data, _Spooled))]
+
+            xmpp.send_queue.clear()
+            sm.session_end(None)
+
+
+    def _sm_feature(self, features):
+        """
+        Replaces the SleekXMPP stream management feature, which is tried
+        before the resource binding, to resume a stream, and after it, to
+        enable a new one. SleekXMPP waits for the answer to a resumption
+        with a handler registered only after sending the request, so a fast
+        answer is missed and the session waits for the response timeout.
+
+        :return Returns True if the stream was resumed.
+        """
+        xmpp = features.stream
+        sm = xmpp['xep_0198']
+
+        if 'stream_management' in xmpp.features:
+            return False
+
+        if not sm.sm_id:
+            if 'bind' in xmpp.features:
+                sm.enabled.set()
+                enable = sm.stanza.Enable(xmpp)
+                enable['resume'] = sm.allow_resume
+                enable.send(now=True)
+                sm.handled = 0
+
+            return False
+
+        if not sm.allow_resume:
+            return False
+
+        waiter = sleekxmpp.Waiter(
+            'resumed_or_failed',
+            sleekxmpp.MatchMany([
+                sleekxmpp.MatchXPath(sm.stanza.Resumed.tag_name()),
+                sleekxmpp.MatchXPath(sm.stanza.Failed.tag_name())]))
+
+        xmpp.register_handler(waiter)
+        sm.enabled.set()
+
+        resume = sm.stanza.Resume(xmpp)
+        resume['h'] = sm.handled
+        resume['previd'] = sm.sm_id
+        resume.send(now=True)
+
+        result = waiter.wait()
+
+        return bool(result) and result.name == 'resumed'
+
+
+    def _sm_resumed(self, stanza):
+        """
+        Replaces the SleekXMPP handler of a resumed stream. It sends the
+        stanzas not acknowledged by the server again, but any of them still
+        in the send queue would be sent twice.
+        """
+        xmpp = stanza.stream
+        sm = xmpp['xep_0198']
+        xmpp.features.add('stream_management')
+
+        with xmpp.send_queue_lock:
+            compat.handle_ack(xmpp, stanza)
+            xmpp.send_queue.clear()
+
+            for unused, data in sm.unacked_queue:
+                if isinstance(data, sleekxmpp.ElementBase):
+                    data = sleekxmpp.xmlstream.tostring(data.xml,
+                                                        xmlns=xmpp.default_ns,
+                                                        stream=xmpp,
+                                                        top_level=True)
+
+                xmpp.send_raw(data)
+
+        xmpp.session_started_event.set()
+        xmpp.event('session_resumed', stanza)
+
+
+    def _sm_failed(self, stanza):
+        """
+        Replaces the SleekXMPP handler of a stream management failure. A
+        refused resumption must also forget the old stream, or the client
+        would try to resume it again instead of enabling a new one.
+        """
+        xmpp = stanza.stream
+        sm = xmpp['xep_0198']
+
+        if sm.sm_id:
+            self._restart_stream(xmpp)
+        else:
+            sm.enabled.clear()
+            sm.unacked_queue.clear()
+
+        xmpp.event('sm_failed', stanza)
+
+
+    def _receive(self, msg):
+        # Every field lookup parses the stanza again, so each is read once
+        type_ = msg['type']
+
+        if type_ not in ('chat', 'normal', 'groupchat'):
+            return
+
+        body = msg['body']
+
+        if not body:
+            return
+
+        jid = msg['from']
+        bare = jid.bare
+
+        if type_ == 'groupchat':
+            room = self._rooms.get(bare)
+
+            # Our own messages come back from the group
+            if room is not None and jid.resource == room.nick:
+                return
+        elif msg.xml.find(_INVITE) is not None:
+            # Reported by _invite()
+            return
+
+        # Replayed messages keep their IDs, so a message which arrives twice,
+        # when its sender's session dropped before the server got all of a
+        # replay, is dropped.
+        id_ = msg['id']
+
+        if id_:
+            key = (bare, id_)
+
+            if key in self._received:
+                return
+
+            self._received[key] = None
+
+            if len(self._received) > RECEIVED_IDS:
+                self._received.popitem(last=False)
+
+        if self._history is not None:
+            sender = bare
+
+            # Group messages come from the group JID, with the sender nick
+            if type_ == 'groupchat':
+                sender = jid.resource
+
+            # The old messages a group sends when it's joined, and the ones
+            # the server kept while we were offline, keep their own time.
+            delay = msg.xml.find(_DELAY)
+            timestamp = None
+
+            if delay is not None:
+                timestamp = archive.parse_stamp(delay.get('stamp', ''))
+
+            self._history.append(bare, history.INCOMING, sender, body,
+                                 timestamp)
+
+        # Group messages are shown along with the sender nick
+        sender = jid.full if type_ == 'groupchat' else bare
+        self._handle_received_message(sender, body)
+
+
+    def _invite(self, msg):
+        invite = msg.xml.find(_INVITE)
+        self._notify("%s invites you to %s" % (invite.get('from'),
+                                               msg['from'].bare))
+
+
+    def _create_client(self):
+        xmpp = sleekxmpp.ClientXMPP(self.ID, self._password)
+        loop = _get_event_loop()
+        events = _StanzaQueue(STANZA_HIGH_WATER, xmpp.stop,
+                              lambda: loop.ready(xmpp, events))
+        compat.replace_queues(xmpp, events,
+                              _SendQueue(self._send_high_water,
+                                         SEND_BATCH_SIZE,
+                                         xmpp.session_started_event))
+
+        # The events and tasks of every session share one thread each
+        compat.share_threads(xmpp, loop.scheduler)
+        xmpp.add_event_handler('session_start', self._session_start)
+        xmpp.add_event_handler('session_resumed', self._session_resumed)
+        xmpp.add_event_handler('failed_auth', self._failed_auth)
+        xmpp.add_event_handler('disconnected', self._disconnected)
+        xmpp.add_event_handler('message', self._receive)
+        xmpp.add_event_handler('roster_update', self._roster_update)
+        xmpp.add_event_handler('presence', self._presence)
+        xmpp.add_event_handler('receipt_received', self._receipt)
+
+        # Bounces don't always carry the original body, so they don't reach
+        # the 'message' event.
+        xmpp.register_handler(
+            sleekxmpp.Callback('Message bounce',
+                               sleekxmpp.StanzaPath('message@type=error'),
+                               self._bounce))
+        xmpp.register_plugin('xep_0184')
+        xmpp.register_plugin('xep_0199')
+
+        # Group presences and archived messages skip the SleekXMPP handlers
+        xmpp.add_filter('in', self._filter_room_presence)
+        xmpp.add_filter('in', self._filter_archive)
+
+        # Invitations to groups may come without a body
+        xmpp.register_handler(
+            sleekxmpp.Callback('Group invite',
+                               sleekxmpp.MatchXPath('{%s}message/%s' %
+                                                    (xmpp.default_ns,
+                                                     _INVITE)),
+                               self._invite))
+
+        # A dropped connection is resumed, see _reconnect()
+        compat.replace_reconnect(xmpp, self._reconnect)
+
+        xmpp.register_plugin('xep_0198', {'window': SM_ACK_WINDOW})
+        compat.replace_stream_management(xmpp, self._sm_feature,
+                                         self._sm_resumed, self._sm_failed)
+
+        # Our presence table replaces the one kept by SleekXMPP in its roster,
+        # which would also look up (and create) a roster item per stanza.
+        compat.drop_roster_presence(xmpp)
+        compat.replace_last_status(xmpp)
+        xmpp.register_plugin('xep_0186')
+
+        if self._roster is not None:
+            xmpp.roster.set_backend(self._roster)
+
+        self._transfers.attach(xmpp)
+
+        # Every incoming stanza goes through the matchers of every handler,
+        # and every queued event is copied.
+        compat.guard_handlers(xmpp)
+        compat.direct_messages(xmpp)
+
+        return xmpp
+
+
+    def connected(self):
+        return self._connected
+
+
+    def _open_history(self):
+        self._close_history()
+
+        if self._history_directory is None:
+            return
+
+        filename = os.path.join(self._history_directory,
+                                self.username + '@' + self.server + '.db')
+
+        self._history = history.History(filename)
+
+
+    def _close_history(self):
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+
+
+    def _open_spool(self, bare_jid):
+        if self._spool_directory is None:
+            return
+
+        filename = os.path.join(self._spool_directory, bare_jid + '.spool')
+
+        # A session dropped by the server keeps its spool
+        if self._spool is not None and self._spool.filename == filename:
+            return
+
+        self._close_spool()
+        self._spool = spool.Spool(filename)
+
+
+    def _close_spool(self):
+        with self._spool_lock:
+            spool_, self._spool = self._spool, None
+            self._spooling = False
+
+        if spool_ is not None:
+            spool_.close()
 
 
     def register(self):
@@ -47,6 +1412,9 @@ class Chat(object):
         if self._connected:
             raise Exception("already connected")
 
+        if len(args) < 3:
+            raise Exception("missing login arguments, see help for details")
+
         self.username = args[0]
         self._password = args[1]
         self.server = args[2]
@@ -58,23 +1426,337 @@ class Chat(object):
             self.host = args[3]
             self.ID += "/" + self.host
 
+        bare_jid = self.username + '@' + self.server
+
+        if self._roster_directory is not None:
+            self._roster = roster.Roster(os.path.join(self._roster_directory,
+                                                      bare_jid + '.roster'),
+                                         bare_jid)
+
+        self._state = presence.AVAILABLE
+        self._status = ''
+        self._session_event.clear()
+        _load_sleekxmpp()
+        self._xmpp = self._create_client()
+
+        # Only the TCP connection is made here, the stream negotiation and
+        # the authentication are made by the stream threads.
+        if self._xmpp.connect(reattempt=False) is False:
+            self._xmpp = None
+            self._roster = None
+            self.ID = ''
+            raise Exception("unable to connect to " + self.server)
+
+        # The spool is only opened once connected, so a failed login leaves
+        # neither its file nor its thread behind. The session only starts
+        # with the stream threads, below.
+        self._open_spool(bare_jid)
+
+        # Messages left from a previous session must be sent before any new
+        # one.
+        with self._spool_lock:
+            self._spooling = self._spool is not None and \
+                    self._spool.pending() > 0
+
+        self._open_history()
+        self._xmpp.process(block=False)
         self._connected = True
 
 
+    def wait_session(self, timeout=SESSION_TIMEOUT):
+        """
+        Waits for the session started by login() to be established. The
+        stanzas sent before it are kept in the send queue, so this is only
+        needed to know if the login succeeded.
+
+        :param timeout: The time, in seconds, to wait.
+
+        :return Returns True if the session was established or False if the
+                authentication failed, the connection was lost or the time
+                is over.
+        """
+        self._session_event.wait(timeout)
+        xmpp = self._xmpp
+
+        return self._connected and xmpp is not None and \
+                xmpp.session_started_event.is_set()
+
+
     def logout(self):
         if self._connected is False:
             raise Exception("not connected")
 
         self._connected = False
+
+        # Without a session, such as while reconnecting, nothing would be
+        # sent, so there's nothing to wait for.
+        if self._xmpp.session_started_event.is_set():
+            self._xmpp.disconnect(wait=True)
+        else:
+            self._xmpp.auto_reconnect = False
+            self._xmpp.abort()
+
+        compat.clear_tasks(self._xmpp)
+        self._xmpp = None
+        self._presences.clear()
+        self._rooms.clear()
+        self._fetches.clear()
+        self._close_history()
+        self._close_spool()
+
+        if self._roster is not None:
+            self._roster.flush()
+            self._roster = None
+
         self.contact = ''
         self.ID = ''
 
 
+    def close(self):
+        """
+        Releases the files of a session dropped by the server, which won't
+        be logged in again. Spooled messages are kept, to be sent by the next
+        login of the account.
+        """
+        self._close_history()
+        self._close_spool()
+
+
+    def _message_type(self, destination):
+        """
+        Gets the type of the messages to a destination. Messages to a joined
+        group go to all of its occupants.
+        """
+        if destination and destination.lower() in self._rooms:
+            return 'groupchat'
+
+        return 'chat'
+
+
     def message(self, message, destination=''):
+        """
+        Sends a message to a contact. Without a session, or while the
+        messages sent without one are being replayed, it goes to the spool,
+        if there's one.
+
+        :param message: The message body.
+        :param destination: The contact JID. If omitted, the active chat
+                            contact.
+        """
+        if not destination:
+            destination = self.contact
+
+        if isinstance(message, str):
+            message = message.decode('utf-8')
+
+        mtype = self._message_type(destination)
+
+        with self._spool_lock:
+            spooling = self._spooling
+
+            if spooling:
+                if not destination:
+                    raise Exception("no active chat")
+
+                self._spool.append(destination, message, mtype)
+
+        if spooling is False:
+            if self._connected is False:
+                raise Exception("not connected")
+
+            if not destination:
+                raise Exception("no active chat")
+
+            if self._xmpp.send_queue.wait_for_room(SEND_TIMEOUT) is False:
+                raise Exception("send queue is full")
+
+            self._xmpp.send_message(mto=destination, mbody=message,
+                                    mtype=mtype)
+
+        if self._history is not None:
+            self._history.append(sleekxmpp.JID(destination).bare,
+                                 history.OUTGOING, self.ID, message)
+
+
+    def broadcast(self, message, destinations):
+        """
+        Sends a message to several contacts at once. The stanza body is
+        serialized only once and the stanzas are queued without waiting for
+        any answer, asking for delivery receipts (XEP-0184). The state of each
+        recipient is reported later through @handle_broadcast. Joined groups
+        get the message as any other of their occupants, and without
+        receipts they remain as SENT.
+
+        :param message: The message body.
+        :param destinations: The recipient JIDs.
+
+        :return Returns a broadcast.Broadcast object.
+        """
         if self._connected is False:
             raise Exception("not connected")
 
-        pass
+        if isinstance(message, str):
+            message = message.decode('utf-8')
+
+        tracker = broadcast.Broadcast(message, self._broadcast_report)
+        body = u'<body>%s</body>' % escape(message)
+        payloads = dict(chat=body + u'<request xmlns="urn:xmpp:receipts"/>'
+                        u'</message>', groupchat=body + u'</message>')
+
+        prefix = self._xmpp.new_id()
+        destinations = list(OrderedDict.fromkeys(destinations))
+
+        for index, destination in enumerate(destinations):
+            # A full sleekxmpp.JID validation costs more than sending the
+            # stanza itself, so only the JID shape is checked here. The
+            # server bounces anything else.
+            bare = destination.split('/', 1)[0]
+            node, _, domain = bare.rpartition('@')
+
+            if not domain or '@' in node or len(destination.split()) != 1:
+                tracker.failed(destination, "invalid JID")
+                continue
+
+            if self._xmpp.send_queue.wait_for_room(SEND_TIMEOUT) is False:
+                for destination in destinations[index:]:
+                    tracker.failed(destination, "send queue is full")
+
+                break
+
+            stanza_id = '%s-%d' % (prefix, index)
+
+            with self._broadcasts_lock:
+                self._broadcasts[stanza_id] = tracker
+
+            tracker.sent(stanza_id, destination)
+            mtype = self._message_type(destination)
+            self._send_stanzas(self._xmpp,
+                               [u'<message to=%s type="%s" id="%s">' %
+                                (quoteattr(destination), mtype, stanza_id) +
+                                payloads[mtype]])
+
+            if self._history is not None:
+                self._history.append(bare, history.OUTGOING, self.ID, message)
+
+        tracker.start()
+
+        return tracker
+
+
+    def send_file(self, filename, destination=''):
+        """
+        Sends a file to a contact, in the background. When the contact is
+        given by its bare JID, the file goes to its resource with the highest
+        priority.
+
+        :param filename: The file to send.
+        :param destination: The contact JID. If omitted, the active chat
+                            contact.
+
+        :return Returns a transfer.Transfer object.
+        """
+        if self._connected is False:
+            raise Exception("not connected")
+
+        if not destination:
+            destination = self.contact
+
+        if not destination:
+            raise Exception("no active chat")
+
+        jid = sleekxmpp.JID(destination)
+
+        # Files must be offered to a full JID
+        if not jid.resource:
+            resources = self._presences.resources(jid.bare)
+
+            if not resources:
+                raise Exception("contact is offline")
+
+            jid.resource = max(resources.iteritems(),
+                               key=lambda item: item[1].priority)[0]
+
+        return self._transfers.send(jid.full, filename)
+
+
+    def transfers(self):
+        """
+        Gets the file transfers which didn't finish yet.
+
+        :return Returns a list of transfer.Transfer objects.
+        """
+        return self._transfers.active()
+
+
+    def history(self, contact, since=None, limit=None):
+        """
+        Gets the messages exchanged with a contact or a group.
+
+        :param contact: The contact or group.
+        :param since: Only messages from this timestamp on.
+        :param limit: The maximum number of messages.
+
+        :return Yields history.Message objects, oldest first.
+        """
+        if self._history is None:
+            raise Exception("no history available, login first")
+
+        return self._history.lookup(_peer(contact), since=since, limit=limit)
+
+
+    def fetch_archive(self, peers=None, since=None):
+        """
+        Fetches the messages kept by the server archive (XEP-0313), in the
+        background. Each message is saved in the history and the received
+        ones are delivered through @handle_received_message, as they arrive.
+        A new session does it by itself for the conversations of the last
+        archive.PERIOD seconds.
+
+        :param peers: The contacts whose conversations are fetched. If
+                      omitted, the conversations of the history with
+                      messages from the last archive.PERIOD seconds.
+        :param since: Only messages from this timestamp on. If omitted, each
+                      conversation is fetched from its last message in the
+                      history or, if it has none, from archive.PERIOD seconds
+                      ago.
+
+        :return Returns an archive.Fetch object.
+        """
+        if self._connected is False:
+            raise Exception("not connected")
+
+        if self._xmpp.session_started_event.is_set() is False:
+            raise Exception("no session, try again later")
+
+        if peers is not None:
+            peers = [_peer(peer) for peer in peers]
+
+        return self._fetch_archive(peers, since)
+
+
+    def search(self, terms, peer=None, since=None, limit=None):
+        """
+        Searches the history for messages containing some terms.
+
+        :param terms: The search terms.
+        :param peer: Only messages with this contact or group.
+        :param since: Only messages from this timestamp on.
+        :param limit: The maximum number of messages, history.SEARCH_LIMIT
+                      if omitted.
+
+        :return Returns a list of (history.Message, snippet) tuples.
+        """
+        if self._history is None:
+            raise Exception("no history available, login first")
+
+        if limit is None:
+            limit = history.SEARCH_LIMIT
+
+        if peer is not None:
+            peer = _peer(peer)
+
+        return self._history.search(terms, peer=peer, since=since,
+                                    limit=limit)
 
 
     def start_chat(self, contact):
@@ -91,37 +1773,207 @@ class Chat(object):
         self.contact = ''
 
 
-    def group_create(self, group_name):
+    def _room_jid(self, group_name):
+        """
+        Splits a group name into the group JID and the user nick.
+
+        :param group_name: The group JID, optionally with the user nick as
+                           its resource. Without a domain, the group is taken
+                           from the muc.SERVICE_PREFIX service of the server.
+
+        :return Returns a tuple with the group bare JID and the nick, which
+                may be empty.
+        """
+        jid, _, nick = group_name.partition('/')
+
+        if '@' not in jid:
+            jid += '@' + muc.SERVICE_PREFIX + self.server
+
+        return jid.lower(), nick
+
+
+    def _add_room(self, group_name, password, create):
+        """
+        Adds a group to the ones joined by the user. It's joined right away
+        or, without a session, along with the others when the session starts.
+
+        :param group_name: The group name, see _room_jid().
+        :param password: The group password, if it has one.
+        :param create: Indicates if the user wants a new group.
+        """
         if self._connected is False:
             raise Exception("not connected")
 
-        pass
+        jid, nick = self._room_jid(group_name)
+
+        if jid in self._rooms:
+            raise Exception("already in " + jid)
+
+        room = muc.Room(jid, nick or self.username, password, create)
+        self._rooms[jid] = room
+
+        if self._xmpp.session_started_event.is_set():
+            self._join_rooms([room])
+
+
+    def group_create(self, group_name, password=''):
+        """
+        Creates a group and joins it. The group is created with the default
+        configuration of the server. If it already exists, it's only joined.
 
+        :param group_name: The group JID, see group_join().
+        :param password: The group password, if it has one.
+        """
+        self._add_room(group_name, password, True)
 
-    def group_invite(self, users):
+
+    def group_invite(self, users, group_name=''):
+        """
+        Invites users to a group, through the group itself.
+
+        :param users: The JIDs of the invited users.
+        :param group_name: The group JID. If omitted, the active chat
+                           contact, which must be a joined group.
+        """
         if self._connected is False:
             raise Exception("not connected")
 
-        pass
+        room = self._rooms.get(self._room_jid(group_name or self.contact)[0])
+
+        if room is None or room.state != muc.JOINED:
+            raise Exception("no active group")
+
+        if not users:
+            raise Exception("no users to invite")
+
+        self._send_stanzas(self._xmpp, [muc.invite_stanza(room, users)])
+
+
+    def group_join(self, group_name, password=''):
+        """
+        Joins a group, such as room@conference.jabber.org/nick.
 
+        :param group_name: The group JID, optionally with the user nick as
+                           its resource. Without a domain, the group is taken
+                           from the muc.SERVICE_PREFIX service of the server.
+                           Without a nick, the username is used.
+        :param password: The group password, if it has one.
+        """
+        self._add_room(group_name, password, False)
 
-    def group_join(self, group_name):
+
+    def group_leave(self, group_name):
+        """
+        Leaves a group.
+
+        :param group_name: The group JID.
+        """
         if self._connected is False:
             raise Exception("not connected")
 
-        pass
+        room = self._rooms.pop(self._room_jid(group_name)[0], None)
 
+        if room is None:
+            raise Exception("not in " + group_name)
 
-    def contact_add(self, name):
-        pass
+        if self._xmpp.session_started_event.is_set():
+            self._send_stanzas(self._xmpp, [muc.leave_stanza(room)])
 
 
-    def contact_del(self, name):
-        pass
+    def group_occupants(self, group_name):
+        """
+        Gets the occupants of a joined group.
 
+        :param group_name: The group JID.
 
-    def contact_list(self):
-        pass
+        :return Returns a list of (nick, muc.Occupant) tuples, sorted by
+                nick.
+        """
+        room = self._rooms.get(self._room_jid(group_name)[0])
+
+        if room is None:
+            raise Exception("not in " + group_name)
+
+        return room.occupants()
+
+
+    def contact_add(self, jid):
+        """
+        Adds a contact to the roster and asks for its presence subscription.
+
+        :param jid: The contact JID.
+        """
+        if self._connected is False:
+            raise Exception("not connected")
+
+        self._xmpp.update_roster(jid, block=False)
+        self._xmpp.client_roster.subscribe(jid)
+
+
+    def contact_del(self, jid):
+        """
+        Removes a contact from the roster, cancelling its subscriptions.
+
+        :param jid: The contact JID.
+        """
+        if self._connected is False:
+            raise Exception("not connected")
+
+        if self._xmpp.client_roster.has_jid(jid) is False:
+            raise Exception("unknown contact")
+
+        self._xmpp.client_roster[jid].remove()
+        self._xmpp.update_roster(jid, subscription='remove', block=False)
+
+
+    def set_presence(self, state, status=''):
+        """
+        Sets the user presence to the contacts. It is sent again at every
+        new session.
+
+        :param state: One of presence.AVAILABLE, presence.AWAY,
+                      presence.CHAT, presence.OFFLINE or presence.INVISIBLE.
+        :param status: An optional free text status message.
+        """
+        if self._connected is False:
+            raise Exception("not connected")
+
+        self._state = state
+        self._status = status
+        self._send_presence()
+
+
+    def presence(self, jid):
+        """
+        Gets the presence of a contact.
+
+        :param jid: The contact bare JID.
+
+        :return Returns a presence.Status object.
+        """
+        return self._presences.get(jid)
+
+
+    def roster(self):
+        """
+        Gets the local copy of the roster.
+
+        :return Returns the roster.Roster object or None when there's no
+                session or the roster isn't kept locally.
+        """
+        return self._roster
+
+
+    def contact_list(self, **options):
+        """
+        Gets the contacts from the local copy of the roster.
 
+        :param options: The roster.Roster.contacts() options, to sort,
+                        filter and page the contacts.
 
+        :return Returns a list of (jid, roster.Contact) tuples.
+        """
+        if self._roster is None:
+            raise Exception("no roster available, login first")
 
+        return self._roster.contacts(**options)
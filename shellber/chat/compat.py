@@ -0,0 +1,632 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The SleekXMPP internals used by the chat sessions.
+
+The sessions replace a few queues, methods and handlers of the SleekXMPP
+client, for which it has no public interface: the event and send queues,
+the reconnection, the stream management (XEP-0198) feature and its
+handlers, the roster presence handlers, the matching of the stream
+handlers, the message handler, the event and scheduler threads and the
+In-Band bytestream (XEP-0047) queues. Every access to a private member goes
+through this module, which was written against SLEEKXMPP_VERSION, the
+version pinned in requirements.txt. check() makes sure the loaded SleekXMPP
+still has every member used here, so a new version fails at login instead
+of breaking a session later.
+"""
+
+import copy
+import itertools
+import logging
+import Queue
+import threading
+
+# The SleekXMPP version this module was written for
+SLEEKXMPP_VERSION = '1.3.1'
+
+# The private members used from the client, from the stream management
+# plugin and from the roster classes
+_CLIENT_MEMBERS = ('_connect', '_disconnect', '_start_thread', '_send_thread',
+                   '_threaded_event_wrapper', '_handle_available',
+                   '_handle_unavailable', 'unregister_feature',
+                   'register_feature')
+_SM_MEMBERS = ('_handle_ack', 'session_end', 'request_ack')
+_ROSTER_MEMBERS = ('_save_last_status',)
+
+# The stream management plugin state used, only set on its instances
+_SM_STATE = ('enabled', 'sm_id', 'handled', 'seq', 'seq_lock',
+             'unacked_queue', 'window', 'window_counter',
+             'window_counter_lock', 'allow_resume', 'resume_order')
+
+# The names of the stream management handlers
+_SM_RESUMED = 'Stream Management Resumed'
+_SM_FAILED = 'Stream Management Failed'
+_SM_ACK = 'Stream Management Ack'
+
+# The In-Band bytestream state used, only set on its instances
+_IBB_STATE = ('recv_queue', 'stream_in_closed', 'window_empty')
+
+# The name mangled set of running SleekXMPP threads
+_ACTIVE_THREADS = '_XMLStream__active_threads'
+
+# The name mangled list of stream handlers
+_HANDLERS = '_XMLStream__handlers'
+
+# Characters of an XPath step which may match other tags than its own
+_XPATH_PATTERNS = '*.[@'
+
+# The name of the stream handler which raises the message event, and the
+# function it calls
+_IM = 'IM'
+_CALLBACK = '_pointer'
+
+# The thread which writes the outgoing stream
+_SEND_THREAD = 'send_thread'
+
+# The threads which run the events and the scheduled tasks of a client
+_EVENT_THREAD = 'event_thread_'
+_SCHEDULER_THREAD = 'scheduler_thread'
+
+# Tells apart the scheduled tasks of each client
+_client_ids = itertools.count()
+
+# The roster items of a roster node, by bare JID, and the lock of their
+# last presence
+_ROSTER_ITEMS = '_jids'
+_ROSTER_STATUS_LOCK = '_last_status_lock'
+
+def check(sleekxmpp):
+    """
+    Checks that SleekXMPP has every member used by this module.
+
+    :param sleekxmpp: The sleekxmpp module.
+    """
+    from sleekxmpp.plugins.xep_0198 import XEP_0198
+
+    missing = [name for name in _CLIENT_MEMBERS
+               if not hasattr(sleekxmpp.ClientXMPP, name)]
+    missing += [name for name in _SM_MEMBERS if not hasattr(XEP_0198, name)]
+    missing += [name for name in _ROSTER_MEMBERS
+                if not hasattr(sleekxmpp.roster.Roster, name)]
+
+    if missing:
+        raise Exception("SleekXMPP %s lacks %s, version %s is required" %
+                        (sleekxmpp.__version__, ', '.join(missing),
+                         SLEEKXMPP_VERSION))
+
+    if sleekxmpp.__version__ != SLEEKXMPP_VERSION:
+        logging.warning("SleekXMPP %s is not supported, %s is required",
+                        sleekxmpp.__version__, SLEEKXMPP_VERSION)
+
+
+
+def replace_queues(xmpp, event_queue, send_queue):
+    """
+    Replaces the client event and send queues. Both must keep the
+    Queue.Queue interface, and None is the stop mark of the send thread.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param event_queue: The queue of incoming events.
+    :param send_queue: The queue of outgoing data.
+    """
+    xmpp.event_queue = event_queue
+    xmpp.send_queue = send_queue
+
+
+
+def replace_reconnect(xmpp, reconnect):
+    """
+    Replaces the client reconnect() method, which its threads call when the
+    connection drops.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param reconnect: A function to be called with the client, and with the
+                      arguments of reconnect(): reattempt, wait and
+                      send_close.
+    """
+    xmpp.reconnect = lambda reattempt=True, wait=False, send_close=True: \
+            reconnect(xmpp, reattempt, wait, send_close)
+
+
+
+def disconnect(xmpp, wait):
+    """
+    Drops the connection without closing the stream, so the server keeps
+    it to be resumed.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param wait: Indicates if the queued data is sent first.
+    """
+    if xmpp.state.ensure('connected'):
+        xmpp.state.transition('connected', 'disconnected', wait=2.0,
+                              func=xmpp._disconnect, args=(True, wait, False))
+
+
+
+def connect(xmpp):
+    """
+    Makes a single connection attempt.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+
+    :return Returns True once connected or False otherwise.
+    """
+    if xmpp.state.transition('disconnected', 'connected', wait=2.0,
+                             func=xmpp._connect, args=(False,)) is False:
+        return False
+
+    # The send thread gives up when a write fails, leaving its batch
+    # unfinished.
+    if _SEND_THREAD not in getattr(xmpp, _ACTIVE_THREADS):
+        xmpp.send_queue.task_done()
+        xmpp._start_thread(_SEND_THREAD, xmpp._send_thread)
+
+    return True
+
+
+
+def replace_stream_management(xmpp, feature, resumed, failed):
+    """
+    Replaces the stream management feature, tried before the resource
+    binding, to resume a stream, and after it, to enable a new one, and the
+    handlers of a resumed stream, of a failure and of the server acks, see
+    handle_ack(). The plugin must be registered already.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param feature: The feature function.
+    :param resumed: The handler of a resumed stream.
+    :param failed: The handler of a stream management failure.
+    """
+    import sleekxmpp
+
+    sm = xmpp['xep_0198']
+    missing = [name for name in _SM_STATE if not hasattr(sm, name)]
+
+    if missing or not hasattr(xmpp, _ACTIVE_THREADS):
+        raise Exception("SleekXMPP %s lacks %s, version %s is required" %
+                        (sleekxmpp.__version__,
+                         ', '.join(missing or [_ACTIVE_THREADS]),
+                         SLEEKXMPP_VERSION))
+
+    # Both orders of the feature share the function
+    xmpp.unregister_feature('sm', sm.resume_order)
+    xmpp.register_feature('sm', feature, restart=True, order=sm.resume_order)
+
+    for name, tag, handler in (
+            (_SM_RESUMED, sm.stanza.Resumed.tag_name(), resumed),
+            (_SM_FAILED, sm.stanza.Failed.tag_name(), failed),
+            (_SM_ACK, sm.stanza.Ack.tag_name(),
+             lambda stanza: handle_ack(xmpp, stanza))):
+        xmpp.remove_handler(name)
+        xmpp.register_handler(
+            sleekxmpp.Callback(name, sleekxmpp.MatchXPath(tag), handler,
+                               instream=True))
+
+
+
+def handle_ack(xmpp, stanza):
+    """
+    Drops the stanzas acknowledged by the server from the stream management
+    queue.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param stanza: The stanza carrying the server count, an ack or a
+                   resumed stream.
+    """
+    sm = xmpp['xep_0198']
+
+    # The plugin forgets the stream when the session ends, while the acks
+    # of its last stanzas may still arrive. Counting them against the empty
+    # queue would kill the stream reader, which then holds the logout.
+    if sm.enabled.is_set() is False:
+        return
+
+    try:
+        sm._handle_ack(stanza)
+    except IndexError:
+        # The session ended while the ack was handled
+        pass
+
+
+
+def drop_roster_presence(xmpp):
+    """
+    Removes the handlers which keep the presences in the SleekXMPP roster,
+    when the caller keeps them itself.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    """
+    for show in ('available', 'away', 'chat', 'dnd', 'xa'):
+        xmpp.del_event_handler('presence_' + show, xmpp._handle_available)
+
+    xmpp.del_event_handler('presence_unavailable', xmpp._handle_unavailable)
+
+
+
+def replace_last_status(xmpp):
+    """
+    Replaces the outgoing filter which keeps, in the SleekXMPP roster, the
+    last presence sent to each contact. A presence to every contact resets
+    the one of each roster item, which the original filter reached through
+    a new JID object per contact, taking seconds with a large roster. Here
+    the items are reset straight from the roster node.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    """
+    import sleekxmpp
+
+    roster = xmpp.roster
+    save = roster._save_last_status
+
+    def save_last_status(stanza):
+        if not isinstance(stanza, sleekxmpp.Presence) or stanza['to'].full:
+            return save(stanza)
+
+        if stanza['type'] in stanza.showtypes or \
+                stanza['type'] in ('available', 'unavailable'):
+            node = roster[stanza['from'].full or xmpp.boundjid]
+            node.last_status = stanza
+
+            with getattr(node, _ROSTER_STATUS_LOCK):
+                for item in getattr(node, _ROSTER_ITEMS).itervalues():
+                    item.last_status = None
+
+            if not xmpp.sentpresence:
+                xmpp.event('sent_presence')
+                xmpp.sentpresence = True
+
+        return stanza
+
+    xmpp.del_filter('out', save)
+    xmpp.add_filter('out', save_last_status)
+
+
+
+def _native(text):
+    """
+    Converts an ASCII unicode string into a str, as the tags and names of
+    the stanzas, so comparing them doesn't decode them every time.
+    """
+    try:
+        return str(text)
+    except UnicodeEncodeError:
+        return text
+
+
+
+def _fast_match(matcher):
+    """
+    Builds a function which gives the same answer as the match() of a
+    matcher for any stanza, but rejects the stanzas of other kinds first,
+    much faster than the matcher itself.
+
+    :param matcher: The matcher of a handler.
+
+    :return Returns a function to be called with a stanza, or None when the
+            matcher can't be told in advance.
+    """
+    from sleekxmpp.xmlstream.matcher import MatchXPath, StanzaPath
+
+    criteria = getattr(matcher, '_criteria', None)
+
+    # A stanza path starts with a stanza name, plugin or interface, which
+    # is checked first by ElementBase.match().
+    if isinstance(matcher, StanzaPath) and isinstance(criteria, list) and \
+            criteria:
+        tag = _native(criteria[0].split('@')[0].split('}')[-1])
+        raw = getattr(matcher, '_raw_criteria', None)
+
+        if not tag:
+            return None
+
+        # A path without namespaces is split as the criteria, so a failed
+        # match isn't tried again with the raw one.
+        if isinstance(raw, basestring) and '{' not in raw:
+            match = lambda stanza: stanza.match(criteria)
+        else:
+            match = matcher.match
+
+        return lambda stanza: (tag == stanza.name or
+                               tag in stanza.loaded_plugins or
+                               tag in stanza.plugin_attrib) and match(stanza)
+
+    # An XPath is searched from a parent of the stanza, so its first step
+    # must be the stanza tag and the rest is searched from the stanza.
+    # Namespaces may contain slashes.
+    if isinstance(matcher, MatchXPath) and isinstance(criteria, basestring):
+        namespace = ''
+
+        if criteria.startswith('{'):
+            namespace, brace, criteria = criteria.partition('}')
+            namespace += brace
+
+        step, unused, rest = criteria.partition('/')
+
+        if not step or any(c in step for c in _XPATH_PATTERNS):
+            return None
+
+        tag = _native(namespace + step)
+
+        def match(stanza):
+            xml = getattr(stanza, 'xml', stanza)
+
+            return xml.tag == tag and (not rest or
+                                       xml.find(rest) is not None)
+
+        return match
+
+    return None
+
+
+
+def _guard(handler):
+    """
+    Replaces the matching of a handler, see guard_handlers(). Handlers given
+    a stream register themselves before setting their matcher, so it's only
+    replaced at the first match.
+    """
+    from sleekxmpp.xmlstream.handler.base import BaseHandler
+
+    # Only handlers which leave the matching to their matcher
+    if type(handler).match != BaseHandler.match:
+        return
+
+    def first_match(stanza):
+        match = _fast_match(getattr(handler, '_matcher', None))
+
+        if match is None:
+            del handler.match
+        else:
+            handler.match = match
+
+        return handler.match(stanza)
+
+    handler.match = first_match
+
+
+
+def guard_handlers(xmpp):
+    """
+    Speeds up the matching of the stream handlers, the current ones and the
+    ones registered later. Every incoming stanza is matched against every
+    handler, most of them for other kinds of stanzas, a failed match of a
+    stanza path is tried twice, the second time parsing the path again, and
+    an XPath is searched from a new parent element. The handlers now check
+    the stanza root first, and only match each stanza path once and each
+    XPath from the stanza itself.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    """
+    for handler in getattr(xmpp, _HANDLERS):
+        _guard(handler)
+
+    register_handler = xmpp.register_handler
+
+    def register_guarded(handler, before=None, after=None):
+        _guard(handler)
+        register_handler(handler, before, after)
+
+    xmpp.register_handler = register_guarded
+
+
+
+def direct_messages(xmpp):
+    """
+    Runs the message event handlers straight from the message stream
+    handler, instead of queueing the event again. The stream handler
+    already runs in the event thread, and the event runner copies every
+    event it takes, so each message was queued and copied twice before
+    reaching its handlers. The event handlers of a direct event can't be
+    threaded.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    """
+    import sleekxmpp
+
+    def handle_message(msg):
+        if not msg['to'].bare:
+            msg['to'] = xmpp.boundjid
+
+        xmpp.event('message', msg, direct=True)
+
+    # The handler keeps its place, ahead of the ones registered later
+    handlers = [handler for handler in getattr(xmpp, _HANDLERS)
+                if handler.name == _IM and hasattr(handler, _CALLBACK)]
+
+    if len(handlers) != 1:
+        raise Exception("SleekXMPP %s lacks the %s handler, version %s is "
+                        "required" % (sleekxmpp.__version__, _IM,
+                                      SLEEKXMPP_VERSION))
+
+    setattr(handlers[0], _CALLBACK, handle_message)
+
+
+
+class _ClientScheduler(object):
+    """
+    The scheduler of a client which shares a SleekXMPP scheduler with other
+    clients. Every client names its tasks the same, so they're given to the
+    shared scheduler under a name of their own. A task added again replaces
+    the pending one: a session which drops before its start is handled
+    removes its keepalive task before adding it, and the next session adds
+    it again.
+
+    :param scheduler: The shared sleekxmpp Scheduler object.
+    """
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._prefix = '%d:' % next(_client_ids)
+
+
+    def add(self, name, seconds, callback, args=None, kwargs=None,
+            repeat=False, qpointer=None):
+        with self._scheduler.schedule_lock:
+            self.remove(name)
+            self._scheduler.add(self._prefix + name, seconds, callback, args,
+                                kwargs, repeat, qpointer)
+
+
+    def remove(self, name):
+        self._scheduler.remove(self._prefix + name)
+
+
+    def clear(self):
+        """
+        Removes every task of the client.
+        """
+        with self._scheduler.schedule_lock:
+            self._scheduler.schedule[:] = [
+                task for task in self._scheduler.schedule
+                if not task.name.startswith(self._prefix)]
+
+
+
+def share_threads(xmpp, scheduler):
+    """
+    Keeps the client from starting its event and scheduler threads, for a
+    caller which runs the events of several clients itself, see
+    run_event(), and times their tasks with a shared scheduler. Only the
+    stream reader and writer threads are left to the client. The caller
+    must run the scheduler and call clear_tasks() once the client is done.
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param scheduler: The shared sleekxmpp Scheduler object, whose tasks are
+                      put in the event queue of their client.
+    """
+    start_thread = xmpp._start_thread
+
+    def start_stream_thread(name, target, track=True):
+        if name != _SCHEDULER_THREAD and not name.startswith(_EVENT_THREAD):
+            start_thread(name, target, track)
+
+    xmpp._start_thread = start_stream_thread
+    xmpp.scheduler = _ClientScheduler(scheduler)
+
+
+
+def clear_tasks(xmpp):
+    """
+    Removes the tasks a client left in the shared scheduler, such as the
+    repeated ones, see share_threads().
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    """
+    xmpp.scheduler.clear()
+
+
+
+def run_event(xmpp, event):
+    """
+    Runs an event taken from the event queue of a client, as its event
+    threads do, see share_threads().
+
+    :param xmpp: The sleekxmpp.ClientXMPP object.
+    :param event: The queued event.
+    """
+    if event is None:
+        return
+
+    etype, handler = event[0:2]
+    args = event[2:]
+
+    # The error reply goes to the stanza as it arrived, before any handler
+    # changed it.
+    orig = copy.copy(args[0])
+
+    if etype == 'stanza':
+        try:
+            handler.run(args[0])
+        except Exception as e:
+            logging.exception("Error processing stream handler: %s",
+                              handler.name)
+            orig.exception(e)
+    elif etype == 'schedule':
+        try:
+            handler(*args[0], **args[1])
+        except Exception as e:
+            logging.exception("Error processing scheduled task")
+            xmpp.exception(e)
+    elif etype == 'event':
+        func, threaded, unused = handler
+
+        try:
+            if threaded:
+                thread = threading.Thread(name="Event_%s" % str(func),
+                                          target=xmpp._threaded_event_wrapper,
+                                          args=(func, args))
+                thread.daemon = xmpp._use_daemons
+                thread.start()
+            else:
+                func(*args)
+        except Exception as e:
+            logging.exception("Error processing event handler: %s",
+                              str(func))
+
+            if hasattr(orig, 'exception'):
+                orig.exception(e)
+            else:
+                xmpp.exception(e)
+
+
+
+def _check_ibb(stream):
+    missing = [name for name in _IBB_STATE if not hasattr(stream, name)]
+
+    if missing:
+        raise Exception("SleekXMPP In-Band bytestreams lack %s, version %s "
+                        "is required" % (', '.join(missing),
+                                         SLEEKXMPP_VERSION))
+
+
+
+def read_block(stream, timeout):
+    """
+    Reads the next block received through an In-Band bytestream. The blocks
+    are taken from the stream queue, as its read() refuses to return the
+    queued ones once the sender closes it.
+
+    :param stream: The sleekxmpp IBBytestream object.
+    :param timeout: The maximum time to wait for a block, in seconds.
+
+    :return Returns the block, None if none arrived in time, or an empty
+            string once the sender closed the stream and every block was
+            read.
+    """
+    _check_ibb(stream)
+
+    try:
+        return stream.recv_queue.get(timeout=timeout)
+    except Queue.Empty:
+        return '' if stream.stream_in_closed.is_set() else None
+
+
+
+def wait_blocks_acked(stream, timeout):
+    """
+    Waits until the receiver acknowledges every block sent through an
+    In-Band bytestream.
+
+    :param stream: The sleekxmpp IBBytestream object.
+    :param timeout: The maximum time to wait, in seconds.
+
+    :return Returns True if every block was acknowledged.
+    """
+    _check_ibb(stream)
+
+    return stream.window_empty.wait(timeout)
@@ -0,0 +1,372 @@
+
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to keep the history of the messages exchanged by an account.
+"""
+
+import logging
+import os
+import Queue
+import sqlite3
+import struct
+import threading
+import time
+
+# Number of rows read from the database at once when paging a history
+PAGE_SIZE = 256
+
+# Maximum number of messages written in a single transaction
+WRITE_BATCH_SIZE = 1024
+
+# Default number of results from a search
+SEARCH_LIMIT = 20
+
+# Number of words around the matches in a search snippet
+SNIPPET_WORDS = 12
+
+# Number of most recent matches ranked by a search
+RANK_WINDOW = 5000
+
+# Message directions
+INCOMING = 0
+OUTGOING = 1
+
+_SCHEMA = [
+    'PRAGMA journal_mode=WAL',
+    'CREATE TABLE IF NOT EXISTS messages ('
+    '   id INTEGER PRIMARY KEY,'
+    '   peer TEXT NOT NULL,'
+    '   timestamp REAL NOT NULL,'
+    '   direction INTEGER NOT NULL,'
+    '   sender TEXT NOT NULL,'
+    '   body TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS messages_peer_timestamp '
+    '   ON messages (peer, timestamp, id)',
+]
+
+# The full-text index is an external content FTS4 table, updated by a
+# trigger on every new message.
+_INDEX_SCHEMA = [
+    'CREATE VIRTUAL TABLE messages_index USING fts4(content="messages", '
+    '   body)',
+    'CREATE TRIGGER messages_index_insert AFTER INSERT ON messages BEGIN'
+    '   INSERT INTO messages_index (docid, body) VALUES (new.id, new.body);'
+    ' END',
+    'INSERT INTO messages_index (messages_index) VALUES (\'rebuild\')',
+]
+
+_INSERT = 'INSERT INTO messages (peer, timestamp, direction, sender, body) ' \
+          'VALUES (?, ?, ?, ?, ?)'
+
+def _text(value):
+    """
+    Decodes a UTF-8 str, since sqlite3 only takes unicode text.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+
+    return value
+
+
+
+def _rank(matchinfo):
+    """
+    Ranks a full-text match by the sum of the frequency of each searched
+    term in the message, weighted by its frequency in all the messages.
+
+    :param matchinfo: The FTS4 matchinfo(index, 'pcx') blob.
+    """
+    info = struct.unpack('@%dI' % (len(matchinfo) / 4), matchinfo)
+    phrases, columns = info[0], info[1]
+    score = 0.0
+
+    for i in range(phrases * columns):
+        hits, all_hits = info[2 + i * 3], info[3 + i * 3]
+
+        if hits:
+            score += float(hits) / all_hits
+
+    return score
+
+
+
+class Message(object):
+    """
+    A message read from the history.
+    """
+    __slots__ = ('id', 'peer', 'timestamp', 'direction', 'sender', 'body')
+
+    def __init__(self, row):
+        self.id, self.peer, self.timestamp, self.direction, self.sender, \
+            self.body = row
+
+
+    def __repr__(self):
+        return "Message(peer=%r, timestamp=%r, sender=%r, body=%r)" % \
+                (self.peer, self.timestamp, self.sender, self.body)
+
+
+
+class History(object):
+    """
+    A class to hold the history of all conversations from an account, saved
+    into a SQLite database, indexed by peer and timestamp.
+
+    New messages are only queued by append() and a background thread writes
+    them, in batches, so the chat session never waits for the disk. Lookups
+    are made with their own connection and read the rows page by page.
+
+    :param filename: The database file.
+    """
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+
+        if directory and os.path.isdir(directory) is False:
+            os.makedirs(directory)
+
+        self._filename = filename
+        self._queue = Queue.Queue()
+        self._connection = self._connect()
+        self._lock = threading.Lock()
+
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+
+        # Databases from older versions have no index yet, so we build it
+        # once from their messages.
+        if not self._connection.execute('SELECT name FROM sqlite_master '
+                                        'WHERE name = \'messages_index\''
+                                        ).fetchall():
+            for statement in _INDEX_SCHEMA:
+                self._connection.execute(statement)
+
+        self._connection.commit()
+        self._connection.create_function('rank', 1, _rank)
+
+        self._writer = threading.Thread(name='history', target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+
+    def _connect(self):
+        # Both our connections are protected by their own threads or locks
+        return sqlite3.connect(self._filename, check_same_thread=False)
+
+
+    def _write(self):
+        connection = self._connect()
+
+        while True:
+            messages = [self._queue.get()]
+
+            while len(messages) < WRITE_BATCH_SIZE:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = None in messages
+            messages = [m for m in messages if m is not None]
+
+            try:
+                with connection:
+                    connection.executemany(_INSERT, messages)
+            except sqlite3.Error:
+                # A single bad message must not take the rest of the batch
+                # with it.
+                for message in messages:
+                    try:
+                        with connection:
+                            connection.execute(_INSERT, message)
+                    except sqlite3.Error as error:
+                        logging.error("Unable to save a message from %s: %s",
+                                      message[0], str(error))
+
+            for _ in range(len(messages) + stop):
+                self._queue.task_done()
+
+            if stop:
+                break
+
+        connection.close()
+
+
+    def append(self, peer, direction, sender, body, timestamp=None):
+        """
+        Adds a message to the history. It's only queued to be written.
+
+        :param peer: The contact or group of the conversation.
+        :param direction: INCOMING or OUTGOING.
+        :param sender: Who sent the message.
+        :param body: The message body.
+        :param timestamp: The message time, the current time if omitted.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        self._queue.put((_text(peer), timestamp, direction, _text(sender),
+                         _text(body)))
+
+
+    def flush(self):
+        """
+        Waits until every queued message is written.
+        """
+        self._queue.join()
+
+
+    def close(self):
+        """
+        Writes every queued message and closes the database.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        self._connection.close()
+
+
+    def _select(self, query, args):
+        with self._lock:
+            return self._connection.execute(query, args).fetchall()
+
+
+    def lookup(self, peer, since=None, limit=None):
+        """
+        Gets messages from a conversation, oldest first. Rows are read from
+        the database in pages, as they are consumed.
+
+        :param peer: The contact or group of the conversation.
+        :param since: Only messages from this timestamp on. If omitted, the
+                      last @limit messages are returned.
+        :param limit: The maximum number of messages.
+
+        :return Yields Message objects.
+        """
+        # We page with the (timestamp, id) of the last row read
+        last = (since or 0, -1)
+
+        if since is None and limit is not None:
+            # The first of the last @limit messages
+            rows = self._select('SELECT timestamp, id FROM messages '
+                                'WHERE peer = ? ORDER BY timestamp DESC, '
+                                'id DESC LIMIT 1 OFFSET ?', (peer, limit - 1))
+
+            if rows:
+                last = (rows[0][0], rows[0][1] - 1)
+
+        remaining = limit
+
+        while remaining is None or remaining > 0:
+            page = PAGE_SIZE if remaining is None else min(PAGE_SIZE,
+                                                           remaining)
+
+            rows = self._select('SELECT id, peer, timestamp, direction, '
+                                'sender, body FROM messages WHERE peer = ? '
+                                'AND timestamp >= ? AND (timestamp > ? OR '
+                                'id > ?) ORDER BY timestamp, id LIMIT ?',
+                                (peer, last[0], last[0], last[1], page))
+
+            for row in rows:
+                yield Message(row)
+
+            if len(rows) < page:
+                break
+
+            last = (rows[-1][2], rows[-1][0])
+
+            if remaining is not None:
+                remaining -= len(rows)
+
+
+    def conversations(self, since):
+        """
+        Gets the conversations with messages from a given time on.
+
+        :param since: The timestamp.
+
+        :return Returns a list of (peer, timestamp) tuples, with the time of
+                the last message of each conversation.
+        """
+        # The (peer, timestamp) index gives the last message of each peer
+        # without reading the messages themselves.
+        return self._select('SELECT peer, MAX(timestamp) FROM messages '
+                            'GROUP BY peer HAVING MAX(timestamp) >= ?',
+                            (since,))
+
+
+    def search(self, terms, peer=None, since=None, limit=SEARCH_LIMIT):
+        """
+        Searches messages through the full-text index.
+
+        :param terms: The search terms, in the FTS4 query syntax.
+        :param peer: Only messages from this contact or group.
+        :param since: Only messages from this timestamp on.
+        :param limit: The maximum number of messages.
+
+        :return Returns a list of (Message, snippet) tuples, best matches
+                first, from the RANK_WINDOW most recent matches. The matched
+                terms are between '*' in the snippet.
+        """
+        # Only the most recent matches are ranked, and the snippets are only
+        # made for the best ones, so large histories are searched as fast as
+        # the small ones.
+        query = 'SELECT docid, matchinfo(messages_index, \'pcx\') AS info ' \
+                'FROM messages_index'
+        args = [terms]
+
+        if peer is not None or since is not None:
+            query += ' JOIN messages m ON m.id = messages_index.docid'
+
+        query += ' WHERE messages_index MATCH ?'
+
+        if peer is not None:
+            query += ' AND m.peer = ?'
+            args.append(peer)
+
+        if since is not None:
+            query += ' AND m.timestamp >= ?'
+            args.append(since)
+
+        query = 'SELECT docid FROM (' + query + ' ORDER BY docid DESC ' \
+                'LIMIT ?) ORDER BY rank(info) DESC, docid DESC LIMIT ?'
+
+        args += [RANK_WINDOW, limit]
+        ids = [row[0] for row in self._select(query, args)]
+
+        if not ids:
+            return []
+
+        # Joined with the messages, the full-text query would run once per
+        # message, so the snippets and the messages are read apart.
+        marks = ', '.join('?' * len(ids))
+        snippets = dict(self._select('SELECT docid, snippet(messages_index, '
+                                     '\'*\', \'*\', \'...\', -1, ?) FROM '
+                                     'messages_index WHERE messages_index '
+                                     'MATCH ? AND docid BETWEEN ? AND ? AND '
+                                     'docid IN (%s)' % marks,
+                                     [SNIPPET_WORDS, terms, min(ids),
+                                      max(ids)] + ids))
+        rows = self._select('SELECT id, peer, timestamp, direction, sender, '
+                            'body FROM messages WHERE id IN (%s)' % marks,
+                            ids)
+
+        results = dict((row[0], (Message(row), snippets[row[0]]))
+                       for row in rows if row[0] in snippets)
+
+        return [results[id_] for id_ in ids if id_ in results]
@@ -0,0 +1,263 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to keep track of the multi-user chat rooms (XEP-0045) joined by
+the user.
+"""
+
+import threading
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+# Maximum number of old messages sent by a room when it's joined
+HISTORY_STANZAS = 20
+
+# Rooms given without a domain are hosted by this service of the user server
+SERVICE_PREFIX = 'conference.'
+
+# XML namespaces
+NS_MUC = 'http://jabber.org/protocol/muc'
+NS_MUC_USER = NS_MUC + '#user'
+NS_MUC_OWNER = NS_MUC + '#owner'
+
+# Room states
+JOINING = 'joining'
+JOINED = 'joined'
+
+# Status codes of the occupant presences
+STATUS_SELF = '110'
+STATUS_CREATED = '201'
+STATUS_BANNED = '301'
+STATUS_NICK_CHANGED = '303'
+STATUS_KICKED = '307'
+
+def join_stanza(room, history_stanzas, since=None):
+    """
+    Builds the presence which joins a room.
+
+    :param room: The Room object.
+    :param history_stanzas: The maximum number of old messages the room
+                            sends back.
+    :param since: Only old messages from this timestamp on.
+
+    :return Returns the serialized stanza.
+    """
+    history = u' maxstanzas="%d"' % history_stanzas
+
+    if since is not None:
+        history += u' since="%s"' % time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                  time.gmtime(since))
+
+    password = u''
+
+    if room.password:
+        password = u'<password>%s</password>' % escape(room.password)
+
+    return u'<presence to=%s><x xmlns="%s"><history%s/>%s</x></presence>' % \
+            (quoteattr(room.jid + u'/' + room.nick), NS_MUC, history,
+             password)
+
+
+
+def leave_stanza(room):
+    """
+    Builds the presence which leaves a room.
+
+    :param room: The Room object.
+
+    :return Returns the serialized stanza.
+    """
+    return u'<presence to=%s type="unavailable"/>' % \
+            quoteattr(room.jid + u'/' + room.nick)
+
+
+
+def invite_stanza(room, users):
+    """
+    Builds a message inviting users to a room, through the room itself.
+
+    :param room: The Room object.
+    :param users: The JIDs of the invited users.
+
+    :return Returns the serialized stanza.
+    """
+    return u'<message to=%s><x xmlns="%s">%s</x></message>' % \
+            (quoteattr(room.jid), NS_MUC_USER,
+             u''.join(u'<invite to=%s/>' % quoteattr(user) for user in users))
+
+
+
+def instant_stanza(room, stanza_id):
+    """
+    Builds the request which unlocks a room just created, accepting its
+    default configuration (an instant room).
+
+    :param room: The Room object.
+    :param stanza_id: The request ID.
+
+    :return Returns the serialized stanza.
+    """
+    return u'<iq to=%s type="set" id="%s"><query xmlns="%s">' \
+            u'<x xmlns="jabber:x:data" type="submit"/></query></iq>' % \
+            (quoteattr(room.jid), stanza_id, NS_MUC_OWNER)
+
+
+
+class Occupant(object):
+    """
+    A room occupant.
+
+    :param jid: The occupant real JID, when the room tells it.
+    :param role: The occupant role in the room (moderator, participant...).
+    :param affiliation: The occupant affiliation (owner, member...).
+    :param show: The presence show value.
+    :param status: The free text status message.
+    """
+    __slots__ = ('jid', 'role', 'affiliation', 'show', 'status')
+
+    def __init__(self, jid, role, affiliation, show, status):
+        self.jid = jid
+        self.role = role
+        self.affiliation = affiliation
+        self.show = show
+        self.status = status
+
+
+    def __repr__(self):
+        return "Occupant(jid=%r, role=%r, affiliation=%r, show=%r, " \
+                "status=%r)" % (self.jid, self.role, self.affiliation,
+                                self.show, self.status)
+
+
+
+class Room(object):
+    """
+    A room joined by the user, with a table of its occupants indexed by
+    their nicks, so an occupant joining, leaving or changing its presence
+    takes constant time however crowded the room is. When the room is
+    joined it sends the presence of every occupant and ours at last, so the
+    room only becomes JOINED then.
+
+    :param jid: The room bare JID.
+    :param nick: The user nick in the room.
+    :param password: The room password, if it has one.
+    :param create: Indicates if the user wants a new room.
+    """
+    def __init__(self, jid, nick, password='', create=False):
+        self.jid = jid
+        self.nick = nick
+        self.password = password
+        self.create = create
+        self.state = JOINING
+        self._occupants = dict()
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+        return "Room(jid=%r, nick=%r, state=%r, occupants=%d)" % \
+                (self.jid, self.nick, self.state, len(self._occupants))
+
+
+    def __len__(self):
+        return len(self._occupants)
+
+
+    def update(self, nick, jid, role, affiliation, show, status):
+        """
+        Sets the presence of an occupant.
+
+        :param nick: The occupant nick.
+        :param jid: The occupant real JID, if known.
+        :param role: The occupant role.
+        :param affiliation: The occupant affiliation.
+        :param show: The presence show value.
+        :param status: The free text status message.
+
+        :return Returns True if the occupant has just entered the room.
+        """
+        occupant = Occupant(jid, role, affiliation, show, status)
+
+        with self._lock:
+            entered = nick not in self._occupants
+            self._occupants[nick] = occupant
+
+        return entered
+
+
+    def remove(self, nick):
+        """
+        Removes an occupant, which left the room.
+
+        :param nick: The occupant nick.
+
+        :return Returns the Occupant object or None if it wasn't known.
+        """
+        with self._lock:
+            return self._occupants.pop(nick, None)
+
+
+    def rename(self, nick, new_nick):
+        """
+        Changes the nick of an occupant.
+
+        :param nick: The current nick.
+        :param new_nick: The new nick.
+        """
+        with self._lock:
+            occupant = self._occupants.pop(nick, None)
+
+            if occupant is not None:
+                self._occupants[new_nick] = occupant
+
+            if nick == self.nick:
+                self.nick = new_nick
+
+
+    def get(self, nick):
+        """
+        Gets an occupant.
+
+        :param nick: The occupant nick.
+
+        :return Returns the Occupant object or None if there's no such
+                occupant.
+        """
+        return self._occupants.get(nick)
+
+
+    def occupants(self):
+        """
+        Gets every occupant.
+
+        :return Returns a list of (nick, Occupant) tuples, sorted by nick.
+        """
+        with self._lock:
+            occupants = self._occupants.items()
+
+        return sorted(occupants)
+
+
+    def clear(self):
+        """
+        Forgets every occupant, such as when the room must be joined again
+        in a new session.
+        """
+        with self._lock:
+            self._occupants.clear()
+            self.state = JOINING
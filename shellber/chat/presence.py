@@ -0,0 +1,208 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to keep track of the contacts presence.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Time, in seconds, which presence changes are gathered before being reported
+COALESCE_INTERVAL = 0.5
+
+# Presence states. Contacts may also be in the other XMPP show states: dnd
+# and xa.
+AVAILABLE = 'available'
+AWAY = 'away'
+CHAT = 'chat'
+OFFLINE = 'offline'
+
+# The user may also hide from everyone, without leaving the session
+INVISIBLE = 'invisible'
+
+class Status(object):
+    """
+    The presence of a single contact resource.
+
+    :param show: The presence show value (available, away, chat, dnd, xa).
+    :param status: The free text status message.
+    :param priority: The resource priority.
+    """
+    __slots__ = ('show', 'status', 'priority')
+
+    def __init__(self, show, status, priority):
+        self.show = show
+        self.status = status
+        self.priority = priority
+
+
+    def __repr__(self):
+        return "Status(show=%r, status=%r, priority=%r)" % \
+                (self.show, self.status, self.priority)
+
+
+
+# The presence of a contact without any available resource
+_OFFLINE = Status(OFFLINE, '', 0)
+
+class Presences(object):
+    """
+    A table with the presence of every resource of every contact, indexed by
+    the contact bare JID and by the resource, so both updates and lookups
+    take constant time.
+
+    Changes are not reported one by one. The first change starts a window
+    of @interval seconds and, at its end, @handle_changes is called once with
+    all contacts whose presence is different from the one they had when the
+    window started. A contact which went offline and came back within the
+    window isn't reported at all. So a presence storm, such as everyone
+    reconnecting after a server restart, results in a single report.
+
+    :param handle_changes: A function to be called, from a timer thread, with
+                           a list of (jid, Status) tuples.
+    :param interval: The time, in seconds, to gather changes.
+    """
+    def __init__(self, handle_changes, interval=COALESCE_INTERVAL):
+        self._handle_changes = handle_changes
+        self._interval = interval
+        self._resources = dict()
+        self._best = dict()
+        self._changed = OrderedDict()
+        self._timer = None
+        self._lock = threading.Lock()
+
+
+    def _update_best(self, jid):
+        """
+        Updates the presence of a contact from its most relevant resource.
+        Must be called with the internal lock held.
+
+        :param jid: The contact bare JID.
+        """
+        resources = self._resources.get(jid)
+        previous = self._best.get(jid, _OFFLINE)
+
+        if resources:
+            best = max(resources.itervalues(), key=lambda s: s.priority)
+            self._best[jid] = best
+        else:
+            self._resources.pop(jid, None)
+            self._best.pop(jid, None)
+
+        # Keep the presence from the beginning of the window only
+        if jid not in self._changed:
+            self._changed[jid] = previous
+
+        if self._timer is None:
+            self._timer = threading.Timer(self._interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+    def update(self, jid, resource, show, status='', priority=0):
+        """
+        Sets the presence of a contact resource.
+
+        :param jid: The contact bare JID.
+        :param resource: The contact resource.
+        :param show: The presence show value.
+        :param status: The free text status message.
+        :param priority: The resource priority.
+        """
+        with self._lock:
+            self._resources.setdefault(jid, dict())[resource] = \
+                    Status(show or AVAILABLE, status, priority)
+
+            self._update_best(jid)
+
+
+    def remove(self, jid, resource):
+        """
+        Removes a contact resource, which went offline.
+
+        :param jid: The contact bare JID.
+        :param resource: The contact resource.
+        """
+        with self._lock:
+            resources = self._resources.get(jid)
+
+            if not resources or resource not in resources:
+                return
+
+            del resources[resource]
+            self._update_best(jid)
+
+
+    def get(self, jid):
+        """
+        Gets the presence of a contact, from its resource with the highest
+        priority.
+
+        :param jid: The contact bare JID.
+
+        :return Returns a Status object.
+        """
+        return self._best.get(jid, _OFFLINE)
+
+
+    def resources(self, jid):
+        """
+        Gets the presence of every available resource of a contact.
+
+        :param jid: The contact bare JID.
+
+        :return Returns a dict mapping resources to Status objects.
+        """
+        with self._lock:
+            return dict(self._resources.get(jid, ()))
+
+
+    def clear(self):
+        """
+        Forgets every presence, such as when the session ends. Nothing is
+        reported.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            self._resources.clear()
+            self._best.clear()
+            self._changed.clear()
+
+
+    def flush(self):
+        """
+        Reports the changes gathered so far.
+        """
+        with self._lock:
+            self._timer = None
+            changed, self._changed = self._changed, OrderedDict()
+            changes = list()
+
+            for jid, previous in changed.iteritems():
+                current = self._best.get(jid, _OFFLINE)
+
+                if current.show != previous.show or \
+                        current.status != previous.status:
+                    changes.append((jid, current))
+
+        if changes:
+            self._handle_changes(changes)
@@ -0,0 +1,294 @@
+
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to keep a local copy of the user contacts list (the roster).
+"""
+
+import cPickle
+import logging
+import os
+import threading
+
+# Contact subscription flags
+FROM = 1
+TO = 2
+PENDING_IN = 4
+PENDING_OUT = 8
+WHITELISTED = 16
+
+_FLAGS = [
+    ('from', FROM),
+    ('to', TO),
+    ('pending_in', PENDING_IN),
+    ('pending_out', PENDING_OUT),
+    ('whitelisted', WHITELISTED),
+]
+
+# Supported contact list sorting keys
+SORT_KEYS = ('jid', 'name', 'subscription')
+
+class Contact(object):
+    """
+    A contact from the roster.
+
+    :param name: The user supplied alias for the contact.
+    :param groups: A tuple with the contact groups.
+    :param flags: The contact subscription flags (FROM, TO, etc).
+    """
+    __slots__ = ('name', 'groups', 'flags')
+
+    def __init__(self, name, groups, flags):
+        self.name = name
+        self.groups = groups
+        self.flags = flags
+
+
+    def __repr__(self):
+        return "Contact(name=%r, groups=%r, flags=%r)" % \
+                (self.name, self.groups, self.flags)
+
+
+    @property
+    def subscription(self):
+        subscription = self.flags & (FROM | TO)
+
+        return {
+            FROM: 'from',
+            TO: 'to',
+            FROM | TO: 'both'
+        }.get(subscription, 'none')
+
+
+
+class Roster(object):
+    """
+    A class to hold the roster of an account in memory, persisted into a
+    file, with its roster version (XEP-0237). At login, the server only
+    sends us the changes made since that version.
+
+    It implements the SleekXMPP roster datastore interface, so it's updated
+    by the SleekXMPP roster handling. Changes are only written to the file
+    when flush() is called.
+
+    The revision attribute is incremented whenever a contact is added or
+    removed, so users of jids() may tell when their copies are outdated.
+
+    :param filename: The file where the roster is saved.
+    :param owner: The bare JID of the roster owner.
+    """
+    def __init__(self, filename, owner):
+        self._filename = filename
+        self._owner = owner
+        self._version = ''
+        self._contacts = dict()
+        self._dirty = False
+        self.revision = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._load()
+
+
+    def _load(self):
+        try:
+            with open(self._filename, 'rb') as fd:
+                data = cPickle.load(fd)
+        except IOError:
+            return
+        except Exception as error:
+            logging.error("Ignoring invalid roster file %s: %s",
+                          self._filename, str(error))
+            return
+
+        self._version = data['version']
+        self._contacts = dict((jid, Contact(*item))
+                              for jid, item in data['contacts'].iteritems())
+
+
+    def flush(self):
+        """
+        Writes the roster to its file, if it has changed. A temporary file is
+        renamed over the old one, so a crash never leaves it half written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._dirty is False:
+                    return
+
+                data = {
+                    'version': self._version,
+                    'contacts': dict((jid, (c.name, c.groups, c.flags))
+                                     for jid, c in self._contacts.iteritems()),
+                }
+
+                self._dirty = False
+
+            directory = os.path.dirname(self._filename)
+
+            if directory and os.path.isdir(directory) is False:
+                os.makedirs(directory)
+
+            tmp_filename = self._filename + '.tmp'
+
+            with open(tmp_filename, 'wb') as fd:
+                cPickle.dump(data, fd, cPickle.HIGHEST_PROTOCOL)
+
+            os.rename(tmp_filename, self._filename)
+
+
+    def retain(self, jids):
+        """
+        Removes every contact which is not in @jids. Used when the server
+        sends the full roster instead of its changes.
+
+        :param jids: The contacts to keep.
+
+        :return Returns the removed contacts.
+        """
+        with self._lock:
+            removed = set(self._contacts) - set(jids)
+
+            for jid in removed:
+                del self._contacts[jid]
+
+            if removed:
+                self._dirty = True
+                self.revision += 1
+
+        return removed
+
+
+    def jids(self):
+        """
+        Gets the JIDs of all contacts, in no particular order.
+        """
+        with self._lock:
+            return self._contacts.keys()
+
+
+    def contacts(self, sort='jid', group=None, pattern=None, offset=0,
+                 limit=None):
+        """
+        Gets contacts from the roster.
+
+        :param sort: The sorting key, one of SORT_KEYS.
+        :param group: Only contacts from this group.
+        :param pattern: Only contacts with this text in their JID or name.
+        :param offset: The number of contacts to skip.
+        :param limit: The maximum number of contacts.
+
+        :return Returns a list of (jid, Contact) tuples.
+        """
+        if sort not in SORT_KEYS:
+            raise Exception("unknown sorting key: " + sort)
+
+        with self._lock:
+            contacts = self._contacts.items()
+
+        if group is not None:
+            contacts = ((jid, c) for jid, c in contacts if group in c.groups)
+
+        if pattern is not None:
+            pattern = pattern.lower()
+            contacts = ((jid, c) for jid, c in contacts
+                        if pattern in jid or pattern in c.name.lower())
+
+        key = {
+            'jid': lambda item: item[0],
+            'name': lambda item: (item[1].name.lower(), item[0]),
+            'subscription': lambda item: (item[1].subscription, item[0]),
+        }.get(sort)
+
+        contacts = sorted(contacts, key=key)
+
+        if limit is None:
+            return contacts[offset:]
+
+        return contacts[offset:offset + limit]
+
+
+    # The SleekXMPP roster datastore interface
+
+    def version(self, owner_jid):
+        return self._version
+
+
+    def set_version(self, owner_jid, version):
+        with self._lock:
+            if owner_jid == self._owner and version != self._version:
+                self._version = version
+                self._dirty = True
+
+
+    def entries(self, owner_jid, db_state=None):
+        if owner_jid is None:
+            return [self._owner]
+
+        if owner_jid != self._owner:
+            return []
+
+        return self._contacts.keys()
+
+
+    def load(self, owner_jid, jid, db_state):
+        contact = self._contacts.get(jid)
+
+        if owner_jid != self._owner or contact is None:
+            return None
+
+        item = {
+            'name': contact.name,
+            'groups': list(contact.groups),
+        }
+
+        for name, flag in _FLAGS:
+            item[name] = bool(contact.flags & flag)
+
+        return item
+
+
+    def save(self, owner_jid, jid, item_state, db_state):
+        if owner_jid != self._owner:
+            return
+
+        flags = 0
+
+        for name, flag in _FLAGS:
+            if item_state.get(name):
+                flags |= flag
+
+        contact = Contact(item_state['name'], tuple(item_state['groups']),
+                          flags)
+
+        with self._lock:
+            # SleekXMPP also creates items for any JID which sends us a
+            # presence, we only keep the ones with some relation to the user.
+            if item_state.get('removed') or \
+                    not (flags or contact.name or contact.groups):
+                if self._contacts.pop(jid, None) is not None:
+                    self._dirty = True
+                    self.revision += 1
+
+                return
+
+            if jid not in self._contacts:
+                self.revision += 1
+
+            self._contacts[jid] = contact
+            self._dirty = True
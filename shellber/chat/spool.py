@@ -0,0 +1,379 @@
+
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to keep the outgoing messages of an account while its session is
+down, until they can be sent.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+# Minimum time, in seconds, between two fsync() calls. Messages queued
+# meanwhile are written together.
+SYNC_INTERVAL = 0.01
+
+# Number of bytes read from the file at once
+READ_SIZE = 65536
+
+# Records larger than this are taken as corrupted
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+# Record kinds
+MESSAGE = 'm'
+ACK = 'a'
+
+# Every record starts with its payload size, the CRC32 of its kind and
+# payload, and its kind.
+_HEADER = struct.Struct('>IIc')
+_ACK = struct.Struct('>QQ')
+
+def _record(kind, payload):
+    return _HEADER.pack(len(payload),
+                        zlib.crc32(kind + payload) & 0xffffffff,
+                        kind) + payload
+
+
+
+def _scan(fd, offset):
+    """
+    Reads the records of a spool file.
+
+    :param fd: The file object.
+    :param offset: The offset of the first record.
+
+    :return Yields (end, kind, payload) tuples, with the file offset of the
+            end of each record. It stops at the end of the file or at the
+            first incomplete or corrupted record.
+    """
+    fd.seek(offset)
+    data = ''
+
+    while True:
+        chunk = fd.read(READ_SIZE)
+
+        if not chunk:
+            return
+
+        data += chunk
+        position = 0
+
+        while position + _HEADER.size <= len(data):
+            size, crc, kind = _HEADER.unpack_from(data, position)
+            start = position + _HEADER.size
+
+            if size > MAX_RECORD_SIZE:
+                return
+
+            if start + size > len(data):
+                break
+
+            payload = data[start:start + size]
+
+            if zlib.crc32(kind + payload) & 0xffffffff != crc:
+                return
+
+            position = start + size
+            yield offset + position, kind, payload
+
+        offset += position
+        data = data[position:]
+
+
+
+class Spool(object):
+    """
+    An append-only file, a write-ahead log, with the messages sent while
+    the session is down. Messages are kept as serialized stanzas, so
+    replaying them is only a matter of reading and sending them. Each one
+    gets a stanza ID which it keeps until it's delivered, so a message
+    replayed twice, after the session drops in the middle of a replay, can
+    be told apart by its ID.
+
+    Messages are only queued by append() and a background thread writes
+    them, in batches, with a single fsync() per batch: every message queued
+    within SYNC_INTERVAL seconds of the previous sync goes into the next
+    one. So spooling never waits for the disk, while a crash loses at most
+    the batches not synced yet. The end of a message which didn't make it
+    to the disk, torn by a crash, is dropped when the spool is opened again.
+
+    Messages are read back in order by read(). Once the server has received
+    them, ack() marks everything up to a file offset as done, through an
+    ack record. When every message is done the file is truncated, so it
+    only grows while messages are waiting.
+
+    :param filename: The spool file.
+    """
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+
+        if directory and os.path.isdir(directory) is False:
+            os.makedirs(directory)
+
+        self.filename = filename
+        self._prefix = uuid.uuid4().hex[:12]
+        self._sequence = 0
+        self._records = list()
+        self._appended = 0
+        self._written = 0
+        self._wake = False
+        self._stop = False
+
+        # The queued records are protected by their own lock, so append()
+        # doesn't wait for the writer while it holds the file lock.
+        self._queued = threading.Condition(threading.Lock())
+        self._lock = threading.Lock()
+        self._fd = open(filename, 'a+b')
+        self._end = 0
+        self._acked = 0
+        self._acked_messages = 0
+        self._written_ack = 0
+        self._cursor = 0
+        self._pending = 0
+        self._load()
+
+        self._writer = threading.Thread(name='spool', target=self._write)
+        self._writer.daemon = True
+        self._writer.start()
+
+
+    def __repr__(self):
+        return "Spool(filename=%r, pending=%r)" % (self.filename,
+                                                   self._pending)
+
+
+    def _load(self):
+        """
+        Finds the messages left by a previous run.
+        """
+        messages = 0
+        offset = 0
+
+        with open(self.filename, 'rb') as fd:
+            for offset, kind, payload in _scan(fd, 0):
+                if kind == MESSAGE:
+                    messages += 1
+                elif kind == ACK:
+                    self._acked, self._acked_messages = _ACK.unpack(payload)
+
+        if offset < os.path.getsize(self.filename):
+            logging.warning("Dropping the incomplete end of %s", self.filename)
+
+        self._pending = messages - self._acked_messages
+
+        if self._pending == 0:
+            offset = self._acked = self._acked_messages = 0
+
+        self._fd.truncate(offset)
+        self._end = offset
+        self._written_ack = self._acked
+        self._cursor = self._acked
+
+
+    def _write(self):
+        stop = False
+        synced = 0
+
+        while stop is False:
+            with self._queued:
+                while not self._records and self._wake is False:
+                    self._queued.wait()
+
+            # Waking up for every message would make the batches tiny and
+            # slow append() down, as it would compete with this thread.
+            delay = synced + SYNC_INTERVAL - time.time()
+
+            if delay > 0 and self._stop is False:
+                time.sleep(delay)
+
+            with self._queued:
+                records, self._records = self._records, list()
+                self._wake = False
+                stop = self._stop
+
+            data = ''.join(records)
+
+            with self._lock:
+                if self._acked > self._written_ack:
+                    data += _record(ACK, _ACK.pack(self._acked,
+                                                   self._acked_messages))
+                    self._written_ack = self._acked
+
+                try:
+                    if self._pending == 0 and self._end > 0:
+                        # Everything was sent, so we start over
+                        self._fd.truncate(0)
+                        self._end = self._acked = self._written_ack = 0
+                        self._acked_messages = self._cursor = 0
+                        data = ''
+
+                    if data:
+                        self._fd.write(data)
+                        self._fd.flush()
+                        os.fsync(self._fd.fileno())
+                        self._end += len(data)
+                        synced = time.time()
+                except (IOError, OSError) as error:
+                    # The messages are lost, but not the ones around them
+                    lost = sum(1 for r in records
+                               if r[_HEADER.size - 1] == MESSAGE)
+
+                    with self._queued:
+                        self._pending -= lost
+
+                    logging.error("Unable to spool %d messages: %s", lost,
+                                  str(error))
+
+                    try:
+                        self._fd.truncate(self._end)
+                    except (IOError, OSError):
+                        pass
+
+            with self._queued:
+                self._written += len(records)
+                self._queued.notify_all()
+
+
+    def append(self, destination, body, mtype='chat'):
+        """
+        Adds a message to the spool. It's only queued to be written.
+
+        :param destination: The recipient JID.
+        :param body: The message body.
+        :param mtype: The message type, such as 'chat' or 'groupchat'. It's
+                      kept in the spooled stanza, so the message is replayed
+                      as it was sent.
+
+        :return Returns the message stanza ID.
+        """
+        if isinstance(destination, unicode):
+            destination = destination.encode('utf-8')
+
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        destination = quoteattr(destination)
+        body = escape(body)
+
+        with self._queued:
+            self._sequence += 1
+            stanza_id = '%s-%d' % (self._prefix, self._sequence)
+            self._records.append(_record(
+                MESSAGE, '<message to=%s type="%s" id="%s"><body>%s'
+                '</body></message>' % (destination, mtype, stanza_id, body)))
+            self._appended += 1
+            self._pending += 1
+
+            if len(self._records) == 1:
+                self._queued.notify_all()
+
+        return stanza_id
+
+
+    def pending(self):
+        """
+        Gets the number of messages not acknowledged yet.
+        """
+        return self._pending
+
+
+    def read(self, limit):
+        """
+        Reads the next messages, among the ones already written.
+
+        :param limit: The maximum number of messages.
+
+        :return Returns a tuple with a list of message stanzas, serialized
+                as UTF-8, and the offset to be given to ack() once they're
+                received.
+        """
+        messages = list()
+
+        with self._lock, open(self.filename, 'rb') as fd:
+            for end, kind, payload in _scan(fd, self._cursor):
+                if end > self._end or len(messages) == limit:
+                    break
+
+                self._cursor = end
+
+                if kind == MESSAGE:
+                    messages.append(payload)
+
+            return messages, self._cursor
+
+
+    def rewind(self):
+        """
+        Makes read() start again from the first message not acknowledged,
+        such as when the session drops in the middle of a replay.
+        """
+        with self._lock:
+            self._cursor = self._acked
+
+
+    def ack(self, offset, count):
+        """
+        Marks the messages before a file offset as received.
+
+        :param offset: The offset returned by read().
+        :param count: The number of messages read up to @offset, since the
+                      previous ack.
+        """
+        with self._lock:
+            if offset <= self._acked or count > self._pending:
+                return
+
+            self._acked = offset
+            self._acked_messages += count
+
+            with self._queued:
+                self._pending -= count
+
+                # Wakes the writer up, to save the ack
+                self._wake = True
+                self._queued.notify_all()
+
+
+    def flush(self):
+        """
+        Waits until every queued message is written.
+        """
+        with self._queued:
+            appended = self._appended
+
+            while self._written < appended:
+                self._queued.wait()
+
+
+    def close(self):
+        """
+        Writes every queued message and closes the file.
+        """
+        with self._queued:
+            self._stop = self._wake = True
+            self._queued.notify_all()
+
+        self._writer.join()
+        self._fd.close()
@@ -0,0 +1,513 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A module to send and receive files (XEP-0096), through SOCKS5 (XEP-0065)
+or In-Band (XEP-0047) bytestreams.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import mmap
+import os
+import socket
+import threading
+import time
+import uuid
+
+from shellber.chat import compat
+
+# Size of each piece read from, or written to, the disk
+CHUNK_SIZE = 65536
+
+# Size of the file windows mapped into memory when sending through SOCKS5.
+# It must be a multiple of mmap.ALLOCATIONGRANULARITY.
+MAP_SIZE = 16 * 1024 * 1024
+
+# Size of each In-Band block and the number of blocks waiting for the
+# receiver acknowledge.
+IBB_BLOCK_SIZE = 4096
+IBB_WINDOW = 16
+
+# Minimum interval, in seconds, between two progress reports of a transfer
+PROGRESS_INTERVAL = 1.0
+
+# Time, in seconds, which the receiver waits for the next block
+RECEIVE_TIMEOUT = 60
+
+# Suffix of incomplete received files, which are resumed by later transfers,
+# and of the file next to each one with the sender, the name and the size
+# of the file it belongs to.
+PARTIAL_SUFFIX = '.part'
+INFO_SUFFIX = '.info'
+
+# Transfer directions
+SEND = 0
+RECEIVE = 1
+
+# Transfer states
+OFFERED = 'offered'
+ACTIVE = 'active'
+DONE = 'done'
+FAILED = 'failed'
+
+_SOCKS5 = 'http://jabber.org/protocol/bytestreams'
+_IBB = 'http://jabber.org/protocol/ibb'
+
+def partial_filename(directory, sender, name, size):
+    """
+    Gets the name of the incomplete file of a received one. It's unique to
+    the sender, the file name and its size, so the files of different
+    contacts, or different files with the same name, are never mixed.
+
+    :param directory: The directory of the received files.
+    :param sender: The bare JID of the sender.
+    :param name: The file name.
+    :param size: The file size, in bytes.
+    """
+    key = hashlib.sha1(u'\0'.join((sender.lower(), name, unicode(size)))
+                       .encode('utf-8')).hexdigest()[:16]
+
+    return os.path.join(directory, '%s.%s%s' % (name, key, PARTIAL_SUFFIX))
+
+
+
+def _info(sender, name, size):
+    return dict(sender=sender.lower(), name=name, size=size)
+
+
+
+def _read_info(partial):
+    """
+    Reads the sender, name and size of an incomplete file.
+
+    :return Returns a dict or None if they can't be read.
+    """
+    try:
+        with open(partial + INFO_SUFFIX, 'rb') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+
+def _link_unique(source, filename):
+    """
+    Links a file under a name which doesn't exist yet: @filename or, if
+    it's taken, <name>-1<extension>, <name>-2<extension> and so on.
+
+    :return Returns the new name.
+    """
+    base, extension = os.path.splitext(filename)
+    candidate = filename
+    index = 0
+
+    while True:
+        try:
+            # Unlike a rename, a link never replaces an existing file
+            os.link(source, candidate)
+            return candidate
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+        index += 1
+        candidate = '%s-%d%s' % (base, index, extension)
+
+
+
+
+class Transfer(object):
+    """
+    A file being sent or received.
+
+    :param direction: SEND or RECEIVE.
+    :param peer: The contact full JID.
+    :param filename: The local file name.
+    :param size: The file size, in bytes.
+    """
+    def __init__(self, direction, peer, filename, size):
+        self.sid = uuid.uuid4().hex
+        self.direction = direction
+        self.peer = peer
+        self.filename = filename
+        self.size = size
+        self.offset = 0
+        self.transferred = 0
+        self.state = OFFERED
+        self.error = ''
+        self.started = time.time()
+        self._reported = 0
+        self._partial = None
+
+
+    def __repr__(self):
+        return "Transfer(peer=%r, filename=%r, size=%r, transferred=%r, " \
+                "state=%r)" % (self.peer, self.filename, self.size,
+                               self.transferred, self.state)
+
+
+    @property
+    def progress(self):
+        """
+        The transferred percentage of the file, including any resumed part.
+        """
+        if not self.size:
+            return 100.0
+
+        return 100.0 * (self.offset + self.transferred) / self.size
+
+
+    @property
+    def rate(self):
+        """
+        The transfer rate, in bytes per second.
+        """
+        return self.transferred / max(time.time() - self.started, 0.001)
+
+
+
+class Transfers(object):
+    """
+    A class to handle the file transfers of a session. Each transfer runs on
+    its own thread, so several of them may be active at the same time, and
+    files are streamed from and to the disk in small pieces, so they're never
+    loaded into memory.
+
+    Received files are accepted from roster contacts only and are written to
+    a partial file, see partial_filename(), until they're complete. When a
+    contact sends a file with the same name and size again the transfer is
+    resumed from the end of the partial one. A complete file never replaces
+    an existing one, it's saved under a new name instead, see
+    _link_unique().
+
+    :param handle_progress: A function to be called with a Transfer object
+                            when its state changes and, while it's active,
+                            every PROGRESS_INTERVAL seconds.
+    :param directory: The directory where received files are saved. If
+                      omitted, files are not accepted.
+    """
+    def __init__(self, handle_progress, directory=None):
+        self._handle_progress = handle_progress
+        self._directory = directory
+        self._xmpp = None
+        self._transfers = dict()
+        self._lock = threading.Lock()
+
+
+    def attach(self, xmpp):
+        """
+        Registers the file transfer plugins and handlers into a new client.
+
+        :param xmpp: The sleekxmpp.ClientXMPP object.
+        """
+        self._xmpp = xmpp
+        xmpp.register_plugin('xep_0030')
+        xmpp.register_plugin('xep_0047')
+        xmpp.register_plugin('xep_0065')
+        xmpp.register_plugin('xep_0096')
+
+        # Prefer SOCKS5 when a contact offers both stream methods
+        xmpp['xep_0095'].unregister_method(_SOCKS5)
+        xmpp['xep_0095'].register_method(_SOCKS5, 'xep_0065', 10)
+        xmpp.add_event_handler('si_request', self._offer_received)
+
+
+    def _report(self, transfer, state=None, error=''):
+        if state is not None:
+            transfer.state = state
+            transfer.error = error
+        elif time.time() - transfer._reported < PROGRESS_INTERVAL:
+            return
+
+        transfer._reported = time.time()
+
+        if transfer.state in (DONE, FAILED):
+            with self._lock:
+                self._transfers.pop(transfer.sid, None)
+
+        if self._handle_progress is not None:
+            self._handle_progress(transfer)
+
+
+    def _start(self, transfer, target, *args):
+        with self._lock:
+            self._transfers[transfer.sid] = transfer
+
+        thread = threading.Thread(name='transfer_' + transfer.sid,
+                                  target=self._run,
+                                  args=(transfer, target) + args)
+        thread.daemon = True
+        thread.start()
+
+
+    def _run(self, transfer, target, *args):
+        try:
+            target(transfer, *args)
+        except Exception as error:
+            logging.exception("file transfer %s failed", transfer.sid)
+            self._report(transfer, FAILED, str(error) or type(error).__name__)
+        else:
+            self._report(transfer, DONE)
+
+
+    def active(self):
+        """
+        Gets the transfers which didn't finish yet.
+
+        :return Returns a list of Transfer objects.
+        """
+        with self._lock:
+            return self._transfers.values()
+
+
+    def send(self, peer, filename):
+        """
+        Offers a file to a contact and, once accepted, sends it in the
+        background.
+
+        :param peer: The contact full JID.
+        :param filename: The file to send.
+
+        :return Returns the Transfer object.
+        """
+        if os.path.isfile(filename) is False:
+            raise Exception("file not found: " + filename)
+
+        transfer = Transfer(SEND, peer, filename, os.path.getsize(filename))
+        self._start(transfer, self._send)
+
+        return transfer
+
+
+    def _send(self, transfer):
+        xmpp = self._xmpp
+        methods = [_IBB]
+
+        try:
+            if xmpp['xep_0065'].discover_proxies():
+                methods.insert(0, _SOCKS5)
+        except Exception:
+            logging.debug("no SOCKS5 proxy available", exc_info=True)
+
+        response = xmpp['xep_0096'].request_file_transfer(
+            transfer.peer, sid=transfer.sid,
+            name=os.path.basename(transfer.filename), size=transfer.size,
+            allow_ranged=True, methods=methods)
+
+        # The receiver asks for the remaining part of a previous transfer
+        offset = response['si']['file']['range']['offset']
+
+        if offset:
+            transfer.offset = min(int(offset), transfer.size)
+
+        method = response['si']['feature_neg']['form'].get_values().get(
+            'stream-method')
+
+        self._report(transfer, ACTIVE)
+
+        with open(transfer.filename, 'rb') as fd:
+            if method == _SOCKS5:
+                stream = xmpp['xep_0065'].handshake(transfer.peer,
+                                                    sid=transfer.sid)
+
+                if stream is None:
+                    raise Exception("unable to connect to the SOCKS5 proxy")
+
+                try:
+                    self._send_mapped(transfer, fd, stream)
+                finally:
+                    stream.close()
+            else:
+                stream = xmpp['xep_0047'].open_stream(transfer.peer,
+                                                      sid=transfer.sid,
+                                                      block_size=IBB_BLOCK_SIZE,
+                                                      window=IBB_WINDOW)
+                try:
+                    self._send_blocks(transfer, fd, stream)
+                finally:
+                    stream.close()
+
+
+    def _send_mapped(self, transfer, fd, stream):
+        """
+        Sends a file through a socket, straight from windows of the file
+        mapped into memory, so its data is never copied into Python strings.
+        Each window is unmapped after being sent, keeping the memory usage
+        flat whatever the file size.
+        """
+        position = transfer.offset
+
+        while position < transfer.size:
+            start = position - position % mmap.ALLOCATIONGRANULARITY
+            length = min(MAP_SIZE, transfer.size - start)
+            window = mmap.mmap(fd.fileno(), length, access=mmap.ACCESS_READ,
+                               offset=start)
+
+            try:
+                while position < start + length:
+                    end = min(position + CHUNK_SIZE, start + length)
+                    stream.sendall(buffer(window, position - start,
+                                          end - position))
+
+                    transfer.transferred += end - position
+                    position = end
+                    self._report(transfer)
+            finally:
+                window.close()
+
+
+    def _send_blocks(self, transfer, fd, stream):
+        """
+        Sends a file through an In-Band bytestream. Blocks must be encoded
+        into stanzas, so they're read one at a time. The stream window keeps
+        at most IBB_WINDOW blocks waiting for the receiver.
+        """
+        fd.seek(transfer.offset)
+
+        while True:
+            data = fd.read(IBB_BLOCK_SIZE)
+
+            if not data:
+                break
+
+            stream.sendall(data)
+            transfer.transferred += len(data)
+            self._report(transfer)
+
+        # Wait for the last acknowledges before closing the stream
+        compat.wait_blocks_acked(stream, RECEIVE_TIMEOUT)
+
+
+    def _offer_received(self, iq):
+        xmpp = self._xmpp
+        peer = iq['from']
+        sid = iq['si']['id']
+        name = os.path.basename(iq['si']['file']['name'] or sid)
+        size = int(iq['si']['file']['size'] or 0)
+
+        if self._directory is None or \
+                xmpp.client_roster.has_jid(peer.bare) is False:
+            logging.info("file %s from %s declined", name, peer)
+            xmpp['xep_0095'].decline(peer, sid)
+            return
+
+        if os.path.isdir(self._directory) is False:
+            os.makedirs(self._directory)
+
+        transfer = Transfer(RECEIVE, peer.full,
+                            os.path.join(self._directory, name), size)
+
+        transfer.sid = sid
+        transfer._partial = partial_filename(self._directory, peer.bare,
+                                             name, size)
+        payload = None
+
+        # The same file from the same contact can't be written twice at once
+        with self._lock:
+            busy = any(other._partial == transfer._partial
+                       for other in self._transfers.itervalues())
+
+            if busy is False:
+                self._transfers[transfer.sid] = transfer
+
+        if busy:
+            logging.info("file %s from %s declined, it's being received",
+                         name, peer)
+            xmpp['xep_0095'].decline(peer, sid)
+            return
+
+        info = _info(peer.bare, name, size)
+
+        # Resume a previous transfer of this file, if the sender allows it
+        if os.path.isfile(transfer._partial) and \
+                _read_info(transfer._partial) == info and \
+                iq['si']['file'].xml.find(
+                    '{%s}range' % iq['si']['file'].namespace) is not None:
+            transfer.offset = min(os.path.getsize(transfer._partial), size)
+            payload = xmpp['xep_0096'].stanza.File()
+            payload['range']['offset'] = transfer.offset
+        else:
+            with open(transfer._partial, 'wb'):
+                pass
+
+            with open(transfer._partial + INFO_SUFFIX, 'wb') as fd:
+                json.dump(info, fd)
+
+        xmpp['xep_0095'].accept(
+            peer, sid, payload=payload,
+            stream_handler=lambda stream: self._run(transfer, self._receive,
+                                                    stream))
+
+
+    def _receive(self, transfer, stream):
+        self._report(transfer, ACTIVE)
+        partial = transfer._partial
+
+        with open(partial, 'ab') as fd:
+            fd.truncate(transfer.offset)
+
+            if isinstance(stream, socket.socket):
+                self._receive_socket(transfer, stream, fd)
+            else:
+                self._receive_blocks(transfer, stream, fd)
+
+        if transfer.offset + transfer.transferred < transfer.size:
+            raise Exception("transfer interrupted, it will be resumed when "
+                            "the file is sent again")
+
+        transfer.filename = _link_unique(partial, transfer.filename)
+        os.remove(partial)
+        os.remove(partial + INFO_SUFFIX)
+
+
+    def _receive_socket(self, transfer, stream, fd):
+        stream.settimeout(RECEIVE_TIMEOUT)
+
+        try:
+            while transfer.offset + transfer.transferred < transfer.size:
+                data = stream.recv(CHUNK_SIZE)
+
+                if not data:
+                    break
+
+                fd.write(data)
+                transfer.transferred += len(data)
+                self._report(transfer)
+        finally:
+            stream.close()
+
+
+    def _receive_blocks(self, transfer, stream, fd):
+        while transfer.offset + transfer.transferred < transfer.size:
+            data = compat.read_block(stream, 1)
+
+            if data is None:
+                if time.time() - transfer._reported > RECEIVE_TIMEOUT:
+                    break
+
+                continue
+
+            if not data:
+                break
+
+            fd.write(data)
+            transfer.transferred += len(data)
+            self._report(transfer)
@@ -36,6 +36,9 @@ CMD_QUIT = 'quit'
 CMD_QUIT_APP = 'app'
 
 # Main commands
+CMD_ACCOUNT = 'account'
+CMD_ACCOUNT_LIST = 'list'
+CMD_ACCOUNT_USE = 'use'
 CMD_CHAT = 'chat'
 CMD_CONTACT = 'contact'
 CMD_CONTACT_ADD = 'add'
@@ -52,8 +55,21 @@ CMD_GROUP = 'group'
 CMD_GROUP_CREATE = 'create'
 CMD_GROUP_INVITE = 'invite'
 CMD_GROUP_JOIN = 'join'
+CMD_GROUP_LEAVE = 'leave'
+CMD_GROUP_OCCUPANTS = 'who'
 CMD_FILE = 'file'
 CMD_FILETO = 'fileto'
+CMD_HISTORY = 'history'
+CMD_SEARCH = 'search'
+CMD_ARCHIVE = 'archive'
+
+# Command options
+CMD_OPTION_FROM = '--from'
+CMD_OPTION_GROUP = '--group'
+CMD_OPTION_LIMIT = '--limit'
+CMD_OPTION_OFFSET = '--offset'
+CMD_OPTION_SINCE = '--since'
+CMD_OPTION_SORT = '--sort'
 CMD_UNCHAT = 'unchat'
 CMD_CONFIG = 'config'
 CMD_PRESENCE = 'presence'
@@ -71,6 +87,9 @@ CMD_CFG_SET_SERVER = 'server'
 CMD_CFG_SET_HOST = 'host'
 CMD_CFG_SHOW = 'show'
 
+# The contact_argument of commands whose every argument is a contact
+ANY_ARGUMENT = -1
+
 class Commands(object):
     def __init__(self):
         self._commands = dict()
@@ -92,7 +111,16 @@ class Commands(object):
         return iter(self._commands)
 
 
-    def sub_command(self, command, help_, required=0, optional=0):
+    def sub_command(self, command, help_, required=0, optional=0,
+                    contact_argument=None):
+        """
+        Creates the description of a command.
+
+        :param contact_argument: The position of the argument which is a
+                                 contact JID, counting from zero after the
+                                 command, or ANY_ARGUMENT. It's completed
+                                 from the roster.
+        """
         cmd = dict()
 
         cmd[command] = {
@@ -101,13 +129,18 @@ class Commands(object):
             'optional_arguments': optional,
         }
 
+        if contact_argument is not None:
+            cmd[command]['contact_argument'] = contact_argument
+
         return cmd
 
 
     def add_command(self, command, help_, sub_commands='', description='',
-                    required_arguments=0, optional_arguments=0):
+                    required_arguments=0, optional_arguments=0,
+                    contact_argument=None):
         cmd = self.sub_command(command, help_, required=required_arguments,
-                               optional=optional_arguments)
+                               optional=optional_arguments,
+                               contact_argument=contact_argument)
 
         if sub_commands:
             cmd[command]['sub_commands'] = sub_commands
@@ -121,6 +154,14 @@ class Commands(object):
     def populate_commands(self):
         self._commands = collections.OrderedDict(sorted(self._commands.items()))
 
+        # The sub-commands are indexed once here, as validate() runs for
+        # every command.
+        for info in self._commands.itervalues():
+            if info.get('sub_commands'):
+                info['sub_command_info'] = dict(sub_cmd.items()[0]
+                                                for sub_cmd
+                                                in info['sub_commands'])
+
 
     def known_command(self, command):
         if self._commands.get(command) is None:
@@ -205,28 +246,31 @@ class Commands(object):
         Function to validate if @cmd is known and, if supports, has its
         arguments correct.
 
-        :param cmd: The command to validate.
+        :param cmd: The command to validate, with the INFO of the known
+                    commands.
 
         :return Raises an exception if the command is invalid.
         """
-        args = cmd.get(shellber.ui.input.ARGUMENTS, 'empty').split(' ')
         info = cmd.get(shellber.ui.input.INFO)
 
-        if cmd.get(shellber.ui.input.COMMAND) not in self._commands:
+        if info is None:
             raise Exception("Unknown command")
 
-        if info['required_arguments'] > 0:
-            tests = [
-                len(args) >= info['required_arguments'],
-                args[0] != 'empty'
-            ]
+        required = info['required_arguments']
+        sub_commands = info.get('sub_command_info')
+
+        if required == 0 and sub_commands is None:
+            return
+
+        # Only the arguments we check are split, not a whole message body
+        args = cmd.get(shellber.ui.input.ARGUMENTS)
+        args = args.split(' ', max(required, 1)) if args is not None else []
 
-            if not all(tests):
-                raise Exception("Wrong arguments, see help for details")
+        if len(args) < required:
+            raise Exception("Wrong arguments, see help for details")
 
-        if info.has_key('sub_commands') and args[0] != 'empty':
-            if args[0] not in [s.keys()[0] for s in info['sub_commands']]:
-                raise Exception("Unknown argument, see help for details")
+        if sub_commands is not None and args and args[0] not in sub_commands:
+            raise Exception("Unknown argument, see help for details")
 
 
 
@@ -241,20 +285,35 @@ class UserCommands(Commands):
                                      'where we pass the the service name '
                                      'running on the server.\n\nExample:\n\n'
                                      '  ${cmd}login${ccmd} user password '
-                                     'jabber.com [service]\n')
+                                     'jabber.com [service]\n\n'
+                                     'Without arguments it uses the account '
+                                     'from the configuration file, and with '
+                                     'a single one it uses the named account '
+                                     'from its accounts section. Every login '
+                                     'keeps the other sessions open, see the '
+                                     '${cmd}account${ccmd} command.\n')
 
         self.add_command(CMD_MSG, 'Sends a message to the active contact.',
                          required_arguments=1)
 
         self.add_command(CMD_MSGTO, 'Sends a message to a specific contact.',
-                         required_arguments=2)
+                         required_arguments=2, contact_argument=0,
+                         description='Several contacts may be given, '
+                                     'separated by commas, and also files '
+                                     'with one contact per line, as '
+                                     '@filename. The message is sent to all '
+                                     'of them at once and the delivery to '
+                                     'each one is reported later.\n\n'
+                                     'Example:\n\n'
+                                     '  ${cmd}msgto${ccmd} '
+                                     'bob@jabber.com,@ops.txt disk full\n')
 
         self.add_command(CMD_MSGGR, 'Sends a message to a group.',
-                         required_arguments=2)
+                         required_arguments=2, contact_argument=0)
 
         self.add_command(CMD_CHAT,
                          'Creates a virtual chat room with a specific contact.',
-                         required_arguments=1,
+                         required_arguments=1, contact_argument=0,
                          description='This command must receive as argument '
                                      'a contact name to establish a chat with '
                                      'it.\n')
@@ -268,10 +327,34 @@ class UserCommands(Commands):
                              self.sub_command(CMD_GROUP_CREATE,
                                               'Create groups'),
                              self.sub_command(CMD_GROUP_INVITE,
-                                              'Invite users to group chat'),
+                                              'Invite users to group chat',
+                                              contact_argument=ANY_ARGUMENT),
                              self.sub_command(CMD_GROUP_JOIN,
-                                              'Join a group chat')],
-                         description='Only a brief description')
+                                              'Join a group chat',
+                                              contact_argument=0),
+                             self.sub_command(CMD_GROUP_LEAVE,
+                                              'Leave a group chat'),
+                             self.sub_command(CMD_GROUP_OCCUPANTS,
+                                              'List the occupants of a group '
+                                              'chat')],
+                         description='Groups are given by their JID, such as '
+                                     'room@conference.jabber.org, or only by '
+                                     'their name, for the conference service '
+                                     'of the account server. A nick may be '
+                                     'given as the resource, otherwise the '
+                                     'username is used. Invitations go to '
+                                     'the active chat group. The groups '
+                                     'listed as rooms in an account '
+                                     'configuration are joined at its '
+                                     'login.\n\n'
+                                     'Example:\n\n'
+                                     '  ${cmd}group${ccmd} join '
+                                     'devs@conference.jabber.com/bob '
+                                     '[password]\n'
+                                     '  ${cmd}chat${ccmd} '
+                                     'devs@conference.jabber.com\n'
+                                     '  ${cmd}group${ccmd} invite '
+                                     'alice@jabber.com\n')
 
         self.add_command(CMD_CONTACT, 'Manipulates the user contacts.',
                          required_arguments=1,
@@ -281,11 +364,25 @@ class UserCommands(Commands):
                                               'list.'),
                              self.sub_command(CMD_CONTACT_DEL,
                                               'Deletes a contact from the '
-                                              'user list.'),
+                                              'user list.',
+                                              contact_argument=0),
                              self.sub_command(CMD_CONTACT_LIST,
                                               'List all contacts from the '
                                               'user list.')
-                         ])
+                         ],
+                         description='The list sub-command accepts a text '
+                                     'to search in the contacts JID or name '
+                                     'and the options:\n\n'
+                                     '  --group GROUP\t\tOnly contacts from '
+                                     'a group.\n'
+                                     '  --sort jid|name|subscription\tSorts '
+                                     'the contacts.\n'
+                                     '  --offset N\t\t\tSkips the first N '
+                                     'contacts.\n'
+                                     '  --limit N\t\t\tShows at most N '
+                                     'contacts.\n\nExample:\n\n'
+                                     '  ${cmd}contact${ccmd} list --group '
+                                     'work --sort name --limit 50\n')
 
         self.add_command(CMD_PRESENCE, 'Sets the user presence to others.',
                          required_arguments=1,
@@ -301,12 +398,98 @@ class UserCommands(Commands):
                                               'Sets presence as offline.'),
                              self.sub_command(CMD_PRESENCE_INVISIBLE,
                                               'Sets presence as invisible.')
-                         ])
-
-        self.add_command(CMD_FILE, 'Sends a file to the active contact.')
-        self.add_command(CMD_FILETO, 'Sends a file to a specific contact.')
+                         ],
+                         description='Any text after the sub-command is sent '
+                                     'as the status message. The presence '
+                                     'is sent again at every login.\n\n'
+                                     'Example:\n\n'
+                                     '  ${cmd}presence${ccmd} away out for '
+                                     'lunch\n')
+
+        self.add_command(CMD_HISTORY,
+                         'Shows the messages exchanged with a contact.',
+                         required_arguments=1, contact_argument=0,
+                         description='This command must receive as argument '
+                                     'a contact or a group name. By default '
+                                     'the last 20 messages are shown. It also '
+                                     'accepts the options:\n\n'
+                                     '  --since YYYY-MM-DD[THH:MM]\tShows '
+                                     'messages from this date on.\n'
+                                     '  --limit N\t\t\tShows at most N '
+                                     'messages.\n\nExample:\n\n'
+                                     '  ${cmd}history${ccmd} user@jabber.com '
+                                     '--since 2016-05-01 --limit 100\n')
+
+        self.add_command(CMD_SEARCH, 'Searches messages in the history.',
+                         required_arguments=1,
+                         description='This command must receive as argument '
+                                     'the terms to search. Terms between '
+                                     'quotes are searched as a phrase and '
+                                     'terms ending with * as a prefix. It '
+                                     'also accepts the options:\n\n'
+                                     '  --from CONTACT\t\tOnly messages '
+                                     'with a contact or a group.\n'
+                                     '  --since YYYY-MM-DD[THH:MM]\tOnly '
+                                     'messages from this date on.\n'
+                                     '  --limit N\t\t\tShows at most N '
+                                     'messages.\n\nExample:\n\n'
+                                     '  ${cmd}search${ccmd} deploy failed '
+                                     '--from ops@jabber.com\n')
+
+        self.add_command(CMD_ARCHIVE,
+                         'Fetches the messages kept by the server archive.',
+                         contact_argument=0,
+                         description='Messages are fetched in the '
+                                     'background, saved in the history and '
+                                     'shown as they arrive. Without '
+                                     'arguments, the conversations of the '
+                                     'last day are fetched, as at every '
+                                     'login. It also accepts contacts as '
+                                     'arguments and the option:\n\n'
+                                     '  --since YYYY-MM-DD[THH:MM]\tFetches '
+                                     'messages from this date on.\n\n'
+                                     'Example:\n\n'
+                                     '  ${cmd}archive${ccmd} user@jabber.com '
+                                     '--since 2016-05-01\n')
+
+        self.add_command(CMD_FILE, 'Sends a file to the active contact.',
+                         description='Files are sent in the background, '
+                                     'reporting their progress. Without '
+                                     'arguments, this command shows the '
+                                     'transfers in progress.\n\nFiles '
+                                     'received from contacts are saved into '
+                                     'the configured download directory. An '
+                                     'interrupted transfer is resumed when '
+                                     'the same file is sent again.\n\n'
+                                     'Example:\n\n'
+                                     '  ${cmd}file${ccmd} /tmp/report.pdf\n')
+
+        self.add_command(CMD_FILETO, 'Sends a file to a specific contact.',
+                         required_arguments=2, contact_argument=0,
+                         description='Example:\n\n'
+                                     '  ${cmd}fileto${ccmd} '
+                                     'bob@jabber.com /tmp/report.pdf\n')
         self.add_command(CMD_REGISTER, 'Register an account.')
-        self.add_command(CMD_LOGOUT, 'Makes the logout from a server.')
+        self.add_command(CMD_ACCOUNT, 'Manipulates the logged in accounts.',
+                         required_arguments=1,
+                         sub_commands=[
+                             self.sub_command(CMD_ACCOUNT_LIST,
+                                              'Lists the logged in '
+                                              'accounts.'),
+                             self.sub_command(CMD_ACCOUNT_USE,
+                                              'Makes an account the active '
+                                              'one.', required=1)
+                         ],
+                         description='Every command, such as '
+                                     '${cmd}msg${ccmd} or ${cmd}contact'
+                                     '${ccmd}, acts on the active account. '
+                                     'Messages received by the other ones '
+                                     'are shown with the account name.\n\n'
+                                     'Example:\n\n'
+                                     '  ${cmd}account${ccmd} use work\n')
+
+        self.add_command(CMD_LOGOUT, 'Makes the logout from the active '
+                                     'account.')
         self.add_command(CMD_UNCHAT, 'Closes an active chat room.')
         self.add_command(CMD_CONFIG, 'Enter in configuration mode.')
         self.populate_commands()
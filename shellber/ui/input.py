@@ -21,56 +21,298 @@
 Objects to handle user input.
 """
 
-import readline
+import logging
 
 import shellber.ui.commands as commands
 
 PROMPT = '$> '
 
+# Maximum number of completions offered for a single word
+COMPLETION_LIMIT = 1000
+
 # User command
 COMMAND = 'command'
 ARGUMENTS = 'arguments'
 INFO = 'info'
 
+def _parse(line, commands_):
+    """
+    Splits a command line into the command and its arguments.
+
+    :param line: The command line.
+    :param commands_: The commands.Commands object of the environment.
+
+    :return Returns the command dictionary.
+    """
+    # We always have a command beggining the line. At least that's
+    # the expected.
+    data = line.strip().split(' ', 1)
+
+    command = dict()
+    command[COMMAND] = data[0]
+
+    if len(data) > 1:
+        command[ARGUMENTS] = data[1]
+
+    # Do we have a known command? Yes, insert its info too ;-)
+    info = commands_.info(command[COMMAND])
+
+    if info is not None:
+        command[INFO] = info
+
+    return command
+
+
+
+class _Node(object):
+    """
+    A node of a _Trie, reached through the @label edge from its parent.
+    """
+    __slots__ = ('label', 'children', 'word')
+
+    def __init__(self, label, word=None):
+        self.label = label
+        self.children = None
+        self.word = word
+
+
+
+class _Trie(object):
+    """
+    A radix tree of words: a prefix tree whose edges are labelled with
+    whole substrings instead of single characters, so a large set of words
+    such as a roster takes about one node per word. Finding the words which
+    start with a prefix walks at most len(prefix) characters, whatever the
+    number of words.
+
+    :param words: The words of the tree.
+    """
+    def __init__(self, words=()):
+        self._root = _Node('')
+
+        for word in words:
+            self.add(word)
+
+
+    def add(self, word):
+        node = self._root
+        position = 0
+
+        while position < len(word):
+            if node.children is None:
+                node.children = dict()
+
+            child = node.children.get(word[position])
+
+            if child is None:
+                node.children[word[position]] = _Node(word[position:], word)
+                return
+
+            # Walk along the common part of the edge label and the word,
+            # splitting the edge where they differ.
+            label = child.label
+            common = 1
+
+            while common < len(label) and position + common < len(word) and \
+                    label[common] == word[position + common]:
+                common += 1
+
+            if common < len(label):
+                middle = _Node(label[:common])
+                child.label = label[common:]
+                middle.children = {child.label[0]: child}
+                node.children[word[position]] = middle
+                child = middle
+
+            node = child
+            position += common
+
+        node.word = word
+
+
+    def _find(self, prefix):
+        node = self._root
+        position = 0
+
+        while position < len(prefix):
+            child = node.children and node.children.get(prefix[position])
+
+            if not child:
+                return None
+
+            rest = prefix[position:position + len(child.label)]
+
+            if not child.label.startswith(rest):
+                return None
+
+            node = child
+            position += len(rest)
+
+        return node
+
+
+    def words(self, prefix, limit=None):
+        """
+        Gets the words which start with a prefix, sorted.
+
+        :param prefix: The prefix.
+        :param limit: The maximum number of words.
+
+        :return Returns a list of words.
+        """
+        words = list()
+        node = self._find(prefix)
+        pending = [node] if node is not None else []
+
+        while pending and (limit is None or len(words) < limit):
+            node = pending.pop()
+
+            if node.word is not None:
+                words.append(node.word)
+
+            if node.children:
+                pending.extend(node.children[key]
+                               for key in sorted(node.children, reverse=True))
+
+        return words
+
+
+
 class _Completer(object):
-    def __init__(self, options):
-        self.options = sorted(options)
+    """
+    Completes the command line: the commands, their sub-commands and the
+    arguments which are contacts, from the roster.
+
+    :param commands_: The commands.Commands object of the environment.
+    :param line_before: A function returning the command line before the
+                        word being completed.
+    :param roster: A function returning the roster.Roster object of the
+                   active session, or None.
+    """
+    def __init__(self, commands_, line_before, roster=None):
+        self._commands = commands_
+        self._line_before = line_before
+        self._roster = roster
+        self._command_trie = _Trie(commands_.supported_commands())
+        self._sub_command_tries = dict()
+        self._contacts = None
+        self._contacts_key = None
+        self.matches = []
 
+        for command in commands_.supported_commands():
+            sub_commands = commands_.info(command).get('sub_command_info')
 
-    def complete(self, text, state):
-        response = None
+            if sub_commands:
+                self._sub_command_tries[command] = _Trie(sub_commands)
 
+
+    def _contact_trie(self):
+        roster = self._roster() if self._roster is not None else None
+
+        if roster is None:
+            return None
+
+        # Rebuilt only when the roster has gained or lost contacts
+        key = (id(roster), roster.revision)
+
+        if key != self._contacts_key:
+            self._contacts = _Trie(roster.jids())
+            self._contacts_key = key
+
+        return self._contacts
+
+
+    def _candidates(self, text):
+        line = self._line_before()
+        words = line.split()
+
+        # The word being completed may follow a comma, as in a list of
+        # recipients, so its first part is not a finished argument.
+        if line and not line[-1].isspace():
+            words.pop()
+
+        if not words:
+            return self._command_trie.words(text, COMPLETION_LIMIT)
+
+        info = self._commands.info(words[0])
+
+        if info is None:
+            return []
+
+        arguments = words[1:]
+        sub_commands = info.get('sub_command_info')
+
+        if sub_commands:
+            if not arguments:
+                return self._sub_command_tries[words[0]].words(
+                    text, COMPLETION_LIMIT)
+
+            info = sub_commands.get(arguments[0])
+
+            if info is None:
+                return []
+
+            arguments = arguments[1:]
+
+        position = info.get('contact_argument')
+
+        if position is None or \
+                position not in (len(arguments), commands.ANY_ARGUMENT):
+            return []
+
+        contacts = self._contact_trie()
+
+        if contacts is None:
+            return []
+
+        return contacts.words(text, COMPLETION_LIMIT)
+
+
+    def complete(self, text, state):
         if state == 0:
-            if text:
-                self.matches = [
-                    s for s in self.options if s and s.startswith(text)
-                ]
-            else:
-                self.matches = self.options[:]
+            try:
+                self.matches = self._candidates(text)
+            except Exception:
+                # readline silently drops the exceptions of a completer
+                logging.exception("completion failed")
+                self.matches = []
 
         try:
-            response = self.matches[state]
+            return self.matches[state]
         except IndexError:
-            response = None
-
-        return response
+            return None
 
 
 
 class Input(object):
     """
     A class to handle the input from the user.
+
+    :param output_: The output.Output object.
+    :param env: The initial commands environment.
+    :param roster: A function returning the roster.Roster object of the
+                   active session, or None, to complete the contacts.
     """
-    def __init__(self, output_, env):
+    def __init__(self, output_, env, roster=None):
         self._prompt = ''
         self._output = output_
+        self._roster = roster
         self._main_commands = commands.UserCommands()
         self._cfg_commands = commands.ConfigCommands()
 
+        # Only the terminal needs readline, so it's loaded here instead of
+        # slowing down the batch and daemon modes.
+        import readline
+        self._readline = readline
+
         self.set_prompt()
         self.update_completer(env)
         readline.parse_and_bind('tab: complete')
 
+        # JIDs are completed as a whole, and recipients may be separated by
+        # commas.
+        readline.set_completer_delims(' ,')
+
 
     def update_completer(self, env):
         self.commands = {
@@ -78,8 +320,13 @@ class Input(object):
             commands.ENV_CONFIG: self._cfg_commands
         }.get(env)
 
-        readline.set_completer(
-            _Completer(self.commands.supported_commands()).complete)
+        self._readline.set_completer(
+            _Completer(self.commands, self._line_before,
+                       self._roster).complete)
+
+
+    def _line_before(self):
+        return self._readline.get_line_buffer()[:self._readline.get_begidx()]
 
 
     def set_prompt(self, login='', contact='', environment=''):
@@ -105,26 +352,68 @@ class Input(object):
         :return Returns a dictionary with the command and its arguments such
                 as: {'command': 'help', 'arguments': 'list', 'info': dict}
         """
+        prompt = self._output.parse(self._prompt)
+
+        # Everything printed so far must appear before the prompt, anything
+        # else will be printed while the user is typing.
+        self._output.flush()
+        self._output.set_prompt(prompt, self._readline.get_line_buffer)
+
         try:
-            line = raw_input(self._output.parse(self._prompt))
+            line = raw_input(prompt)
         except:
             return None
+        finally:
+            self._output.set_prompt(None)
+
+        return _parse(line, self.commands)
+
+
+
+class BatchInput(object):
+    """
+    A class to read commands from a file or a pipe, one per line, instead of
+    the user terminal. There is no prompt nor line editing, so it works
+    without a terminal. Empty lines and lines starting with # are ignored.
+
+    :param stream: The file object to read the commands from.
+    :param env: The initial commands environment.
+    """
+    def __init__(self, stream, env):
+        self._stream = stream
+        self._main_commands = commands.UserCommands()
+        self._cfg_commands = commands.ConfigCommands()
+        self.line_number = 0
+
+        self.update_completer(env)
+
+
+    def update_completer(self, env):
+        self.commands = {
+            commands.ENV_MAIN: self._main_commands,
+            commands.ENV_CONFIG: self._cfg_commands
+        }.get(env)
 
-        # We always have a command beggining the line. At least that's
-        # the expected.
-        data = line.strip().split(' ', 1)
 
-        command = dict()
-        command[COMMAND] = data[0]
+    def set_prompt(self, *unused, **unused_too):
+        pass
 
-        if len(data) > 1:
-            command[ARGUMENTS] = data[1]
 
-        # Do we have a known command? Yes, insert its info too ;-)
-        if self.commands.known_command(command[COMMAND]):
-            command[INFO] = self.commands.info(command[COMMAND])
+    def readline(self):
+        """
+        Reads the next command.
+
+        :return Returns a dictionary with the command and its arguments, like
+                Input.readline(), or None at the end of the input.
+        """
+        for line in iter(self._stream.readline, ''):
+            self.line_number += 1
+            line = line.strip()
+
+            if line and not line.startswith('#'):
+                return _parse(line, self.commands)
 
-        return command
+        return None
 
 
 
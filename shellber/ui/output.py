@@ -21,12 +21,45 @@
 Functions do handle user interface output.
 """
 
+import atexit
 import os
 import logging
-import re
+import sys
+import threading
+import time
+from collections import OrderedDict
 from string import Template
 
-import colorama
+# Maximum number of compiled messages kept by an Output object
+RENDER_CACHE_SIZE = 256
+
+# Minimum interval, in seconds, between two terminal updates
+FRAME_INTERVAL = 0.05
+
+# Maximum number of received messages displayed per second from one sender
+RATE_LIMIT = 20
+
+# Terminal sequence to move to the beginning of the line and erase it
+_ERASE_LINE = '\r\x1b[2K'
+
+# Color names of the messages templates, such as ${FG_RED}
+_COLOR_NAMES = tuple(ground + color
+                     for ground in ('FG_', 'BG_')
+                     for color in ('BLACK', 'RED', 'GREEN', 'YELLOW', 'BLUE',
+                                   'MAGENTA', 'CYAN', 'WHITE', 'RESET'))
+
+def _encode(text):
+    """
+    Encodes a unicode message into the terminal encoding, so every message
+    is a str and they can be joined and written together. Characters the
+    terminal can't show are replaced.
+    """
+    if isinstance(text, unicode):
+        return text.encode(sys.stdout.encoding or 'utf-8', 'replace')
+
+    return text
+
+
 
 def clear(*unused):
     """
@@ -40,83 +73,367 @@ class Output(object):
     """
     A class to handle a little internal template language to make messages
     more user friendly.
+
+    Every distinct message template is compiled only once, into both its
+    colored form and its plain form (used for logging), and kept in a small
+    LRU cache. So messages built from variable data should pass that data
+    as arguments, in the same way of the logging module, instead of
+    formatting it into the template:
+
+    output.message("[${FG_MAGENTA}%s${FG_RESET}] %s", sender, body)
+
+    Messages are not written as they come. They are buffered and a
+    background thread writes them, and logs them, at most once every
+    FRAME_INTERVAL seconds, with a single write to the terminal. When the
+    user is typing a command, the prompt and the partial input are redrawn
+    after the new lines.
+
+    :param cache_size: The maximum number of compiled templates to keep.
+    :param rate_limit: The maximum number of received messages displayed per
+                       second from a single sender. The exceeding ones are
+                       only logged and summarized.
+    :param colors: Indicates if messages are colored. Without colors, such
+                   as when the output is not a terminal, every message is
+                   written in its plain form.
     """
-    def __init__(self):
+    def __init__(self, cache_size=RENDER_CACHE_SIZE, rate_limit=RATE_LIMIT,
+                 colors=True):
         # Tokens to translate
         self._tokens = {
             'cmd': '${FG_GREEN}',
             'ccmd': '${FG_RESET}'
         }
 
-        # Supported colors
-        self._colors = {
-            'FG_BLACK': colorama.Fore.BLACK,
-            'FG_RED': colorama.Fore.RED,
-            'FG_GREEN': colorama.Fore.GREEN,
-            'FG_YELLOW': colorama.Fore.YELLOW,
-            'FG_BLUE': colorama.Fore.BLUE,
-            'FG_MAGENTA': colorama.Fore.MAGENTA,
-            'FG_CYAN': colorama.Fore.CYAN,
-            'FG_WHITE': colorama.Fore.WHITE,
-            'FG_RESET': colorama.Fore.RESET,
-            'BG_BLACK': colorama.Back.BLACK,
-            'BG_RED': colorama.Back.RED,
-            'BG_GREEN': colorama.Back.GREEN,
-            'BG_YELLOW': colorama.Back.YELLOW,
-            'BG_BLUE': colorama.Back.BLUE,
-            'BG_MAGENTA': colorama.Back.MAGENTA,
-            'BG_CYAN': colorama.Back.CYAN,
-            'BG_WHITE': colorama.Back.WHITE,
-            'BG_RESET': colorama.Back.RESET
-        }
+        # Supported colors. colorama is only loaded when they're used, so
+        # the batch and daemon modes don't pay for it.
+        if colors:
+            import colorama
+
+            self._colors = dict(
+                (name, getattr(colorama.Fore if name.startswith('FG_')
+                               else colorama.Back, name[3:]))
+                for name in _COLOR_NAMES)
+        else:
+            self._colors = dict.fromkeys(_COLOR_NAMES, '')
+
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+
+        # Buffered messages, as (colored, log level, plain) tuples
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        # The prompt being displayed, if any, and a function to get what
+        # the user has typed so far.
+        self._prompt = None
+        self._line_buffer = None
+
+        # Received messages from each sender in the current second
+        self._rate_limit = rate_limit
+        self._window = 0
+        self._window_count = dict()
+        self._suppressed = OrderedDict()
+
+        # Number of error messages printed so far
+        self.errors = 0
+
+        # Messages printed by each thread while capturing them
+        self._local = threading.local()
+
+        writer = threading.Thread(name='output', target=self._writer)
+        writer.daemon = True
+        writer.start()
+        atexit.register(self.flush)
+
+
+    def _segments(self, message, tokens=True):
+        """
+        Splits a message template into its literal text and its escape codes.
+
+        :param message: The message template.
+        :param tokens: Indicates if the tokens may be translated too. Tokens
+                       are translated into colors, never into other tokens.
 
+        :return Yields (text, is_escape_code) pairs.
+        """
+        position = 0
+
+        for match in Template.pattern.finditer(message):
+            if match.start() > position:
+                yield message[position:match.start()], False
+
+            position = match.end()
+            name = match.group('named') or match.group('braced')
+
+            if match.group('escaped') is not None:
+                yield Template.delimiter, False
+            elif tokens and name in self._tokens:
+                for segment in self._segments(self._tokens[name], False):
+                    yield segment
+            elif name in self._colors:
+                yield self._colors[name], True
+            else:
+                yield match.group(), False
 
-    def _preprocess(self, message):
-        return Template(message).safe_substitute(self._tokens)
+        if position < len(message):
+            yield message[position:], False
+
+
+    def _compile(self, message):
+        """
+        Compiles a message template.
 
+        :param message: The message template.
 
-    def _clear(self, message):
+        :return Returns a tuple with the colored and the plain messages.
         """
-        Removes tokens from the string, so we can log it.
+        colored = []
+        plain = []
 
-        :param message: The original message, containing tokens or not.
+        for text, is_escape_code in self._segments(message):
+            colored.append(text)
+
+            if is_escape_code is False:
+                plain.append(text)
+
+        return ''.join(colored), ''.join(plain)
+
+
+    def _compiled(self, message):
         """
-        return re.sub(r'\$\{[a-zA-Z0-9_]*\}', '', message)
+        Gets a compiled message template from the cache, compiling it if it's
+        not there yet.
 
+        :param message: The message template.
 
-    def parse(self, message):
+        :return Returns a tuple with the colored and the plain messages.
+        """
+        with self._cache_lock:
+            compiled = self._cache.pop(message, None)
+
+            if compiled is None:
+                compiled = self._compile(message)
+
+                if len(self._cache) >= self._cache_size:
+                    self._cache.popitem(last=False)
+
+            self._cache[message] = compiled
+
+        return compiled
+
+
+    def _render(self, message, args):
+        colored, plain = self._compiled(message)
+
+        if args:
+            colored %= args
+            plain %= args
+
+        return _encode(colored), _encode(plain)
+
+
+    def _keep(self, level, plain):
+        captured = getattr(self._local, 'captured', None)
+
+        if captured is not None:
+            captured.append((level, plain))
+
+
+    def _queue(self, colored, level, plain):
+        self._keep(level, plain)
+
+        with self._lock:
+            self._pending.append((colored, level, plain))
+
+        self._wakeup.set()
+
+
+    def _roll_window(self):
+        """
+        Starts a new rate limit window when a second has passed, summarizing
+        the messages suppressed in the last one. Must be called with the
+        internal lock held.
+        """
+        now = int(time.time())
+
+        if now == self._window:
+            return
+
+        for sender, count in self._suppressed.items():
+            colored, plain = self._render("${FG_YELLOW}%d more messages from "
+                                          "%s${FG_RESET}", (count, sender))
+
+            self._pending.append((colored, logging.INFO, plain))
+
+        self._window = now
+        self._window_count.clear()
+        self._suppressed.clear()
+
+
+    def _writer(self):
+        while True:
+            # While there are suppressed messages we must wake up to
+            # summarize them, even if nothing else arrives.
+            if self._suppressed:
+                self._wakeup.wait(1)
+            else:
+                self._wakeup.wait()
+
+            self._wakeup.clear()
+
+            # A message which can't be written must not stop the following
+            # ones.
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Unable to write the output")
+
+            time.sleep(FRAME_INTERVAL)
+
+
+    def flush(self):
+        """
+        Writes all buffered messages to the terminal and to the log.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._roll_window()
+                pending, self._pending = self._pending, []
+                prompt = self._prompt
+                line_buffer = self._line_buffer
+
+            lines = []
+
+            for colored, level, plain in pending:
+                if colored is not None:
+                    lines.append(colored)
+
+                logging.log(level, "%s", plain)
+
+            if not lines:
+                return
+
+            data = '\n'.join(lines) + '\n'
+
+            if prompt is not None:
+                data = _ERASE_LINE + data + prompt + line_buffer()
+
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+
+    def set_prompt(self, prompt, line_buffer=None):
+        """
+        Tells which prompt is being displayed to the user, so it can be
+        redrawn after writing new messages.
+
+        :param prompt: The displayed prompt, already parsed, or None when the
+                       user is not typing.
+        :param line_buffer: A function returning what the user typed so far.
+        """
+        with self._lock:
+            self._prompt = prompt
+            self._line_buffer = line_buffer
+
+
+    def capture(self):
+        """
+        Starts keeping a copy of the messages printed by the calling thread,
+        such as the output of a command requested through the control
+        socket. They're still printed as usual.
+        """
+        self._local.captured = []
+
+
+    def release(self):
+        """
+        Stops keeping the messages printed by the calling thread.
+
+        :return Returns a list of (log level, plain message) tuples with the
+                messages printed since capture().
+        """
+        captured = getattr(self._local, 'captured', None)
+        self._local.captured = None
+
+        return captured or []
+
+
+    def parse(self, message, *args):
         """
         A function to parse a message with known tokens returning a message
         ready to be displayed to the user.
 
         :param message: The original message with/without tokens.
+        :param args: Optional arguments to be merged into the message, using
+                     the string formatting operator.
 
         :return Returns a new message.
         """
-        return Template(self._preprocess(message)).safe_substitute(self._colors)
+        return self._render(message, args)[0]
 
 
-    def message(self, message):
+    def message(self, message, *args):
         """
         A function to print messages to the application output.
 
         :param message: The message which will be printed into the standard
                         output.
+        :param args: Optional arguments to be merged into the message, using
+                     the string formatting operator.
         """
-        print self.parse(message)
-        logging.info("%s", self._clear(message))
+        colored, plain = self._render(message, args)
+        self._queue(colored, logging.INFO, plain)
 
 
+    def received(self, sender, message, *args):
+        """
+        A function to print messages received from a contact. When a sender
+        goes above the rate limit its messages are only logged, and a summary
+        is printed at the end of the second.
 
-    def error(self, message):
+        :param sender: The contact who sent the message.
+        :param message: The message which will be printed into the standard
+                        output.
+        :param args: Optional arguments to be merged into the message, using
+                     the string formatting operator.
+        """
+        colored, plain = self._render(message, args)
+
+        with self._lock:
+            self._roll_window()
+            count = self._window_count.get(sender, 0) + 1
+            self._window_count[sender] = count
+
+            if count > self._rate_limit:
+                self._suppressed[sender] = self._suppressed.get(sender, 0) + 1
+                colored = None
+
+            self._pending.append((colored, logging.INFO, plain))
+
+        self._wakeup.set()
+
+
+    def error(self, message, *args):
         """
         A function to print error messages to the application output.
 
         :param message: The message which will be printed into the standard
                         output.
+        :param args: Optional arguments to be merged into the message, using
+                     the string formatting operator.
         """
-        print self.parse("${FG_RED}%s${FG_RESET}" % message)
-        logging.error("%s", self._clear(message))
+        colored, plain = self._render(message, args)
+        colored = self._colors['FG_RED'] + colored + self._colors['FG_RESET']
+        self._keep(logging.ERROR, plain)
+
+        with self._lock:
+            self.errors += 1
+            self._pending.append((colored, logging.ERROR, plain))
+
+        self._wakeup.set()
 
 
 
@@ -0,0 +1,1287 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+A loopback XMPP server, standing in for a real one in the tests and the
+benchmarks.
+
+It implements only what the chat sessions use: SASL PLAIN without TLS,
+resource binding, message and presence routing between its users, the
+roster with versioning (XEP-0237), stream management (XEP-0198), group
+chat rooms (XEP-0045), the message archive (XEP-0313) and a SOCKS5
+bytestreams proxy (XEP-0065). Every user exists and every password is
+accepted. Faults are injected through drop(), and through the refuse,
+stream_management and resumption attributes.
+"""
+
+import base64
+import calendar
+import itertools
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+
+import shellber.app.core as core
+import shellber.chat.chat as chat
+
+DOMAIN = 'localhost'
+ROOMS = 'conference.' + DOMAIN
+PROXY = 'proxy.' + DOMAIN
+
+# Messages sent to this domain are only counted, see Server.sunk
+SINK = 'sink'
+
+# Number of stanzas sent to a session between two requests of its acknowledge,
+# with stream management enabled
+ACK_REQUEST = 64
+
+NS_CLIENT = 'jabber:client'
+NS_STREAM = 'http://etherx.jabber.org/streams'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_SM = 'urn:xmpp:sm:3'
+NS_ROSTER = 'jabber:iq:roster'
+NS_ROSTER_VER = 'urn:xmpp:features:rosterver'
+NS_MUC = 'http://jabber.org/protocol/muc'
+NS_MUC_USER = NS_MUC + '#user'
+NS_MAM = 'urn:xmpp:mam:2'
+NS_RSM = 'http://jabber.org/protocol/rsm'
+NS_DATA = 'jabber:x:data'
+NS_DISCO_INFO = 'http://jabber.org/protocol/disco#info'
+NS_DISCO_ITEMS = 'http://jabber.org/protocol/disco#items'
+NS_BYTESTREAMS = 'http://jabber.org/protocol/bytestreams'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+NS_XML = 'http://www.w3.org/XML/1998/namespace'
+
+_STANZAS = ('{%s}message' % NS_CLIENT, '{%s}presence' % NS_CLIENT,
+            '{%s}iq' % NS_CLIENT)
+
+_HEADER = u"<?xml version='1.0'?><stream:stream xmlns='jabber:client' " \
+          u"xmlns:stream='%s' id='%%s' from='%s' version='1.0'>" % \
+          (NS_STREAM, DOMAIN)
+
+_AUTH_FEATURES = u"<stream:features><mechanisms xmlns='%s'>" \
+                 u"<mechanism>PLAIN</mechanism></mechanisms>" \
+                 u"</stream:features>" % NS_SASL
+
+def _tag(name):
+    """
+    Translates an expat name, such as "jabber:client message", into the
+    ElementTree form, "{jabber:client}message".
+    """
+    if ' ' in name:
+        return '{%s}%s' % tuple(name.split(' ', 1))
+
+    return name
+
+
+
+def _stamp(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+
+def bare(jid):
+    return jid.split('/', 1)[0]
+
+
+
+class Element(object):
+    """
+    A parsed XML element, lighter than an ElementTree one.
+    """
+    __slots__ = ('tag', 'attrib', 'children', 'text')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+        self.text = u''
+
+
+    def get(self, name, default=None):
+        return self.attrib.get(name, default)
+
+
+    def find(self, tag):
+        for child in self.children:
+            if child.tag == tag:
+                return child
+
+        return None
+
+
+    def findtext(self, tag, default=None):
+        child = self.find(tag)
+        return default if child is None else child.text
+
+
+    def serialize(self, namespace=NS_CLIENT, attrib=None):
+        """
+        Serializes the element, declaring the default namespace wherever it
+        changes.
+
+        :param namespace: The default namespace of the parent element.
+        :param attrib: Attributes replacing the ones of the element, such as
+                       the sender of a routed stanza.
+        """
+        uri, name = self.tag[1:].split('}', 1)
+        parts = [u'<', name]
+
+        if uri != namespace:
+            parts.append(u' xmlns=%s' % quoteattr(uri))
+
+        attrib = dict(self.attrib, **attrib) if attrib else self.attrib
+
+        for key, value in attrib.iteritems():
+            if value is None:
+                continue
+
+            if key.startswith('{%s}' % NS_XML):
+                key = 'xml:' + key.split('}', 1)[1]
+            elif key.startswith('{'):
+                continue
+
+            parts.append(u' %s=%s' % (key, quoteattr(value)))
+
+        if not self.children and not self.text:
+            parts.append(u'/>')
+        else:
+            parts.append(u'>')
+            parts.append(escape(self.text))
+
+            for child in self.children:
+                parts.append(child.serialize(uri))
+
+            parts.append(u'</%s>' % name)
+
+        return u''.join(parts)
+
+
+
+class _Parser(object):
+    """
+    An incremental parser of a client stream, handing each top level
+    element over once it's complete.
+    """
+    def __init__(self, handle_open, handle_element, handle_close):
+        self._handle_open = handle_open
+        self._handle_element = handle_element
+        self._handle_close = handle_close
+        self._stack = []
+        self._depth = 0
+        self._parser = expat.ParserCreate('utf-8', ' ')
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+
+    def _start(self, name, attrs):
+        self._depth += 1
+
+        if self._depth == 1:
+            self._handle_open()
+            return
+
+        element = Element(_tag(name), dict((_tag(key), value)
+                                           for key, value in attrs.items()))
+
+        if self._stack:
+            self._stack[-1].children.append(element)
+
+        self._stack.append(element)
+
+
+    def _end(self, unused):
+        self._depth -= 1
+
+        if self._depth == 0:
+            self._handle_close()
+            return
+
+        element = self._stack.pop()
+
+        if not self._stack:
+            self._handle_element(element)
+
+
+    def _data(self, data):
+        if self._stack:
+            self._stack[-1].text += data
+
+
+
+class Session(object):
+    """
+    A bound resource. With stream management it outlives its connection
+    until it's resumed or replaced.
+    """
+    def __init__(self, server, jid):
+        self.jid = jid
+        self.user = jid.split('@', 1)[0]
+        self.connection = None
+        self.presence = None
+        self.sm_id = None
+        self.sm_enabled = False
+        self.handled = 0
+        self.sent = 0
+        self.unacked = []
+        self.lock = threading.RLock()
+        self._server = server
+
+
+    def write(self, data, stanza=True):
+        """
+        Sends data to the client, kept to be sent again on resumption when
+        it's a stanza and stream management is enabled.
+
+        :return Returns False if the session has no connection.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        with self.lock:
+            if stanza and self.sm_enabled:
+                self.sent += 1
+                self.unacked.append(data)
+
+                # The acknowledged stanzas are no longer kept
+                if self.sent % ACK_REQUEST == 0:
+                    data += "<r xmlns='%s'/>" % NS_SM
+
+            connection = self.connection
+
+            if connection is None:
+                return self.sm_id is not None
+
+            return connection.write(data)
+
+
+    def ack(self, count):
+        with self.lock:
+            drop = len(self.unacked) - (self.sent - count)
+
+            if drop > 0:
+                del self.unacked[:drop]
+
+
+
+class _Connection(object):
+    """
+    A client connection, from the stream header to its end.
+    """
+    def __init__(self, server, sock):
+        self.sock = sock
+        self.user = None
+        self.session = None
+        self._server = server
+        self._lock = threading.Lock()
+        self._authenticated = False
+        self._restart = False
+        self._parser = self._new_parser()
+
+
+    def _new_parser(self):
+        return _Parser(self._open, self._element, self._close)
+
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        with self._lock:
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                return False
+
+        return True
+
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                break
+
+            if not data:
+                break
+
+            try:
+                self._parser.feed(data)
+            except (expat.ExpatError, _Closed):
+                break
+
+            # The stream starts over after the authentication
+            if self._restart:
+                self._restart = False
+                self._parser = self._new_parser()
+
+        self._server._disconnected(self)
+
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+    def _open(self):
+        header = _HEADER % uuid.uuid4().hex
+
+        if self._authenticated is False:
+            self.write(header + _AUTH_FEATURES)
+            return
+
+        features = u"<bind xmlns='%s'/><session xmlns='%s'/><ver " \
+                   u"xmlns='%s'/>" % (NS_BIND, NS_SESSION, NS_ROSTER_VER)
+
+        if self._server.stream_management:
+            features += u"<sm xmlns='%s'/>" % NS_SM
+
+        self.write(header + u'<stream:features>%s</stream:features>' %
+                   features)
+
+
+    def _close(self):
+        self.write('</stream:stream>')
+
+        # A closed stream can't be resumed
+        if self.session is not None:
+            self.session.sm_id = None
+
+        raise _Closed()
+
+
+    def _element(self, element):
+        if element.tag == '{%s}auth' % NS_SASL:
+            credentials = base64.b64decode(element.text).split('\0')
+            self.user = credentials[1]
+            self._authenticated = True
+            self._restart = True
+            self.write(u"<success xmlns='%s'/>" % NS_SASL)
+        elif element.tag.startswith('{%s}' % NS_SM):
+            self._server._stream_management(self, element)
+        elif element.tag in _STANZAS:
+            session = self.session
+
+            if session is not None and session.sm_enabled:
+                session.handled += 1
+
+            self._server._stanza(self, element)
+
+
+
+class _Closed(Exception):
+    pass
+
+
+
+class Room(object):
+    """
+    A group chat room. Occupants without a session are only listed.
+    """
+    def __init__(self, jid, password=''):
+        self.jid = jid
+        self.password = password
+        self.occupants = OrderedDict()
+        self.history = []
+
+
+
+class Server(object):
+    """
+    The loopback server, listening on a free port of the loopback
+    interface, given by @address.
+
+    :param roster: A dict with the contacts of each user, such as
+                   {'alice': ['bob@localhost']}.
+    :param proxy: Indicates if a SOCKS5 bytestreams proxy is offered.
+    :param latency: Delay, in seconds, of the answers to archive queries.
+    """
+    def __init__(self, roster=None, proxy=False, latency=0):
+        self.stream_management = True
+        self.resumption = True
+        self.refuse = False
+        self.latency = latency
+        self.sunk = 0
+        self.sunk_ids = []
+        self.sunk_bodies = []
+        self.stanzas = 0
+        self.resumed = 0
+        self.sessions = dict()
+        self.rooms = dict()
+        self.archive = dict()
+        self._rosters = dict()
+        self._roster_log = dict()
+        self._sm_sessions = dict()
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._connections = []
+        self._sink_event = threading.Condition(threading.Lock())
+
+        for user, contacts in (roster or {}).items():
+            for contact in contacts:
+                self.add_contact(user, contact)
+
+        self._sock = self._listen()
+        self.address = self._sock.getsockname()
+        self._start(self._accept, self._sock, self._serve)
+
+        self._proxy = None
+        self._streams = dict()
+
+        if proxy:
+            self._proxy = self._listen()
+            self._start(self._accept, self._proxy, self._socks5)
+
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+
+        return sock
+
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+
+    def _accept(self, sock, serve):
+        while True:
+            try:
+                client, unused = sock.accept()
+            except socket.error:
+                return
+
+            if self.refuse:
+                client.close()
+                continue
+
+            self._start(serve, client)
+
+
+    def close(self):
+        """
+        Stops listening and drops every connection.
+        """
+        for sock in (self._sock, self._proxy):
+            if sock is not None:
+                sock.close()
+
+        with self._lock:
+            connections = list(self._connections)
+
+        for connection in connections:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+    def drop(self, user):
+        """
+        Breaks the connections of a user, without ending their streams, as a
+        network failure would.
+
+        :return Returns True if the user had a connection.
+        """
+        with self._lock:
+            connections = [c for c in self._connections if c.user == user]
+
+        for connection in connections:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        return bool(connections)
+
+
+    def wait_sunk(self, count, timeout=60):
+        """
+        Waits until @count messages were sent to the sink domain.
+
+        :return Returns True if they were.
+        """
+        deadline = time.time() + timeout
+
+        with self._sink_event:
+            while self.sunk < count and time.time() < deadline:
+                self._sink_event.wait(0.1)
+
+            return self.sunk >= count
+
+
+    def _serve(self, sock):
+        connection = _Connection(self, sock)
+
+        with self._lock:
+            self._connections.append(connection)
+
+        connection.run()
+
+
+    def _disconnected(self, connection):
+        with self._lock:
+            self._connections.remove(connection)
+            session = connection.session
+
+            if session is None or session.connection is not connection:
+                return
+
+            session.connection = None
+
+            if session.sm_id is not None:
+                return
+
+            self.sessions.pop(session.jid, None)
+
+        if session.presence is not None:
+            self._broadcast_presence(session, u"<presence type='unavailable'/>")
+
+
+    def sessions_of(self, user):
+        """
+        Gets the sessions of a user.
+
+        :param user: The user name or bare JID.
+        """
+        user = user.split('@', 1)[0]
+
+        with self._lock:
+            return [s for s in self.sessions.values() if s.user == user]
+
+
+    def push(self, jid, data):
+        """
+        Sends raw stanzas to the sessions of a JID, bare or full.
+        """
+        if '/' in jid:
+            session = self.sessions.get(jid)
+            sessions = [session] if session is not None else []
+        else:
+            sessions = self.sessions_of(jid)
+
+        for session in sessions:
+            session.write(data)
+
+        return bool(sessions)
+
+
+    # Roster
+
+    def add_contact(self, user, jid, name='', subscription='both'):
+        """
+        Adds or changes a contact in the roster of a user, pushing it to
+        the user sessions.
+        """
+        self._change_roster(user, jid, (name, subscription))
+
+
+    def remove_contact(self, user, jid):
+        self._change_roster(user, jid, None)
+
+
+    def _change_roster(self, user, jid, item):
+        with self._lock:
+            roster = self._rosters.setdefault(user, OrderedDict())
+            log = self._roster_log.setdefault(user, [])
+
+            if item is None:
+                roster.pop(jid, None)
+            else:
+                roster[jid] = item
+
+            log.append(jid)
+            version = str(len(log))
+
+        push = u"<iq type='set' id='push%d'><query xmlns='%s' ver='%s'>" \
+               u"%s</query></iq>" % (next(self._ids), NS_ROSTER, version,
+                                     self._roster_item(jid, item))
+
+        for session in self.sessions_of(user):
+            session.write(push)
+
+
+    def _roster_item(self, jid, item):
+        if item is None:
+            return u"<item jid=%s subscription='remove'/>" % quoteattr(jid)
+
+        name, subscription = item
+        name = u' name=%s' % quoteattr(name) if name else u''
+
+        return u"<item jid=%s%s subscription='%s'/>" % (quoteattr(jid), name,
+                                                        subscription)
+
+
+    def roster(self, user):
+        with self._lock:
+            return self._rosters.get(user, OrderedDict()).copy()
+
+
+    def roster_version(self, user):
+        with self._lock:
+            return str(len(self._roster_log.get(user, [])))
+
+
+    def _roster_get(self, session, element, query):
+        with self._lock:
+            roster = self._rosters.get(session.user, OrderedDict())
+            log = self._roster_log.get(session.user, [])
+            version = str(len(log))
+            known = query.get('ver')
+
+            # Only the changes since a version we know
+            if known and known.isdigit() and int(known) <= len(log):
+                # Each contact once, with the version of its last change
+                changed = OrderedDict()
+
+                for number, jid in enumerate(log[int(known):],
+                                             int(known) + 1):
+                    changed.pop(jid, None)
+                    changed[jid] = number
+
+                pushes = [u"<iq type='set' id='push%d'><query xmlns='%s' "
+                          u"ver='%d'>%s</query></iq>" %
+                          (next(self._ids), NS_ROSTER, number,
+                           self._roster_item(jid, roster.get(jid)))
+                          for jid, number in changed.iteritems()]
+                result = u"<iq type='result' id=%s/>" % \
+                        quoteattr(element.get('id'))
+            else:
+                pushes = []
+                result = u"<iq type='result' id=%s><query xmlns='%s' " \
+                         u"ver='%s'>%s</query></iq>" % \
+                         (quoteattr(element.get('id')), NS_ROSTER, version,
+                          u''.join(self._roster_item(jid, item)
+                                   for jid, item in roster.iteritems()))
+
+        session.write(result)
+
+        for push in pushes:
+            session.write(push)
+
+
+    # Stanzas
+
+    def _stream_management(self, connection, element):
+        name = element.tag.split('}', 1)[1]
+        session = connection.session
+
+        if name == 'enable':
+            session.sm_enabled = True
+            session.handled = 0
+
+            if self.resumption and element.get('resume') in ('true', '1'):
+                session.sm_id = 'sm%d' % next(self._ids)
+
+                with self._lock:
+                    self._sm_sessions[session.sm_id] = session
+
+                connection.write(u"<enabled xmlns='%s' id='%s' "
+                                 u"resume='true'/>" % (NS_SM, session.sm_id))
+            else:
+                connection.write(u"<enabled xmlns='%s'/>" % NS_SM)
+        elif name == 'r' and session is not None:
+            connection.write(u"<a xmlns='%s' h='%d'/>" % (NS_SM,
+                                                         session.handled))
+        elif name == 'a' and session is not None:
+            session.ack(int(element.get('h')))
+        elif name == 'resume':
+            with self._lock:
+                session = self._sm_sessions.get(element.get('previd'))
+
+                if session is None or self.resumption is False or \
+                        session.connection is not None:
+                    session = None
+                else:
+                    connection.session = session
+                    session.connection = connection
+
+            if session is None:
+                connection.write(u"<failed xmlns='%s'><item-not-found "
+                                 u"xmlns='%s'/></failed>" % (NS_SM,
+                                                            NS_STANZAS))
+                return
+
+            self.resumed += 1
+
+            with session.lock:
+                session.ack(int(element.get('h')))
+                connection.write(u"<resumed xmlns='%s' h='%d' previd='%s'/>" %
+                                 (NS_SM, session.handled, session.sm_id) +
+                                 ''.join(session.unacked))
+
+
+    def _stanza(self, connection, element):
+        self.stanzas += 1
+
+        if element.tag == '{%s}iq' % NS_CLIENT and \
+                element.find('{%s}bind' % NS_BIND) is not None:
+            self._bind(connection, element)
+            return
+
+        session = connection.session
+
+        if session is None:
+            return
+
+        to = element.get('to')
+        domain = bare(to).rpartition('@')[2] if to else DOMAIN
+
+        if to and bare(to) not in (DOMAIN, bare(session.jid)) and \
+                domain == DOMAIN:
+            self._route(session, element, to)
+        elif domain == SINK:
+            with self._sink_event:
+                self.sunk += 1
+                self.sunk_ids.append(element.get('id'))
+                self.sunk_bodies.append(element.findtext('{%s}body' %
+                                                         NS_CLIENT))
+                self._sink_event.notify_all()
+        elif domain == ROOMS:
+            self._room(session, element, to)
+        elif domain == PROXY:
+            self._proxy_iq(session, element)
+        elif domain != DOMAIN:
+            self._error(session, element, 'remote-server-not-found')
+        elif element.tag == '{%s}presence' % NS_CLIENT:
+            self._presence(session, element)
+        elif element.tag == '{%s}iq' % NS_CLIENT:
+            self._iq(session, element)
+
+
+    def _bind(self, connection, element):
+        resource = element.find('{%s}bind' % NS_BIND).findtext(
+            '{%s}resource' % NS_BIND) or uuid.uuid4().hex[:8]
+        jid = u'%s@%s/%s' % (connection.user, DOMAIN, resource)
+        session = Session(self, jid)
+        session.connection = connection
+
+        with self._lock:
+            old = self.sessions.get(jid)
+
+            if old is not None and old.sm_id is not None:
+                self._sm_sessions.pop(old.sm_id, None)
+
+            self.sessions[jid] = session
+
+        connection.session = session
+        connection.write(u"<iq type='result' id=%s><bind xmlns='%s'><jid>%s"
+                         u"</jid></bind></iq>" %
+                         (quoteattr(element.get('id')), NS_BIND, jid))
+
+
+    def _error(self, session, element, condition='service-unavailable'):
+        if element.get('type') in ('error', 'result') or \
+                element.tag == '{%s}presence' % NS_CLIENT:
+            return
+
+        name = element.tag.split('}', 1)[1]
+        session.write(u"<%s type='error' id=%s from=%s><error type='cancel'>"
+                      u"<%s xmlns='%s'/></error></%s>" %
+                      (name, quoteattr(element.get('id', '')),
+                       quoteattr(element.get('to', DOMAIN)), condition,
+                       NS_STANZAS, name))
+
+
+    def _route(self, session, element, to):
+        if '/' in to:
+            targets = [s for s in [self.sessions.get(to)] if s is not None]
+        else:
+            targets = self.sessions_of(to)
+
+            # A message to a bare JID goes to one of its resources
+            if element.tag == '{%s}message' % NS_CLIENT:
+                targets = targets[:1]
+
+        if not targets:
+            self._error(session, element)
+            return
+
+        data = element.serialize(attrib={'from': session.jid})
+
+        for target in targets:
+            target.write(data)
+
+        if element.tag == '{%s}message' % NS_CLIENT and \
+                element.find('{%s}body' % NS_CLIENT) is not None:
+            self._archive(session, element, to)
+
+
+    def _archive(self, session, element, to):
+        stamp = time.time()
+        body = element.findtext('{%s}body' % NS_CLIENT)
+        stanza_id = element.get('id', '')
+
+        for owner, peer in ((bare(session.jid), bare(to)),
+                            (bare(to), bare(session.jid))):
+            self.archive_message(owner, peer, stamp, session.jid, to,
+                                 stanza_id, body)
+
+
+    def archive_message(self, owner, peer, timestamp, sender, recipient,
+                        stanza_id, body):
+        """
+        Adds a message to the archive of a user.
+
+        :param owner: The bare JID of the user.
+        :param peer: The bare JID of the conversation.
+        """
+        with self._lock:
+            messages = self.archive.setdefault(owner, dict()).setdefault(
+                peer, [])
+            messages.append(('a%d' % next(self._ids), timestamp, sender,
+                             recipient, stanza_id, body))
+
+
+    def _presence(self, session, element):
+        kind = element.get('type')
+
+        if kind in ('subscribe', 'subscribed', 'unsubscribe', 'unsubscribed',
+                    'probe'):
+            return
+
+        data = element.serialize(attrib={'from': session.jid})
+        first = session.presence is None
+        session.presence = None if kind == 'unavailable' else data
+        self._broadcast_presence(session, data)
+
+        # The contacts' presence is sent once available
+        if first and kind is None:
+            for jid in self.roster(session.user):
+                for contact in self.sessions_of(jid):
+                    if contact.presence is not None:
+                        session.write(contact.presence)
+
+
+    def _broadcast_presence(self, session, data):
+        for jid in self.roster(session.user):
+            for contact in self.sessions_of(jid):
+                contact.write(data if ' from=' in data else
+                              data.replace(u'<presence',
+                                           u'<presence from=%s' %
+                                           quoteattr(session.jid), 1))
+
+
+    def _iq(self, session, element):
+        if element.get('type') not in ('get', 'set'):
+            return
+
+        query = element.find('{%s}query' % NS_ROSTER)
+
+        if query is not None and element.get('type') == 'get':
+            self._roster_get(session, element, query)
+            return
+
+        if query is not None:
+            for item in query.children:
+                if item.get('subscription') == 'remove':
+                    self.remove_contact(session.user, item.get('jid'))
+                else:
+                    self.add_contact(session.user, item.get('jid'),
+                                     item.get('name', ''))
+
+            session.write(u"<iq type='result' id=%s/>" %
+                          quoteattr(element.get('id')))
+            return
+
+        query = element.find('{%s}query' % NS_MAM)
+
+        if query is not None:
+            if self.latency:
+                timer = threading.Timer(self.latency, self._archive_query,
+                                        (session, element, query))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._archive_query(session, element, query)
+
+            return
+
+        query = element.find('{%s}query' % NS_DISCO_ITEMS)
+
+        if query is not None and element.get('to') == DOMAIN:
+            items = u"<item jid='%s'/>" % PROXY if self._proxy else u''
+            session.write(u"<iq type='result' id=%s from='%s'><query "
+                          u"xmlns='%s'>%s</query></iq>" %
+                          (quoteattr(element.get('id')), DOMAIN,
+                           NS_DISCO_ITEMS, items))
+            return
+
+        # Anything else is accepted
+        session.write(u"<iq type='result' id=%s%s/>" %
+                      (quoteattr(element.get('id')),
+                       u' from=%s' % quoteattr(element.get('to'))
+                       if element.get('to') else u''))
+
+
+    def _archive_query(self, session, element, query):
+        fields = dict()
+        form = query.find('{%s}x' % NS_DATA)
+
+        for field in form.children if form is not None else []:
+            fields[field.get('var')] = field.findtext('{%s}value' % NS_DATA)
+
+        rsm = query.find('{%s}set' % NS_RSM)
+        limit = int(rsm.findtext('{%s}max' % NS_RSM) or 0) if rsm else 0
+        after = rsm.findtext('{%s}after' % NS_RSM) if rsm else None
+        start = 0
+
+        if fields.get('start'):
+            start = calendar.timegm(time.strptime(fields['start'],
+                                                  '%Y-%m-%dT%H:%M:%SZ'))
+
+        with self._lock:
+            messages = [m for m in self.archive.get(bare(session.jid), {}).get(
+                fields.get('with'), []) if m[1] >= start]
+
+        if after:
+            ids = [m[0] for m in messages]
+            messages = messages[ids.index(after) + 1:] if after in ids else []
+
+        page = messages[:limit] if limit else messages
+        query_id = quoteattr(query.get('queryid', ''))
+        data = [u"<message to=%s><result xmlns='%s' queryid=%s id='%s'>"
+                u"<forwarded xmlns='urn:xmpp:forward:0'><delay "
+                u"xmlns='urn:xmpp:delay' stamp='%s'/><message xmlns='%s' "
+                u"from=%s to=%s type='chat' id=%s><body>%s</body></message>"
+                u"</forwarded></result></message>" %
+                (quoteattr(session.jid), NS_MAM, query_id, archive_id,
+                 _stamp(stamp), NS_CLIENT, quoteattr(sender),
+                 quoteattr(recipient), quoteattr(stanza_id), escape(body))
+                for archive_id, stamp, sender, recipient, stanza_id, body
+                in page]
+
+        last = u''
+
+        if page:
+            last = u'<first>%s</first><last>%s</last>' % (page[0][0],
+                                                          page[-1][0])
+
+        data.append(u"<iq type='result' id=%s><fin xmlns='%s'%s><set "
+                    u"xmlns='%s'>%s</set></fin></iq>" %
+                    (quoteattr(element.get('id')), NS_MAM,
+                     u" complete='true'" if len(page) == len(messages)
+                     else u'', NS_RSM, last))
+
+        for stanza in data:
+            session.write(stanza)
+
+
+    # Group chat rooms
+
+    def add_room(self, name, occupants=0, history=0):
+        """
+        Creates a room with occupants which have no session, and old
+        messages.
+
+        :return Returns the Room object.
+        """
+        room = Room(u'%s@%s' % (name, ROOMS))
+
+        for index in range(occupants):
+            room.occupants[u'user%d' % index] = None
+
+        for index in range(history):
+            room.history.append((u'user0', time.time(), u'message %d' % index))
+
+        with self._lock:
+            self.rooms[room.jid] = room
+
+        return room
+
+
+    def _occupant(self, room, nick, to, codes=(), kind=None):
+        status = u''.join(u"<status code='%s'/>" % code for code in codes)
+
+        return u"<presence from=%s to=%s%s><x xmlns='%s'><item " \
+               u"affiliation='member' role='participant'/>%s</x></presence>" % \
+               (quoteattr(room.jid + u'/' + nick), quoteattr(to),
+                u" type='%s'" % kind if kind else u'', NS_MUC_USER, status)
+
+
+    def _room(self, session, element, to):
+        with self._lock:
+            room = self.rooms.get(bare(to))
+
+        if element.tag == '{%s}presence' % NS_CLIENT:
+            self._room_presence(session, element, to, room)
+        elif room is None:
+            self._error(session, element, 'item-not-found')
+        elif element.tag == '{%s}message' % NS_CLIENT:
+            self._room_message(session, element, room)
+        elif element.tag == '{%s}iq' % NS_CLIENT:
+            session.write(u"<iq type='result' id=%s from=%s/>" %
+                          (quoteattr(element.get('id')),
+                           quoteattr(room.jid)))
+
+
+    def _room_presence(self, session, element, to, room):
+        nick = to.partition('/')[2]
+        leave = element.get('type') == 'unavailable'
+
+        if room is None:
+            if leave:
+                return
+
+            room = self.add_room(bare(to).split('@', 1)[0])
+            created = True
+        else:
+            created = False
+
+        with self._lock:
+            occupants = room.occupants.items()
+
+        mine = [n for n, s in occupants if s is session]
+
+        if leave:
+            for name in mine:
+                room.occupants.pop(name, None)
+
+            for name, occupant in occupants:
+                if occupant is not None:
+                    occupant.write(self._occupant(
+                        room, nick, occupant.jid,
+                        ('110',) if occupant is session else (),
+                        'unavailable'))
+
+            return
+
+        if mine:
+            return
+
+        if nick in room.occupants:
+            self._error(session, element, 'conflict')
+            return
+
+        muc = element.find('{%s}x' % NS_MUC)
+
+        if room.password and (muc is None or muc.findtext(
+                '{%s}password' % NS_MUC) != room.password):
+            self._error(session, element, 'not-authorized')
+            return
+
+        # Everyone else first, then the new occupant himself
+        session.write(u''.join(self._occupant(room, name, session.jid)
+                               for name, unused in occupants))
+
+        for name, occupant in occupants:
+            if occupant is not None:
+                occupant.write(self._occupant(room, nick, occupant.jid))
+
+        room.occupants[nick] = session
+        session.write(self._occupant(room, nick, session.jid,
+                                     ('110', '201') if created else ('110',)))
+
+        history = muc.find('{%s}history' % NS_MUC) if muc is not None else None
+        limit = len(room.history)
+
+        if history is not None and history.get('maxstanzas'):
+            limit = int(history.get('maxstanzas'))
+
+        for sender, stamp, body in room.history[-limit:] if limit else []:
+            session.write(u"<message from=%s to=%s type='groupchat'><body>%s"
+                          u"</body><delay xmlns='urn:xmpp:delay' stamp='%s'/>"
+                          u"</message>" %
+                          (quoteattr(room.jid + u'/' + sender),
+                           quoteattr(session.jid), escape(body),
+                           _stamp(stamp)))
+
+
+    def _room_message(self, session, element, room):
+        nick = [n for n, s in room.occupants.items() if s is session]
+
+        invite = element.find('{%s}x' % NS_MUC_USER)
+
+        if invite is not None:
+            for child in invite.children:
+                self.push(child.get('to'),
+                          u"<message from=%s to=%s><x xmlns='%s'><invite "
+                          u"from=%s/></x></message>" %
+                          (quoteattr(room.jid), quoteattr(child.get('to')),
+                           NS_MUC_USER, quoteattr(session.jid)))
+            return
+
+        if not nick:
+            self._error(session, element, 'not-acceptable')
+            return
+
+        body = element.findtext('{%s}body' % NS_CLIENT, u'')
+        room.history.append((nick[0], time.time(), body))
+
+        for occupant in room.occupants.values():
+            if occupant is not None:
+                occupant.write(element.serialize(attrib={
+                    'from': room.jid + u'/' + nick[0], 'to': occupant.jid}))
+
+
+    # SOCKS5 bytestreams proxy
+
+    def _proxy_iq(self, session, element):
+        query = element.find('{%s}query' % NS_BYTESTREAMS)
+        reply = u''
+
+        if element.find('{%s}query' % NS_DISCO_INFO) is not None:
+            reply = u"<query xmlns='%s'><identity category='proxy' " \
+                    u"type='bytestreams'/><feature var='%s'/></query>" % \
+                    (NS_DISCO_INFO, NS_BYTESTREAMS)
+        elif query is not None and element.get('type') == 'get':
+            reply = u"<query xmlns='%s'><streamhost jid='%s' host='%s' " \
+                    u"port='%d'/></query>" % ((NS_BYTESTREAMS, PROXY) +
+                                             self._proxy.getsockname())
+        elif query is not None:
+            self._activate(query.get('sid'))
+
+        session.write(u"<iq type='result' id=%s from='%s'>%s</iq>" %
+                      (quoteattr(element.get('id')), PROXY, reply))
+
+
+    def _socks5(self, sock):
+        try:
+            greeting = sock.recv(2)
+            sock.recv(ord(greeting[1]))
+            sock.sendall('\x05\x00')
+            request = sock.recv(5)
+            address = sock.recv(ord(request[4]) + 2)[:-2]
+            sock.sendall('\x05\x00\x00\x03' + chr(len(address)) + address +
+                         '\x00\x00')
+        except (socket.error, IndexError):
+            sock.close()
+            return
+
+        with self._lock:
+            self._streams.setdefault(address, []).append(sock)
+
+
+    def _activate(self, unused_sid):
+        # The stream is identified by the hash of its sid and JIDs, which
+        # both sides sent, so the pair connected is the one to activate.
+        deadline = time.time() + 10
+
+        while time.time() < deadline:
+            with self._lock:
+                pairs = [a for a, s in self._streams.items() if len(s) == 2]
+
+                if pairs:
+                    first, second = self._streams.pop(pairs[0])
+                    break
+
+            time.sleep(0.01)
+        else:
+            return
+
+        for source, target in ((first, second), (second, first)):
+            self._start(self._pipe, source, target)
+
+
+    def _pipe(self, source, target):
+        while True:
+            try:
+                data = source.recv(65536)
+            except socket.error:
+                data = ''
+
+            if not data:
+                try:
+                    target.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+
+                return
+
+            try:
+                target.sendall(data)
+            except socket.error:
+                return
+
+
+
+def chat_class(server):
+    """
+    Builds a chat.Chat class whose sessions connect to a loopback server,
+    without TLS.
+
+    :param server: The Server object.
+    """
+    class LoopbackChat(chat.Chat):
+        def _create_client(self):
+            xmpp = chat.Chat._create_client(self)
+            xmpp['feature_mechanisms'].unencrypted_plain = True
+            connect = xmpp.connect
+            xmpp.connect = lambda *args, **kwargs: \
+                    connect(server.address, *args[1:], **kwargs)
+
+            return xmpp
+
+    return LoopbackChat
+
+
+
+def application_class(server):
+    """
+    Builds a core.Application class whose sessions connect to a loopback
+    server, see chat_class().
+
+    :param server: The Server object.
+    """
+    loopback_chat = chat_class(server)
+
+    class LoopbackApplication(core.Application):
+        def _new_session(self, account):
+            # Only the client creation differs, so the session keeps every
+            # option given by the application.
+            session = core.Application._new_session(self, account)
+            session.__class__ = loopback_chat
+
+            return session
+
+    return LoopbackApplication
+
+
+
+def wait(predicate, timeout=10):
+    """
+    Waits for a condition, checked every few milliseconds.
+
+    :return Returns the last value of the predicate.
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        value = predicate()
+
+        if value or time.time() > deadline:
+            return value
+
+        time.sleep(0.01)
@@ -0,0 +1,176 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The application in batch mode, as run by shellber-cli --batch FILE.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+from shellber.app import log
+from shellber.chat import presence
+from shellber.ui import input
+from tests import server
+
+commands = input.commands
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(roster={'alice': ['bob@localhost'],
+                                            'bob': ['alice@localhost']})
+        self.directory = tempfile.mkdtemp()
+        self.config = os.path.join(self.directory, 'shellber.yml')
+
+        # Every file of the sessions is kept in the test directory
+        with open(self.config, 'w') as f:
+            f.write("log_filename: %s\n" % os.path.join(self.directory,
+                                                        'shellber.log'))
+
+            for name in ('history', 'roster', 'download', 'spool'):
+                f.write("%s_directory: %s\n" %
+                        (name, os.path.join(self.directory, name)))
+
+
+    def tearDown(self):
+        # The application leaves its log file open, and the next one would
+        # close it under the sessions still logging.
+        log.stop_log()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+
+    def application(self, lines):
+        """
+        Creates the application with a batch file.
+
+        :param lines: The command lines of the batch file.
+
+        :return Returns the core.Application object.
+        """
+        batch = os.path.join(self.directory, 'commands')
+
+        with open(batch, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+        return server.application_class(self.server)(
+            argparse.Namespace(config=self.config, batch=batch, daemon=False,
+                               commands=None, socket=None))
+
+
+    def run_batch(self, lines, application=None):
+        """
+        Runs the application with a batch file, as shellber-cli does.
+
+        :param lines: The command lines of the batch file.
+        :param application: The application, if already created, to run
+                            until the end of its batch.
+
+        :return Returns the application exit status.
+        """
+        if application is None:
+            application = self.application(lines)
+
+        while application.run():
+            cmd = application.wait_for_command()
+
+            if cmd is not None:
+                application.handle_command(cmd)
+
+        application.sync_configuration()
+
+        return application.finish()
+
+
+    def test_success(self):
+        status = self.run_batch(["login alice secret %s test" % server.DOMAIN,
+                                 "msgto alert@%s first" % server.SINK])
+
+        self.assertEqual(status, 0)
+        self.assertTrue(self.server.wait_sunk(1))
+
+
+    def test_failure(self):
+        status = self.run_batch(["login alice secret %s test" % server.DOMAIN,
+                                 "msgto alert@%s first" % server.SINK,
+                                 "nosuchcommand",
+                                 "msgto alert@%s second" % server.SINK])
+
+        # The batch goes on after the failed command, but it's reported
+        self.assertEqual(status, 1)
+        self.assertTrue(self.server.wait_sunk(2))
+
+
+    def test_actions(self):
+        application = self.application([])
+
+        try:
+            for commands_ in (commands.UserCommands(),
+                              commands.ConfigCommands()):
+                for command in commands_.supported_commands():
+                    self.assertIn(command, application._actions)
+        finally:
+            self.run_batch([], application)
+
+
+    def test_dispatch(self):
+        bob = server.chat_class(self.server)(
+            lambda sender, body: received.append((sender, body)))
+        received = []
+        bob.login(['bob', 'secret', server.DOMAIN, 'test'])
+
+        application = self.application([
+            "login alice secret %s test" % server.DOMAIN,
+            "msgto bob@localhost  two  spaces, kept",
+            "msggr bob@localhost,carol@localhost  to a list",
+            "presence away out  for lunch",
+            "group create room"])
+
+        try:
+            self.assertTrue(bob.wait_session())
+
+            for unused in range(5):
+                application.handle_command(application.wait_for_command())
+
+            # Only the recipients are split off the messages
+            self.assertTrue(server.wait(lambda: len(received) == 2))
+            self.assertEqual(received,
+                             [('alice@localhost', u' two  spaces, kept'),
+                              ('alice@localhost', u' to a list')])
+            self.assertTrue(server.wait(
+                lambda: bob.presence('alice@localhost').show ==
+                presence.AWAY))
+            self.assertEqual(bob.presence('alice@localhost').status,
+                             u'out  for lunch')
+            self.assertTrue(server.wait(
+                lambda: 'room@conference.localhost' in self.server.rooms))
+        finally:
+            try:
+                status = self.run_batch([], application)
+            finally:
+                bob.logout()
+
+        self.assertEqual(status, 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
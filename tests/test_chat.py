@@ -0,0 +1,353 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Chat sessions against the loopback server.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from shellber.chat import broadcast
+from shellber.chat import history
+from shellber.chat import presence
+from tests import server
+
+class ChatTest(unittest.TestCase):
+    """
+    Each test gets its own server and, through session(), logged in users
+    which collect what they receive.
+    """
+    def setUp(self):
+        self.server = server.Server(roster={'alice': ['bob@localhost'],
+                                            'bob': ['alice@localhost']})
+        self.directory = tempfile.mkdtemp()
+        self.chats = []
+
+
+    def tearDown(self):
+        for chat in self.chats:
+            if chat.connected():
+                chat.logout()
+
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+
+    def session(self, user, **options):
+        """
+        Logs a user in.
+
+        :param options: Options of the chat.Chat object.
+
+        :return Returns the chat.Chat object, with the received messages
+                and notifications in its received and notifications lists.
+        """
+        received = list()
+        notifications = list()
+        chat = server.chat_class(self.server)(
+            lambda sender, body: received.append((sender, body)),
+            notifications.append, **options)
+        chat.received = received
+        chat.notifications = notifications
+        chat.login([user, 'secret', server.DOMAIN, 'test'])
+        self.chats.append(chat)
+        self.assertTrue(chat.wait_session())
+
+        return chat
+
+
+    def test_login(self):
+        alice = self.session('alice')
+
+        self.assertEqual(alice.ID, 'alice@localhost/test')
+        self.assertIn('Session started as alice@localhost/test',
+                      alice.notifications)
+        self.assertEqual(len(self.server.sessions_of('alice')), 1)
+
+
+    def test_logout(self):
+        alice = self.session('alice')
+        alice.logout()
+
+        self.assertFalse(alice.connected())
+        self.assertTrue(server.wait(
+            lambda: not self.server.sessions_of('alice')))
+        self.assertRaises(Exception, alice.logout)
+
+
+    def test_message(self):
+        alice = self.session('alice')
+        bob = self.session('bob')
+        alice.message(u'hello \xe9', 'bob@localhost')
+        alice.message('hello \xc3\xa9', 'bob@localhost')
+
+        self.assertTrue(server.wait(lambda: len(bob.received) == 2))
+        self.assertEqual(bob.received, [('alice@localhost', u'hello \xe9')] * 2)
+
+
+    def test_active_chat(self):
+        alice = self.session('alice')
+        bob = self.session('bob')
+        alice.start_chat('bob@localhost')
+
+        for index in range(100):
+            alice.message(str(index))
+
+        self.assertTrue(server.wait(lambda: len(bob.received) == 100))
+        self.assertEqual([body for unused, body in bob.received],
+                         [unicode(index) for index in range(100)])
+
+
+    def test_not_connected(self):
+        chat = server.chat_class(self.server)(lambda *args: None)
+
+        self.assertRaises(Exception, chat.broadcast, 'hello', ['a@localhost'])
+        self.assertRaises(Exception, chat.login, ['alice', 'secret'])
+
+
+    def test_unreachable(self):
+        self.server.refuse = True
+        chat = server.chat_class(self.server)(lambda *args: None)
+        chat.login(['alice', 'secret', server.DOMAIN])
+        self.chats.append(chat)
+
+        self.assertFalse(chat.wait_session(timeout=2))
+
+
+    def test_presence(self):
+        alice = self.session('alice')
+        self.session('bob')
+
+        self.assertTrue(server.wait(
+            lambda: alice.presence('bob@localhost').show ==
+            presence.AVAILABLE))
+
+
+    def test_broadcast(self):
+        reports = list()
+        alice = self.session('alice', handle_broadcast=reports.append)
+        bob = self.session('bob')
+        tracker = alice.broadcast(u'alert', ['bob@localhost',
+                                             'nobody@localhost', 'a@b@c'])
+
+        self.assertTrue(server.wait(lambda: reports))
+        self.assertIs(reports[0], tracker)
+        self.assertEqual(bob.received, [('alice@localhost', u'alert')])
+        self.assertEqual(tracker.recipients['bob@localhost'][0],
+                         broadcast.DELIVERED)
+        self.assertEqual(tracker.recipients['nobody@localhost'][0],
+                         broadcast.FAILED)
+        self.assertEqual(tracker.recipients['a@b@c'][0], broadcast.FAILED)
+
+
+    def test_broadcast_group(self):
+        alice = self.session('alice')
+        bob = self.session('bob')
+        alice.group_create('room')
+        bob.group_join('room@conference.localhost/bobby')
+
+        self.assertTrue(server.wait(
+            lambda: 'bobby' in dict(alice.group_occupants('room'))))
+
+        alice.broadcast(u'alert', ['room@conference.localhost',
+                                   'bob@localhost'])
+
+        # The group sends it to its occupants
+        self.assertTrue(server.wait(lambda: len(bob.received) == 2))
+        self.assertEqual(sorted(bob.received),
+                         [('alice@localhost', u'alert'),
+                          ('room@conference.localhost/alice', u'alert')])
+
+
+    def test_history(self):
+        alice = self.session('alice', history_directory=self.directory)
+        bob = self.session('bob')
+        alice.message(u'ping', 'bob@localhost')
+        server.wait(lambda: bob.received)
+        bob.message(u'pong', 'alice@localhost')
+
+        self.assertTrue(server.wait(lambda: alice.received))
+        self.assertTrue(server.wait(
+            lambda: len(list(alice.history('bob@localhost'))) == 2))
+        self.assertEqual([m.body for m in alice.history('bob@localhost')],
+                         [u'ping', u'pong'])
+        self.assertEqual([m.body for m, unused in alice.search(u'pong')],
+                         [u'pong'])
+
+
+    def test_history_jid(self):
+        alice = self.session('alice', history_directory=self.directory)
+        alice.message(u'ping', 'bob@localhost')
+
+        self.assertTrue(server.wait(
+            lambda: list(alice.history('bob@localhost'))))
+
+        # The contact may be given in any case, or with a resource
+        for contact in ('Bob@LocalHost', 'bob@localhost/phone'):
+            self.assertEqual([m.body for m in alice.history(contact)],
+                             [u'ping'])
+
+
+    def test_search_peer(self):
+        alice = self.session('alice', history_directory=self.directory)
+        alice.message(u'ping bob', 'bob@localhost')
+        alice.message(u'ping carol', 'carol@localhost')
+
+        self.assertTrue(server.wait(lambda: alice.search(u'ping')))
+
+        for peer in ('Bob@LocalHost', 'bob@localhost/phone'):
+            self.assertEqual([m.body for m, unused in
+                              alice.search(u'ping', peer=peer)],
+                             [u'ping bob'])
+
+
+    def test_group_history(self):
+        room = self.server.add_room('old', history=3)
+        start = int(time.time()) - 3600
+
+        for index, (sender, unused, body) in enumerate(room.history):
+            room.history[index] = (sender, start + index * 60, body)
+
+        alice = self.session('alice', history_directory=self.directory)
+        alice.group_join('old@conference.localhost/alice')
+
+        # The old messages keep the time they were sent at
+        self.assertTrue(server.wait(
+            lambda: len(list(alice.history('old@conference.localhost'))) ==
+            3))
+        self.assertEqual([(m.body, m.timestamp) for m in
+                          alice.history('old@conference.localhost')],
+                         [(u'message %d' % index, start + index * 60)
+                          for index in range(3)])
+
+
+    def test_archive(self):
+        start = int(time.time()) - 3600
+        owner = u'alice@' + server.DOMAIN
+        peer = u'bob@' + server.DOMAIN
+        store = history.History(os.path.join(self.directory, owner + '.db'))
+        store.append(peer, history.INCOMING, peer, u'hello', start)
+        store.close()
+
+        # The last message of the history is archived too
+        self.server.archive_message(owner, peer, start, peer, owner, 'm0',
+                                    u'hello')
+        self.server.archive_message(owner, peer, start + 10, owner, peer,
+                                    'm1', u'hi')
+
+        for index in range(2, 6):
+            self.server.archive_message(owner, peer, start + index * 10, peer,
+                                        owner, 'm%d' % index,
+                                        u'message %d' % index)
+
+        pages = []
+        archive_query = self.server._archive_query
+
+        def count_pages(*args):
+            pages.append(args)
+            archive_query(*args)
+
+        self.server._archive_query = count_pages
+        alice = self.session('alice', history_directory=self.directory,
+                             archive_page_size=2)
+
+        self.assertTrue(server.wait(
+            lambda: [n for n in alice.notifications
+                     if n.startswith("Fetched ")]))
+        self.assertEqual(len(pages), 3)
+
+        # The known message is neither delivered nor saved twice
+        self.assertEqual(alice.received,
+                         [(peer, u'message %d' % index)
+                          for index in range(2, 6)])
+        self.assertTrue(server.wait(
+            lambda: len(list(alice.history(peer))) == 6))
+        self.assertEqual([(m.body, m.timestamp) for m in
+                          alice.history(peer)],
+                         [(u'hello', start), (u'hi', start + 10)] +
+                         [(u'message %d' % index, start + index * 10)
+                          for index in range(2, 6)])
+
+
+    def test_roster(self):
+        alice = self.session('alice', roster_directory=self.directory)
+
+        self.assertTrue(server.wait(
+            lambda: [jid for jid, unused in alice.contact_list()] ==
+            ['bob@localhost']))
+
+        self.server.add_contact('alice', 'carol@localhost', 'Carol')
+
+        self.assertTrue(server.wait(
+            lambda: len(alice.contact_list()) == 2))
+
+
+    def test_group(self):
+        alice = self.session('alice')
+        bob = self.session('bob')
+        alice.group_create('room')
+
+        self.assertTrue(server.wait(
+            lambda: 'alice' in dict(alice.group_occupants('room'))))
+
+        bob.group_join('room@conference.localhost/bobby')
+
+        self.assertTrue(server.wait(
+            lambda: 'bobby' in dict(alice.group_occupants('room'))))
+
+        alice.message(u'hi all', 'room@conference.localhost')
+
+        self.assertTrue(server.wait(lambda: bob.received))
+        self.assertEqual(bob.received,
+                         [('room@conference.localhost/alice', u'hi all')])
+        self.assertEqual(alice.received, [])
+
+
+    def test_spool(self):
+        alice = self.session('alice', spool_directory=self.directory)
+        bob = self.session('bob')
+        self.server.resumption = False
+        self.server.refuse = True
+        self.server.drop('alice')
+
+        self.assertTrue(server.wait(
+            lambda: 'Connection to localhost lost, reconnecting' in
+            alice.notifications))
+
+        alice.message(u'while away', 'bob@localhost')
+        self.server.refuse = False
+
+        self.assertTrue(server.wait(lambda: bob.received, timeout=30))
+        self.assertEqual(bob.received, [('alice@localhost', u'while away')])
+
+
+    def test_resume(self):
+        alice = self.session('alice')
+        bob = self.session('bob')
+        self.server.drop('alice')
+        alice.message(u'after the drop', 'bob@localhost')
+
+        self.assertTrue(server.wait(lambda: self.server.resumed, timeout=30))
+        self.assertTrue(server.wait(lambda: bob.received))
+        self.assertEqual(bob.received,
+                         [('alice@localhost', u'after the drop')])
+        self.assertEqual(len(self.server.sessions_of('alice')), 1)
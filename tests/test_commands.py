@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The supported commands and the validation of the command lines.
+"""
+
+import unittest
+
+from shellber.ui import input
+
+commands = input.commands
+
+class CommandsTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = commands.UserCommands()
+
+
+    def validate(self, line):
+        self.commands.validate(input._parse(line, self.commands))
+
+
+    def assertInvalid(self, line, message):
+        with self.assertRaises(Exception) as context:
+            self.validate(line)
+
+        self.assertEqual(str(context.exception), message)
+
+
+    def test_populate(self):
+        names = self.commands.supported_commands()
+        self.assertEqual(names, sorted(names))
+
+        info = self.commands.info(commands.CMD_GROUP)
+        self.assertEqual(sorted(info['sub_command_info']),
+                         ['create', 'invite', 'join', 'leave', 'who'])
+        self.assertEqual(
+            info['sub_command_info']['invite']['contact_argument'],
+            commands.ANY_ARGUMENT)
+        self.assertNotIn('sub_command_info',
+                         self.commands.info(commands.CMD_MSG))
+
+        # Commands added later are sorted and indexed again
+        self.commands.add_command('aaa', 'First.', sub_commands=[
+            self.commands.sub_command('sub', 'A sub-command.')])
+        self.commands.populate_commands()
+        self.assertEqual(self.commands.supported_commands()[0], 'aaa')
+        self.assertEqual(self.commands.info('aaa')['sub_command_info'],
+                         {'sub': {'help': 'A sub-command.',
+                                  'required_arguments': 0,
+                                  'optional_arguments': 0}})
+
+
+    def test_unknown(self):
+        self.assertInvalid('nosuchcommand', "Unknown command")
+        self.assertInvalid('nosuchcommand bob@localhost', "Unknown command")
+
+
+    def test_no_arguments(self):
+        for line in ('help', 'help msgto', 'logout', 'archive', 'quit',
+                     'quit app'):
+            self.validate(line)
+
+
+    def test_required(self):
+        self.assertInvalid('msg', "Wrong arguments, see help for details")
+        self.assertInvalid('msgto bob@localhost',
+                           "Wrong arguments, see help for details")
+        self.assertInvalid('group create',
+                           "Wrong arguments, see help for details")
+        self.validate('msg hello')
+        self.validate('msgto bob@localhost hello')
+        self.validate('group create room')
+
+
+    def test_sub_commands(self):
+        self.assertInvalid('group nosuch room',
+                           "Unknown argument, see help for details")
+        self.assertInvalid('presence lunch',
+                           "Unknown argument, see help for details")
+        self.assertInvalid('quit now',
+                           "Unknown argument, see help for details")
+
+
+    def test_message_body(self):
+        # Only the checked arguments are split off, the rest is the body,
+        # which may even look like a sub-command.
+        body = ' '.join(['word'] * 10000)
+        self.validate('msgto bob@localhost ' + body)
+        self.validate('msg ' + body)
+        self.validate('presence away out for lunch')
+        self.validate('group create room extra arguments')
+
+        cmd = input._parse('msgto bob@localhost two  spaces', self.commands)
+        self.commands.validate(cmd)
+        self.assertEqual(cmd[input.ARGUMENTS], 'bob@localhost two  spaces')
+
+
+    def test_config(self):
+        self.commands = commands.ConfigCommands()
+
+        self.validate('set username alice')
+        self.validate('show')
+        self.assertInvalid('set username',
+                           "Wrong arguments, see help for details")
+        self.assertInvalid('set color yes',
+                           "Unknown argument, see help for details")
+        self.assertInvalid('msg hello', "Unknown command")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The config file, as written by config.Store and read by config.load().
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from shellber.app import config
+from tests import server
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'shellber.yml')
+
+        with open(self.filename, 'w') as f:
+            f.write("log_filename: shellber.log\n"
+                    "log_level: info\n"
+                    "account:\n"
+                    "  username: alice\n"
+                    "  server: localhost\n")
+
+        self.writes = []
+        self._save = config._save
+        config._save = self.save
+
+
+    def tearDown(self):
+        config._save = self._save
+        shutil.rmtree(self.directory)
+
+
+    def save(self, filename, cfg):
+        self._save(filename, cfg)
+        self.writes.append(cfg)
+
+
+    def store(self, delay=0.05, max_delay=5):
+        cfg = config.load(self.filename)
+        self.assertEqual(cfg.filename, self.filename)
+
+        return cfg, config.Store(cfg, delay=delay, max_delay=max_delay)
+
+
+    def test_burst(self):
+        cfg, store = self.store()
+
+        for index in range(100):
+            store.set('account', 'resource', 'resource%d' % index)
+
+        self.assertTrue(server.wait(lambda: self.writes))
+        time.sleep(0.2)
+        self.assertTrue(store.close())
+
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(config.load(self.filename).account['resource'],
+                         'resource99')
+
+
+    def test_max_delay(self):
+        cfg, store = self.store(delay=0.2, max_delay=0.5)
+        start = time.time()
+
+        # The changes never settle, but they're written anyway
+        while not self.writes and time.time() - start < 5:
+            store.set('account', 'resource', str(time.time()))
+            time.sleep(0.05)
+
+        store.close()
+        self.assertTrue(self.writes)
+        self.assertLess(time.time() - start, 2)
+
+
+    def test_close(self):
+        cfg, store = self.store(delay=60)
+        store.set('account', 'resource', 'laptop')
+        store.set('preferences', 'color', 'no')
+        self.assertTrue(store.close())
+
+        loaded = config.load(self.filename)
+        self.assertEqual(loaded.account['resource'], 'laptop')
+        self.assertEqual(loaded.account['username'], 'alice')
+        self.assertEqual(self.writes[-1]['preferences'], {'color': 'no'})
+
+
+    def test_atomic(self):
+        os.chmod(self.filename, 0o640)
+        cfg, store = self.store()
+        store.set('account', 'resource', 'laptop')
+        store.close()
+
+        # The temporary file is renamed over the old one
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0o640)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['shellber.yml', 'shellber.yml' + config.CACHE_SUFFIX])
+
+
+    def test_cache(self):
+        config.load(self.filename)
+        self.assertTrue(os.path.exists(self.filename + config.CACHE_SUFFIX))
+
+        with open(self.filename, 'a') as f:
+            f.write("send_high_water: 64\n")
+
+        self.assertEqual(config.load(self.filename).send_high_water, 64)
+
+
+    def test_same_size(self):
+        config.load(self.filename)
+        stamp = config._stamp(self.filename)
+
+        # An edit which keeps the size and the modification time
+        with open(self.filename, 'r+') as f:
+            data = f.read()
+            f.seek(0)
+            f.write(data.replace('alice', 'carol'))
+
+        os.utime(self.filename, (stamp[1], stamp[1]))
+        self.assertEqual(config.load(self.filename).account['username'],
+                         'carol')
+
+
+    def test_corrupted_cache(self):
+        config.load(self.filename)
+        cache = self.filename + config.CACHE_SUFFIX
+
+        with open(cache, 'rb') as f:
+            data = f.read()
+
+        for corrupted in (data[:-3], data[:-1] + chr(ord(data[-1]) ^ 1),
+                          'garbage'):
+            with open(cache, 'wb') as f:
+                f.write(corrupted)
+
+            self.assertEqual(config.load(self.filename).account['username'],
+                             'alice')
+
+
+    def test_python_tags(self):
+        # Written by older versions
+        with open(self.filename, 'w') as f:
+            f.write("log_filename: !!python/unicode shellber.log\n"
+                    "log_level: !!python/str info\n")
+
+        self.assertEqual(config.load(self.filename).log_level, 'info')
+
+        with open(self.filename, 'w') as f:
+            f.write("log_filename: !!python/object/apply:os.getcwd []\n"
+                    "log_level: info\n")
+
+        # Never run, the defaults are used instead
+        cfg = config.load(self.filename)
+        self.assertEqual(cfg.log_filename, config.DEFAULT_LOG_FILENAME)
+        self.assertEqual(cfg.filename, self.filename)
+
+
+    def test_explicit(self):
+        cfg, store = self.store()
+        store.set('account', 'resource', 'laptop')
+        self.assertTrue(store.close())
+
+        # The defaults aren't written, so they still apply when they change
+        self.assertEqual(sorted(self.writes[-1]),
+                         ['account', 'log_filename', 'log_level'])
+
+        with open(self.filename) as f:
+            self.assertNotIn('send_high_water', f.read())
+
+
+    def test_missing(self):
+        os.unlink(self.filename)
+        cfg, store = self.store()
+        self.assertEqual(cfg.log_level, config.DEFAULT_LOG_LEVEL)
+        self.assertTrue(store.close())
+        self.assertFalse(os.path.exists(self.filename))
+
+        # It's only created once something is set
+        cfg, store = self.store()
+        store.set('account', 'username', 'carol')
+        self.assertTrue(store.close())
+        self.assertEqual(self.writes, [{'account': {'username': 'carol'}}])
+
+
+    def test_invalid(self):
+        with open(self.filename, 'w') as f:
+            f.write("log_level: [info\n")
+
+        cfg, store = self.store()
+        store.set('account', 'username', 'carol')
+        self.assertFalse(store.close())
+
+        # The user's file is kept as it is
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), "log_level: [info\n")
+
+
+    def test_removed_keys(self):
+        cfg, store = self.store()
+        changes = []
+        watcher = config.Watcher(store, self.filename, changes.append,
+                                 interval=0.05)
+
+        try:
+            with open(self.filename, 'w') as f:
+                f.write("send_high_water: 64\n")
+
+            self.assertTrue(server.wait(lambda: changes))
+        finally:
+            watcher.close()
+            store.close()
+
+        # The removed parameters are back to their defaults, the account is
+        # gone
+        self.assertEqual(changes, [{'log_level': config.DEFAULT_LOG_LEVEL,
+                                    'send_high_water': 64,
+                                    'account': None}])
+        self.assertEqual(cfg.log_level, config.DEFAULT_LOG_LEVEL)
+        self.assertFalse(hasattr(cfg, 'account'))
+
+        # Nothing was set, so nothing is written
+        self.assertEqual(self.writes, [])
+
+
+    def test_failed_reload(self):
+        cfg, store = self.store()
+        changes = []
+
+        def handle_changes(values):
+            changes.append(values)
+            raise AttributeError(values)
+
+        watcher = config.Watcher(store, self.filename, handle_changes,
+                                 interval=0.05)
+
+        try:
+            for level in ('error', 'warning'):
+                with open(self.filename, 'w') as f:
+                    f.write("log_level: %s\n" % level)
+
+                # The watcher goes on after a change it couldn't apply
+                self.assertTrue(server.wait(
+                    lambda: changes and changes[-1].get('log_level') == level))
+        finally:
+            watcher.close()
+            store.close()
+
+
+    def test_unchanged(self):
+        cfg, store = self.store()
+        stamp = config._stamp(self.filename)
+        self.assertTrue(store.close())
+
+        # Nothing changed, so the file isn't written again
+        self.assertEqual(self.writes, [])
+        self.assertEqual(config._stamp(self.filename), stamp)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
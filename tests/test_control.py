@@ -0,0 +1,236 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The control socket of a daemon: its frames, its replies and the socket
+file itself.
+"""
+
+import os
+import shutil
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+from shellber.app import control
+from tests import server
+
+TOP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FrameTest(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+
+    def test_frames(self):
+        for payload in ('status', '', 'x' * 100000):
+            control.write_frame(self.left, payload)
+            self.assertEqual(control.read_frame(self.right), payload)
+
+
+    def test_closed(self):
+        self.left.close()
+        self.assertIsNone(control.read_frame(self.right))
+
+
+    def test_truncated(self):
+        self.left.sendall(control._HEADER.pack(10) + 'short')
+        self.left.close()
+        self.assertIsNone(control.read_frame(self.right))
+
+
+    def test_too_large(self):
+        self.left.sendall(control._HEADER.pack(control.MAX_FRAME_SIZE + 1))
+        self.assertRaises(Exception, control.read_frame, self.right)
+
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control')
+        self.server = control.Server(self.path)
+
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+
+    def answer(self, replies):
+        """
+        Answers the commands in the background.
+
+        :param replies: A dict of command lines to their (failed, lines)
+                        answers.
+
+        :return Returns the list of handled command lines.
+        """
+        handled = []
+
+        def run():
+            while len(handled) < len(replies):
+                line = self.server.readline().rstrip('\n')
+                handled.append(line)
+                self.server.reply(*replies[line])
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        return handled
+
+
+    def request(self, line):
+        """
+        Sends a command line.
+
+        :return Returns the reply.
+        """
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+
+        try:
+            control.write_frame(client, line)
+            return control.read_frame(client)
+        finally:
+            client.close()
+
+
+    def test_mode(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+
+    def test_reply(self):
+        handled = self.answer({'whoami': (False, [u'alice\xe9', 'bob']),
+                               'quit now': (True, ['unknown'])})
+
+        self.assertEqual(self.request('whoami'),
+                         control.STATUS_OK + 'alice\xc3\xa9\nbob')
+        self.assertEqual(self.request('quit now'),
+                         control.STATUS_FAILED + 'unknown')
+        self.assertEqual(handled, ['whoami', 'quit now'])
+
+
+    def test_blank(self):
+        handled = self.answer({'help': (False, ['help'])})
+
+        # Nothing to handle, but the client still gets its answer
+        self.assertEqual(self.request('   '), control.STATUS_OK)
+        self.assertEqual(self.request('# comment'), control.STATUS_OK)
+        self.assertEqual(self.request('help'), control.STATUS_OK + 'help')
+        self.assertEqual(handled, ['help'])
+
+
+    def test_send_commands(self):
+        self.answer({'one': (False, ['first']), 'two': (True, ['second'])})
+        stdout, sys.stdout = sys.stdout, StringIO()
+
+        try:
+            status = control.send_commands(self.path, ['one', 'two'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(status, 1)
+        self.assertEqual(output, 'first\nsecond\n')
+
+
+    def test_running(self):
+        self.assertRaises(Exception, control.Server, self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+
+    def test_stale(self):
+        self.server.close()
+
+        # A socket left by an application which died
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+
+        self.server = control.Server(self.path)
+        self.answer({'help': (False, ['help'])})
+        self.assertEqual(self.request('help'), control.STATUS_OK + 'help')
+
+
+    def test_close(self):
+        self.server.close()
+        self.assertFalse(os.path.exists(self.path))
+
+        # A socket which replaced ours isn't removed
+        self.server = control.Server(self.path)
+        other = self.server
+        os.remove(self.path)
+        self.server = control.Server(self.path)
+        other.close()
+        self.assertTrue(os.path.exists(self.path))
+
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_terminate(self):
+        config = os.path.join(self.directory, 'shellber.yml')
+
+        with open(config, 'w') as f:
+            f.write("log_filename: %s\n" % os.path.join(self.directory,
+                                                        'shellber.log'))
+
+        with open(os.devnull, 'w') as null:
+            daemon = subprocess.Popen([sys.executable, 'shellber-cli',
+                                       '--config', config, '--daemon',
+                                       '--socket', self.path],
+                                      cwd=TOP_DIRECTORY, stdout=null,
+                                      stderr=null)
+
+        try:
+            self.assertTrue(server.wait(lambda: os.path.exists(self.path)))
+            daemon.send_signal(signal.SIGTERM)
+            self.assertTrue(server.wait(lambda: daemon.poll() is not None))
+        finally:
+            if daemon.poll() is None:
+                daemon.kill()
+
+        # The socket is removed on the way out
+        self.assertEqual(daemon.returncode, 128 + signal.SIGTERM)
+        self.assertFalse(os.path.exists(self.path))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The completion of the command line: the prefix tree of words and the
+completer which readline calls.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from shellber.chat import roster
+from shellber.ui import input
+
+WORDS = ['romane', 'romanus', 'romulus', 'rubens', 'ruber', 'rubicon',
+         'rubicundus']
+
+class TrieTest(unittest.TestCase):
+    def labels(self, node):
+        """
+        :return Returns the tree below a node as nested (label, word,
+                children) tuples, sorted by label.
+        """
+        return [(child.label, child.word, self.labels(child))
+                for unused, child in sorted((node.children or {}).items())]
+
+
+    def test_split(self):
+        trie = input._Trie(['romane'])
+        self.assertEqual(self.labels(trie._root),
+                         [('romane', 'romane', [])])
+
+        # The edge is split where the words differ
+        trie.add('romanus')
+        self.assertEqual(self.labels(trie._root),
+                         [('roman', None, [('e', 'romane', []),
+                                           ('us', 'romanus', [])])])
+
+        # Again, above the first split
+        trie.add('romulus')
+        self.assertEqual(self.labels(trie._root),
+                         [('rom', None, [
+                             ('an', None, [('e', 'romane', []),
+                                           ('us', 'romanus', [])]),
+                             ('ulus', 'romulus', [])])])
+
+
+    def test_inner_word(self):
+        trie = input._Trie(['ruber', 'rubens'])
+
+        # A word which ends at a split, or in the middle of an edge
+        trie.add('rube')
+        trie.add('ru')
+        self.assertEqual(self.labels(trie._root),
+                         [('ru', 'ru', [('be', 'rube', [
+                             ('ns', 'rubens', []), ('r', 'ruber', [])])])])
+        self.assertEqual(trie.words('rub'), ['rube', 'rubens', 'ruber'])
+
+
+    def test_words(self):
+        trie = input._Trie(reversed(WORDS))
+
+        self.assertEqual(trie.words(''), WORDS)
+        self.assertEqual(trie.words('r'), WORDS)
+        self.assertEqual(trie.words('rom'), WORDS[:3])
+        self.assertEqual(trie.words('roma'), WORDS[:2])
+        self.assertEqual(trie.words('rubic'), WORDS[5:])
+        self.assertEqual(trie.words('rubicon'), ['rubicon'])
+        self.assertEqual(trie.words('rubicons'), [])
+        self.assertEqual(trie.words('rx'), [])
+        self.assertEqual(trie.words('x'), [])
+
+
+    def test_limit(self):
+        trie = input._Trie(WORDS)
+
+        self.assertEqual(trie.words('r', limit=3), WORDS[:3])
+        self.assertEqual(trie.words('rub', limit=1), ['rubens'])
+
+
+    def test_duplicate(self):
+        trie = input._Trie(WORDS + WORDS)
+
+        self.assertEqual(trie.words(''), WORDS)
+
+
+
+class CompleterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.roster = roster.Roster(os.path.join(self.directory, 'roster'),
+                                    'alice@localhost')
+        self.line = ''
+        self.completer = input._Completer(input.commands.UserCommands(),
+                                          lambda: self.line,
+                                          lambda: self.roster)
+
+        for jid in ('bob@localhost', 'bill@localhost', 'carol@localhost'):
+            self.add_contact(jid)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def add_contact(self, jid):
+        self.roster.save('alice@localhost', jid,
+                         {'name': jid.partition('@')[0], 'groups': []}, None)
+
+
+    def complete(self, line, text):
+        """
+        Calls the completer as readline does, until it has no more matches.
+
+        :param line: The command line before the word being completed.
+
+        :return Returns the matches.
+        """
+        self.line = line
+        matches = []
+
+        while True:
+            match = self.completer.complete(text, len(matches))
+
+            if match is None:
+                return matches
+
+            matches.append(match)
+
+
+    def test_commands(self):
+        self.assertEqual(self.complete('', 'ms'), ['msg', 'msggr', 'msgto'])
+        self.assertEqual(self.complete('', 'h'), ['help', 'history'])
+        self.assertEqual(self.complete('', 'x'), [])
+
+
+    def test_sub_commands(self):
+        self.assertEqual(self.complete('group ', ''),
+                         ['create', 'invite', 'join', 'leave', 'who'])
+        self.assertEqual(self.complete('presence ', 'o'),
+                         ['offline', 'online'])
+        self.assertEqual(self.complete('nosuchcommand ', ''), [])
+        self.assertEqual(self.complete('group nosuch ', ''), [])
+
+
+    def test_contacts(self):
+        self.assertEqual(self.complete('msgto ', 'b'),
+                         ['bill@localhost', 'bob@localhost'])
+        self.assertEqual(self.complete('msgto ', 'bo'), ['bob@localhost'])
+
+        # Only the contact argument is completed
+        self.assertEqual(self.complete('msgto bob@localhost ', 'b'), [])
+        self.assertEqual(self.complete('msg ', 'b'), [])
+
+
+    def test_sub_command_contacts(self):
+        self.assertEqual(self.complete('contact del ', 'c'),
+                         ['carol@localhost'])
+        self.assertEqual(self.complete('contact add ', 'c'), [])
+
+        # Every argument of an invitation is a contact
+        self.assertEqual(self.complete('group invite bob@localhost ', 'c'),
+                         ['carol@localhost'])
+
+
+    def test_list(self):
+        # The recipient after a comma
+        self.assertEqual(self.complete('msgto bob@localhost,', 'c'),
+                         ['carol@localhost'])
+
+
+    def test_roster_changes(self):
+        self.assertEqual(self.complete('chat ', 'd'), [])
+        self.add_contact('dave@localhost')
+        self.assertEqual(self.complete('chat ', 'd'), ['dave@localhost'])
+
+        # Without a session there's nothing to complete
+        self.roster = None
+        self.assertEqual(self.complete('chat ', 'd'), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The log file, written directly or, in the queued mode, by a background
+thread.
+"""
+
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+from shellber.app import log
+
+class LogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'shellber.log')
+        self.level = logging.getLogger().level
+
+
+    def tearDown(self):
+        log.stop_log()
+        logging.getLogger().setLevel(self.level)
+        shutil.rmtree(self.directory)
+
+
+    def messages(self):
+        """
+        :return Returns the messages of the log file, without their prefix.
+        """
+        with open(self.filename) as f:
+            return [line.rstrip('\n').split(':', 6)[-1] for line in f]
+
+
+    def test_direct(self):
+        log.start_log(self.filename, 'warning')
+        logging.info("not written")
+        logging.warning("written %d", 1)
+        log.stop_log()
+
+        self.assertEqual(self.messages(), ["written 1"])
+        self.assertNotIn(log._handler, logging.getLogger().handlers)
+
+
+    def test_queued(self):
+        log.start_log(self.filename, 'info', queued=True)
+
+        for index in range(100):
+            logging.info("message %d", index)
+
+        log.stop_log()
+
+        # Everything queued is written by stop_log()
+        self.assertEqual(self.messages(),
+                         ["message %d" % index for index in range(100)])
+        self.assertIsNone(log._listener)
+        self.assertEqual(logging.getLogger().handlers, [])
+
+
+    def test_full_queue(self):
+        log.start_log(self.filename, 'info', queued=True, queue_size=10)
+
+        # The file handler is blocked, as by a slow disk, so the queue fills
+        # up and the messages above it are dropped without blocking.
+        handler = log._listener._handler
+        handler.acquire()
+
+        try:
+            for index in range(100):
+                logging.info("message %d", index)
+
+            # Stopping waits for the queue, without losing its messages
+            stopper = threading.Thread(target=log.stop_log)
+            stopper.start()
+            stopper.join(0.2)
+            self.assertTrue(stopper.is_alive())
+        finally:
+            handler.release()
+
+        stopper.join(10)
+        self.assertFalse(stopper.is_alive())
+        self.assertIsNone(log._handler)
+
+        messages = self.messages()
+        written = [m for m in messages if m.startswith("message ")]
+        dropped = [m for m in messages if not m.startswith("message ")]
+
+        # The queued messages and the one taken by the blocked listener. If
+        # it took that one after some were dropped, those are reported
+        # before it.
+        self.assertIn(len(written), (10, 11))
+        self.assertEqual(written[:10], ["message %d" % index
+                                        for index in range(10)])
+        self.assertIn(len(dropped), (1, 2))
+
+        for message in dropped:
+            self.assertRegexpMatches(message, r'^\d+ log messages dropped')
+
+        self.assertEqual(sum(int(re.match(r'\d+', message).group())
+                             for message in dropped), 100 - len(written))
+
+
+    def test_restart(self):
+        log.start_log(self.filename, 'info', queued=True)
+        logging.info("first")
+
+        # A bad rotation interval keeps the current handler
+        handler = log._handler
+        self.assertRaises(ValueError, log.start_log, self.filename + '.2',
+                          'info', rotate_when='never')
+        self.assertIs(log._handler, handler)
+
+        log.start_log(self.filename, 'info')
+        logging.info("second")
+        log.stop_log()
+
+        self.assertEqual(self.messages(), ["first", "second"])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
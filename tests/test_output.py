@@ -0,0 +1,257 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The application output: its compiled templates, its buffered writes and
+the messages captured for the control socket.
+"""
+
+import logging
+import sys
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import colorama
+
+from shellber.ui import output
+
+class OutputTest(unittest.TestCase):
+    """
+    Each test writes to its own standard output, and the messages logged by
+    the output are kept in the logged list.
+    """
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+        self.logged = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.logged.append(
+            (record.levelno, record.getMessage()))
+        self.level = logging.getLogger().level
+        logging.getLogger().addHandler(self.handler)
+        logging.getLogger().setLevel(logging.INFO)
+
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        logging.getLogger().removeHandler(self.handler)
+        logging.getLogger().setLevel(self.level)
+
+
+    def written(self, out):
+        """
+        Writes the buffered messages of an output.
+
+        :return Returns what was written since the last call.
+        """
+        out.flush()
+        data = sys.stdout.getvalue()
+        sys.stdout.seek(0)
+        sys.stdout.truncate()
+
+        return data
+
+
+    def test_compile(self):
+        out = output.Output()
+
+        self.assertEqual(out.parse("${FG_RED}%s${FG_RESET} $$5 ${cmd}help"
+                                   "${ccmd} ${unknown}", 'error'),
+                         colorama.Fore.RED + 'error' + colorama.Fore.RESET +
+                         ' $5 ' + colorama.Fore.GREEN + 'help' +
+                         colorama.Fore.RESET + ' ${unknown}')
+
+        # Arguments aren't templates
+        out = output.Output(colors=False)
+        self.assertEqual(out.parse("${FG_RED}%s", '${FG_BLUE}'), '${FG_BLUE}')
+
+
+    def test_cache(self):
+        out = output.Output(cache_size=2, colors=False)
+        out.parse("a")
+        out.parse("b")
+        self.assertEqual(list(out._cache), ["a", "b"])
+
+        # The least recently used one is dropped
+        out.parse("a")
+        self.assertEqual(list(out._cache), ["b", "a"])
+        out.parse("c")
+        self.assertEqual(list(out._cache), ["a", "c"])
+        self.assertEqual(out.parse("b"), "b")
+        self.assertEqual(list(out._cache), ["c", "b"])
+
+
+    def test_flush(self):
+        out = output.Output(colors=False)
+
+        # A single write, with the messages in order
+        with out._flush_lock:
+            for index in range(3):
+                out.message("message %d", index)
+
+            out.error("failed")
+
+        self.assertEqual(self.written(out),
+                         "message 0\nmessage 1\nmessage 2\nfailed\n")
+        self.assertEqual(self.logged,
+                         [(logging.INFO, "message %d" % index)
+                          for index in range(3)] +
+                         [(logging.ERROR, "failed")])
+        self.assertEqual(out.errors, 1)
+        self.assertEqual(self.written(out), "")
+
+
+    def test_prompt(self):
+        out = output.Output(colors=False)
+        out.set_prompt('$> ', lambda: 'msg hel')
+
+        with out._flush_lock:
+            out.message("first")
+            out.message("second")
+
+        # The line being typed is erased and redrawn after the messages
+        self.assertEqual(self.written(out), output._ERASE_LINE +
+                         "first\nsecond\n$> msg hel")
+
+        out.set_prompt(None)
+        out.message("third")
+        self.assertEqual(self.written(out), "third\n")
+
+
+    def test_capture(self):
+        out = output.Output(colors=False)
+        out.capture()
+        out.message("kept %s", 'one')
+        out.error("kept too")
+
+        # Other threads aren't captured
+        thread = threading.Thread(target=out.message, args=("not kept",))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(out.release(), [(logging.INFO, "kept one"),
+                                         (logging.ERROR, "kept too")])
+        self.assertEqual(sorted(self.written(out).splitlines()),
+                         ["kept one", "kept too", "not kept"])
+
+        # Nothing is kept after the release
+        out.message("after")
+        self.assertEqual(out.release(), [])
+        self.assertEqual(self.written(out), "after\n")
+
+
+class _Clock(object):
+    """
+    Stands for the time module of the output, with a time which only moves
+    when told so.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.sleep = time.sleep
+
+
+    def time(self):
+        return self.now
+
+
+
+class RateLimitTest(OutputTest):
+    def setUp(self):
+        super(RateLimitTest, self).setUp()
+        self.clock = _Clock(1000.5)
+        self.time, output.time = output.time, self.clock
+        self.out = output.Output(rate_limit=3, colors=False)
+
+
+    def tearDown(self):
+        # The writer thread keeps waking up while there are suppressed
+        # messages, so they're summarized here.
+        self.clock.now += 1
+        self.written(self.out)
+        output.time = self.time
+        super(RateLimitTest, self).tearDown()
+
+
+    def receive(self, sender, count):
+        for index in range(count):
+            self.out.received(sender, "%s: %d", sender, index)
+
+
+    def test_limit(self):
+        self.receive('bob', 5)
+        self.receive('carol', 2)
+
+        # Only the first messages of each sender in a second are shown
+        self.assertEqual(self.written(self.out).splitlines(),
+                         ["bob: 0", "bob: 1", "bob: 2", "carol: 0",
+                          "carol: 1"])
+
+        # But all of them are logged
+        self.assertEqual(sorted(message for unused, message in self.logged),
+                         ["bob: %d" % index for index in range(5)] +
+                         ["carol: 0", "carol: 1"])
+
+
+    def test_summary(self):
+        self.receive('bob', 5)
+        self.receive('carol', 4)
+        self.written(self.out)
+
+        # A summary once the second is over, then the senders start again
+        self.clock.now += 1
+        self.receive('bob', 4)
+        self.assertEqual(self.written(self.out).splitlines(),
+                         ["2 more messages from bob",
+                          "1 more messages from carol",
+                          "bob: 0", "bob: 1", "bob: 2"])
+
+        self.clock.now += 1
+        self.assertEqual(self.written(self.out).splitlines(),
+                         ["1 more messages from bob"])
+        self.assertEqual(self.written(self.out), "")
+
+
+    def test_same_second(self):
+        self.receive('bob', 3)
+        self.written(self.out)
+
+        # The window is the second, not the time since the first message
+        self.clock.now += 0.4
+        self.receive('bob', 1)
+        self.assertEqual(self.written(self.out), "")
+
+        self.clock.now += 0.2
+        self.receive('bob', 1)
+        self.assertEqual(self.written(self.out),
+                         "1 more messages from bob\nbob: 0\n")
+
+
+    def test_other_messages(self):
+        self.receive('bob', 4)
+
+        # Messages which aren't received from a contact have no limit
+        for index in range(5):
+            self.out.message("notice %d", index)
+
+        self.assertEqual(len(self.written(self.out).splitlines()), 8)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+The modules loaded by shellber-cli in the modes which must start fast.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TOP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs shellber-cli and prints the loaded modules after a marker line
+_RUN = """
+import runpy, sys
+sys.argv = sys.argv[1:]
+
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+
+print '\\nmodules: ' + ' '.join(m for m in sys.modules if sys.modules[m])
+"""
+
+# Modules only needed by the terminal or by a session
+_SLOW_MODULES = ('colorama', 'readline', 'sleekxmpp')
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = os.path.join(self.directory, 'shellber.yml')
+
+        with open(self.config, 'w') as f:
+            f.write("log_filename: %s\n" % os.path.join(self.directory,
+                                                        'shellber.log'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def modules(self, *args):
+        """
+        Runs shellber-cli.
+
+        :return Returns the set of modules it loaded.
+        """
+        output = subprocess.Popen([sys.executable, '-c', _RUN,
+                                   'shellber-cli'] + list(args),
+                                  cwd=TOP_DIRECTORY, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT).communicate()[0]
+
+        for line in output.splitlines():
+            if line.startswith('modules: '):
+                return set(line.split()[1:])
+
+        self.fail("shellber-cli failed: " + output)
+
+
+    def assertNotLoaded(self, modules, names):
+        self.assertEqual([name for name in names if name in modules], [])
+
+
+    def test_version(self):
+        modules = self.modules('--version')
+
+        self.assertNotLoaded(modules, _SLOW_MODULES + ('yaml',
+                                                       'shellber.app.core'))
+
+
+    def test_help(self):
+        modules = self.modules('--help')
+
+        self.assertNotLoaded(modules, _SLOW_MODULES + ('yaml',
+                                                       'shellber.app.core'))
+
+
+    def test_batch(self):
+        batch = os.path.join(self.directory, 'commands')
+
+        with open(batch, 'w') as f:
+            f.write("help\n")
+
+        modules = self.modules('--config', self.config, '--batch', batch)
+
+        self.assertIn('shellber.app.core', modules)
+        self.assertNotLoaded(modules, _SLOW_MODULES)
@@ -0,0 +1,248 @@
+#
+# Copyright (C) 2016 Rodrigo Freitas
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+File transfers between two sessions of the loopback server, through its
+SOCKS5 proxy or In-Band.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from shellber.chat import presence
+from shellber.chat import transfer
+from tests import server
+
+class TransferTest(unittest.TestCase):
+    """
+    Alice sends files to Bob, who saves them into his downloads directory.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.downloads = os.path.join(self.directory, 'downloads')
+        self.server = None
+        self.chats = []
+        self.reports = []
+
+
+    def tearDown(self):
+        for chat in self.chats:
+            if chat.connected():
+                chat.logout()
+
+        if self.server is not None:
+            self.server.close()
+
+        shutil.rmtree(self.directory)
+
+
+    def start(self, proxy):
+        """
+        Logs Alice and Bob in, with a server of their own.
+
+        :param proxy: Indicates if the server offers a SOCKS5 proxy.
+
+        :return Returns the chat.Chat objects of Alice and Bob.
+        """
+        self.server = server.Server(roster={'alice': ['bob@localhost'],
+                                            'bob': ['alice@localhost']},
+                                    proxy=proxy)
+        chats = []
+
+        for user, options in (('alice', {}),
+                              ('bob', {'download_directory': self.downloads})):
+            chat = server.chat_class(self.server)(
+                lambda *args: None, handle_transfer=self.reports.append,
+                **options)
+            chat.login([user, 'secret', server.DOMAIN, 'test'])
+            self.chats.append(chat)
+            self.assertTrue(chat.wait_session())
+            chats.append(chat)
+
+        self.assertTrue(server.wait(
+            lambda: chats[0].presence('bob@localhost').show ==
+            presence.AVAILABLE))
+
+        return chats
+
+
+    def create(self, name, size):
+        """
+        Creates a file of random data.
+
+        :return Returns the file name and its data.
+        """
+        filename = os.path.join(self.directory, name)
+        data = os.urandom(size)
+
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+        return filename, data
+
+
+    def finished(self, sent):
+        """
+        Waits until both sides of a transfer finish.
+
+        :param sent: The Transfer object of the sender.
+
+        :return Returns the Transfer object of the receiver.
+        """
+        def received():
+            return [t for t in self.reports if t.sid == sent.sid and
+                    t.direction == transfer.RECEIVE and
+                    t.state in (transfer.DONE, transfer.FAILED)]
+
+        self.assertTrue(server.wait(
+            lambda: sent.state in (transfer.DONE, transfer.FAILED) and
+            received(), timeout=30))
+        self.assertEqual(sent.state, transfer.DONE, sent.error)
+        self.assertEqual(received()[0].state, transfer.DONE)
+
+        return received()[0]
+
+
+    def partial(self, sender, name, data, size):
+        """
+        Creates the partial file of a previous transfer.
+
+        :return Returns its name.
+        """
+        if os.path.isdir(self.downloads) is False:
+            os.makedirs(self.downloads)
+
+        partial = transfer.partial_filename(self.downloads, sender, name, size)
+
+        with open(partial, 'wb') as f:
+            f.write(data)
+
+        with open(partial + transfer.INFO_SUFFIX, 'wb') as f:
+            json.dump(dict(sender=sender, name=name, size=size), f)
+
+        return partial
+
+
+    def read(self, name):
+        with open(os.path.join(self.downloads, name), 'rb') as f:
+            return f.read()
+
+
+    def test_socks5(self):
+        alice, unused = self.start(proxy=True)
+        filename, data = self.create('socks5.bin', 3 * transfer.CHUNK_SIZE + 7)
+        self.finished(alice.send_file(filename, 'bob@localhost'))
+
+        self.assertEqual(self.read('socks5.bin'), data)
+
+
+    def test_in_band(self):
+        alice, unused = self.start(proxy=False)
+        filename, data = self.create('ibb.bin',
+                                     40 * transfer.IBB_BLOCK_SIZE + 7)
+        self.finished(alice.send_file(filename, 'bob@localhost'))
+
+        self.assertEqual(self.read('ibb.bin'), data)
+
+
+    def test_resume(self):
+        alice, unused = self.start(proxy=True)
+        filename, data = self.create('resumed.bin', 200000)
+        partial = self.partial('alice@localhost', 'resumed.bin',
+                               data[:120000], 200000)
+
+        sent = alice.send_file(filename, 'bob@localhost')
+        received = self.finished(sent)
+
+        self.assertEqual(sent.offset, 120000)
+        self.assertEqual(received.offset, 120000)
+        self.assertEqual(sent.transferred, 80000)
+        self.assertEqual(self.read('resumed.bin'), data)
+        self.assertEqual(os.listdir(self.downloads), ['resumed.bin'])
+        self.assertFalse(os.path.exists(partial))
+
+
+    def test_other_partial(self):
+        alice, unused = self.start(proxy=True)
+        filename, data = self.create('report.pdf', 200000)
+
+        # The same name from another contact, and with another size
+        others = [self.partial('carol@localhost', 'report.pdf',
+                               os.urandom(120000), 200000),
+                  self.partial('alice@localhost', 'report.pdf',
+                               os.urandom(120000), 300000)]
+
+        received = self.finished(alice.send_file(filename, 'bob@localhost'))
+
+        self.assertEqual(received.offset, 0)
+        self.assertEqual(self.read('report.pdf'), data)
+
+        for partial in others:
+            self.assertEqual(os.path.getsize(partial), 120000)
+
+
+    def test_existing(self):
+        alice, unused = self.start(proxy=True)
+        os.makedirs(self.downloads)
+
+        with open(os.path.join(self.downloads, 'notes.txt'), 'wb') as f:
+            f.write('old notes')
+
+        filename, data = self.create('notes.txt', 1000)
+        received = self.finished(alice.send_file(filename, 'bob@localhost'))
+
+        # The existing file is kept
+        self.assertEqual(received.filename,
+                         os.path.join(self.downloads, 'notes-1.txt'))
+        self.assertEqual(self.read('notes.txt'), 'old notes')
+        self.assertEqual(self.read('notes-1.txt'), data)
+
+
+    def test_concurrent(self):
+        alice, unused = self.start(proxy=True)
+        files = [self.create('file%d.bin' % index, 100000 + index)
+                 for index in range(3)]
+        sent = [alice.send_file(filename, 'bob@localhost')
+                for filename, unused in files]
+
+        for tracker in sent:
+            self.finished(tracker)
+
+        for index, (unused, data) in enumerate(files):
+            self.assertEqual(self.read('file%d.bin' % index), data)
+
+
+    def test_declined(self):
+        self.start(proxy=True)
+        filename, unused = self.create('declined.bin', 1000)
+
+        # Only contacts from the roster may send files
+        carol = server.chat_class(self.server)(lambda *args: None)
+        carol.login(['carol', 'secret', server.DOMAIN, 'test'])
+        self.chats.append(carol)
+        self.assertTrue(carol.wait_session())
+
+        sent = carol.send_file(filename, 'bob@localhost/test')
+
+        self.assertTrue(server.wait(lambda: sent.state == transfer.FAILED,
+                                    timeout=30))
+        self.assertFalse(os.path.exists(os.path.join(self.downloads,
+                                                     'declined.bin')))